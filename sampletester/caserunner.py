@@ -12,15 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
 from datetime import datetime
+import ast
+import functools
 import logging
 import os
 import re
-import subprocess
+import time
 import traceback
 import uuid
 
+from typing import List
+
+from sampletester import execution
 from sampletester import testenv
 
 
@@ -31,10 +35,27 @@ class TestCase:
 
   def __init__(self, environment: testenv.Base,
                idx: int, label: str,
-               setup, case, teardown):
+               setup, case, teardown,
+               engine: execution.Engine = None,
+               call_timeout: float = None,
+               case_timeout: float = None,
+               source: str = None):
+    """Initializes TestCase.
+
+    Args:
+      source: the path of the file defining the test case, used to report
+        the location of errors in `code` directives
+      engine: the execution.Engine used to run external commands
+      call_timeout: the default number of seconds each external command may
+        run before being killed, or None for no limit. The environment may
+        override this for specific artifacts.
+      case_timeout: the number of seconds the setup and test stages of the
+        case may take in total before any running command is killed, or None
+        for no limit. The teardown stage is not subject to this limit.
+    """
     self.failures = []
     self.errors = []
-    self.output = ""
+    self.output = OutputBuffer()
 
     self.environment = environment
     self.idx = idx
@@ -42,82 +63,27 @@ class TestCase:
     self.setup = setup
     self.case = case
     self.teardown = teardown
+    self.engine = engine if engine else execution.SubprocessEngine()
+    self.call_timeout = call_timeout
+    self.case_timeout = case_timeout
+    self.deadline = None  # per time.monotonic()
+    self.source = source
 
     self.last_return_code = 0
     self.last_call_output = ""
+    # `last_call_output` lower-cased, computed on first use by the
+    # case-insensitive checks.
+    self.folded_call_output = None
+    # The execution.Capture of the last call, which may hold more output than
+    # `last_call_output` if the engine limits how much it keeps in memory.
+    self.last_capture = None
     self.start_time = None
     self.end_time = None
 
-    # The key is the external binding available through `code` and directly through yaml keys.
-    #
-    # The value is a pair. The first element is the test variable or
-    # function. The second element, if not None, is the "yaml_prep" function
-    # that returns a pair of ([arguments], {kwargs}) for passing to the function; if
-    # the yaml_prep returns None, the test function is not called (this is
-    # useful to provide an alternate representation in the YAML)
-    self.builtins = {
-        ### Variables: meta info about the test case, last output
-        "testcase_num": (self.idx, None),
-        "testcase_id": (self.label, None),
-        "_last_call_output": (self.last_call_output, None),
-
-        ### Functions to execute processes
-        "call": (self.call_no_error, self.params_for_call),
-        "call_may_fail": (self.call_allow_error, self.params_for_call),
-        "shell": (self.shell, self.yaml_args_string),
-
-        ### Other functions available to the test suite
-        "uuid": (self.get_uuid, self.yaml_get_uuid),
-        "env": (self.get_env, self.yaml_get_env),
-        "log": (self.print_out, self.yaml_args_string),
-        "extract_match": (self.extract_match, self.yaml_extract_match),
-
-        ### Code
-        "code": (self.execute, lambda p: ([p], {})),
-
-        # Functions to fail the test: these are intended for code only
-        "fail": (self.fail, None),
-        "expect": (self.expect, None),
-        "abort": (self.abort, None),
-        "assert_that": (self.assert_that, None),
-
-        ### Functions to fail the test: intended for YAML, may be used in code as well.
-        # contains any of a list
-        "assert_contains_any": (self.contain_checker(self.assert_that, any, True),
-                                self.params_for_contains),
-        # does not contain any of a list (all list elements absent)
-        "assert_excludes": (self.contain_checker(self.assert_that, all, False),
-                                self.params_for_contains),
-        # alias for "assert_excludes"
-        "assert_not_contains": (self.contain_checker(self.assert_that, all, False),
-                                self.params_for_contains),
-
-        # contains all of a list
-        "assert_contains": (self.contain_checker(self.assert_that, all, True),
-                                self.params_for_contains),
-        # does not contain some of the list (at least one list element absent)
-        "assert_excludes_any": (self.contain_checker(self.assert_that, any, False),
-                                self.params_for_contains),
-        "assert_success": (self.assert_success, self.yaml_args_string),
-        "assert_failure": (self.assert_failure, self.yaml_args_string),
-        # Due to feedback in the spec, we only allow assert_ functions (which exit
-        # the test case immediately) and not expect_ functions (which would allow
-        # the test to continue even if an expectation is not met).
-        # "expect_contains_any": (self.# contain_checker(self.expect, any, True),
-        #                         self.params_for_contains),
-        # "expect_not_contains": (self.contain_checker(self.expect, all, False),
-        #                         self.params_for_contains),
-        # "expect_contains": (self.contain_checker(self.expect, all, True),
-        #                     self.params_for_contains),
-        # "expect_not_contains_some": (self.contain_checker(self.expect, any, False),
-        #                              self.params_for_contains),
-
-
-    }
-
+    # The variables set by the test spec. The builtins (see `BUILTINS`) are
+    # only added when `code` first runs, since most cases never need them.
     self.local_symbols = {}
-    for symbol, info in self.builtins.items():
-      self.local_symbols[symbol] = info[0]
+    self.builtins_in_symbols = False
 
   def get_failures(self):
     return [(status, message.format(*args))
@@ -160,13 +126,17 @@ class TestCase:
   def print_out(self, msg, *args):
     """Formats `msg` according to `args` and records it in the TestCase output."""
     try:
-      self.output += self.format_string(str(msg), *args) + "\n"
+      self.output.write(self.format_string(str(msg), *args) + "\n")
     except Exception as e:
       raise
 
   def execute(self, code):
     """Executes YAML directive "code"."""
-    exec(code, None, self.local_symbols)
+    if not self.builtins_in_symbols:
+      for symbol, info in self.BUILTINS.items():
+        self.local_symbols.setdefault(symbol, info[0](self))
+      self.builtins_in_symbols = True
+    exec(compile_code(code, self.source), None, self.local_symbols)
 
   def get_uuid(self):
     """Gets a UUID via code."""
@@ -188,8 +158,14 @@ class TestCase:
     self.local_symbols[var_name] = self.get_env(env_var)
     return None, None
 
-  def extract_match(self, pattern, variable=None, group_variables=None):
-    """Extracts regular expression captures from output via code."""
+  def extract_match(self, pattern, variable=None, group_variables=None,
+                    streaming=False):
+    """Extracts regular expression captures from output via code.
+
+    If `streaming` and the last output was too large to keep in memory, the
+    whole of it is searched chunk by chunk (see `chunks_search`) rather than
+    just the part in `last_call_output`.
+    """
 
     if not pattern:
       raise ConfigError("extract_match requires pattern to match")
@@ -204,8 +180,11 @@ class TestCase:
       for variable_name in group_variables:
        self.local_symbols[variable_name] = None
 
-    text = self.last_call_output
-    match = re.search(pattern, text)
+    regex = compile_pattern(pattern)
+    if streaming and self.last_capture and self.last_capture.spilled():
+      match = chunks_search(regex, self.last_capture.text_chunks())
+    else:
+      match = regex.search(self.last_call_output)
     if match and match.groups():
       captures = match.groups()
       if variable:
@@ -221,46 +200,92 @@ class TestCase:
     key_pattern = 'pattern'
     key_variable = 'variable'
     key_groups = 'groups'
+    key_streaming = 'streaming'
     return [parts.get(key_pattern), parts.get(key_variable),
-      parts.get(key_groups)], None
+      parts.get(key_groups), parts.get(key_streaming, False)], None
 
   def call_allow_error(self, *args, **kwargs):
     """Invokes `cmd` (formatted with `params`). Does not fail in case of error."""
     try:
       call, chdir = self.environment.get_call(*args, **kwargs)
+      timeout = self.environment.get_call_timeout(*args, **kwargs)
+      script = self.environment.get_call_script(*args, **kwargs)
     except Exception as e:
       raise CallError('could not resolve call: {}'.format(str(e)))
-    return self._call_external(call, chdir)
+    return self._call_external(call, chdir, timeout, script)
 
   def shell(self, cmd, *args):
     return self._call_external(self.format_string(cmd + " {}"*len(args), *args))
 
-  def _call_external(self, cmd, chdir=None):
+  def _call_external(self, cmd, chdir=None, timeout=None, script=None):
+    """Runs `cmd` from directory `chdir`, recording its output.
+
+    If `script` is set, it is the (interpreter, path, arguments) triple of the
+    Python script that `cmd` runs, which the engine may run in a warm
+    interpreter instead.
+    """
     self.last_return_code = 0
     self.last_call_output = ""
+    self.folded_call_output = None
+    self.release_last_capture()
 
+    self.print_out("\n# Calling: " + cmd)
+    timeout, limited_by_case = self.effective_timeout(timeout)
     try:
-      self.print_out("\n# Calling: " + cmd)
-      out = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True, cwd=chdir)
-      return_code = 0
-    except subprocess.CalledProcessError as e:
-      return_code = e.returncode
-      out = e.output
+      if script:
+        return_code, capture = self.engine.run_python(cmd, *script, chdir,
+                                                      timeout)
+      else:
+        return_code, capture = self.engine.run(cmd, chdir, timeout)
+    except execution.TimeoutExpired as e:
+      self.last_capture = e.capture
+      self.output.write(e.capture.head_text())
+      if limited_by_case:
+        raise CallTimeout('test case timed out after {} seconds while calling: {}'
+                          .format(self.case_timeout, cmd))
+      raise CallTimeout('call timed out after {} seconds: {}'
+                        .format(timeout, cmd))
+    if return_code != 0:
       # TODO(vchudnov): Prefix the error output with comments
-      self.output += "# ... call did not succeed  "
-      # return return_code, out
-    except Exception as e:
-      raise
+      self.output.write("# ... call did not succeed  ")
 
-    new_output = out.decode("utf-8")
+    # If the output was too large to keep in memory, only its head is
+    # available as text; the checks on the last output read the rest back from
+    # `self.last_capture`.
+    new_output = capture.head_text()
+    self.last_capture = capture
     self.last_return_code = return_code
     # TODO: De-dupe the following. Either some accessor magic, or have it live in local_symbols
     self.last_call_output = new_output
+    self.folded_call_output = None
     self.local_symbols['_last_call_output'] = new_output
 
-    self.output += new_output
+    self.output.write(new_output)
+    if capture.spilled():
+      self.print_out('\n# ... output truncated: {} of {} bytes shown',
+                     len(capture.head()), capture.size)
     return return_code, new_output
 
+  def effective_timeout(self, call_timeout=None):
+    """Returns the timeout for the next call and whether the case limits it.
+
+    The timeout is `call_timeout` if specified, or else `self.call_timeout`,
+    in either case capped by the time remaining before `self.deadline`.
+    """
+    timeout = call_timeout if call_timeout is not None else self.call_timeout
+    if self.deadline is None:
+      return timeout, False
+    remaining = max(self.deadline - time.monotonic(), 0)
+    if timeout is None or remaining < timeout:
+      return remaining, True
+    return timeout, False
+
+  def release_last_capture(self):
+    """Frees any resources held by the capture of the last call."""
+    if self.last_capture:
+      self.last_capture.close()
+      self.last_capture = None
+
   def call_no_error(self, *args, **kwargs):
     """Invokes `cmd` (formatted with `args`), failing/soft-aborting if error."""
     return_code, out = self.call_allow_error(*args, **kwargs)
@@ -302,11 +327,12 @@ class TestCase:
       if self.KEY_CONTAINS_MESSAGE in kwargs:
         message = kwargs[self.KEY_CONTAINS_MESSAGE]
         del(kwargs[self.KEY_CONTAINS_MESSAGE])
+      found = self.last_output_contains_each(values, **kwargs)
       if contains:
-        condition = lambda substr: self.last_output_contains(substr, **kwargs)
+        self._check_several(check, which, found, message, values, 'missing')
       else:
-        condition = lambda substr: not self.last_output_contains(substr, **kwargs)
-      self._check_several(check, which, condition, message, values)
+        self._check_several(check, which, [not f for f in found], message,
+                            values, 'found')
     return checker
 
   # Assertion on the return value of the last call indicating success.
@@ -319,22 +345,24 @@ class TestCase:
     message = message or "expected last call to fail"
     self.assert_that(self.last_return_code != 0, message, *args)
 
-  def _check_several(self, check, which, condition, message, values):
+  def _check_several(self, check, which, results, message, values,
+                     unmet_label):
     """Utility function for the `expect_*` and `assert_*` calls.
 
-    Runs `check` on `condition` for each element of `values`, reporting on
-    aggregate errors (as determined by `which`) either with the default error
-    message or `message`, if non- empty.
+    Runs `check` on the aggregate of `results` (as determined by `which`),
+    reporting errors either with the default error message or `message`, if
+    non-empty, followed by the `values` that did not meet the condition.
 
     Args:
       check: one of `self.assert`_that or `self.expect`
       which: one of `any` or `all`
-      condition: a function that evaluates to true in the expected case
+      results: for each of `values`, whether it met the condition
       message: if non-empty, the message to output if the condition fails. If
          empty, a default message will be constructed
-      values: the values to be tested using condition. This check will pass or
-         fail depending on the result of `which` applies to the result of
-         `condition` on these `values`.
+      values: the values that were tested. This check will pass or fail
+         depending on the result of `which` applied to `results`.
+      unmet_label: how to describe the values that did not meet the condition
+         in the message, eg "missing"
     """
     default_message = len(message) == 0
     label_check = 'required' if check == self.assert_that else 'expected' if check == self.expect else None
@@ -345,7 +373,10 @@ class TestCase:
     if default_message:
       message = ('{}, but did not find, {} the following values in the preceding output: {}'
                  .format(label_check, label_which, values))
-    check(which([condition(substr) for substr in values]), message)
+    unmet = [value for value, met in zip(values, results) if not met]
+    if unmet:
+      message = '{} ({}: {})'.format(message, unmet_label, unmet)
+    check(which(results), message)
 
   def run(self):
     self.start_time = datetime.now()
@@ -354,16 +385,22 @@ class TestCase:
         self.idx, self.label)
 
     def run_segments_of(stage_spec):
-      if stage_spec:
-        for spec_segment in stage_spec:
-          self.run_segment(spec_segment)
+      for operation in compile_spec(stage_spec, call_target_key(self.environment),
+                                    self.source):
+        operation.run(self)
 
+    if self.case_timeout is not None:
+      self.deadline = time.monotonic() + self.case_timeout
     try:
       for stage_name, stage_spec in [("SETUP", self.setup), ("TEST", self.case)]:
         self.print_out("\n### Test case {0}".format(stage_name))
         run_segments_of(stage_spec)
     except TestFailure:
       pass
+    except CallTimeout as e:
+      status = f'TIMEOUT in stage {stage_name} of case {self.idx} ("{self.label}")'
+      self.record_error(status, e.msg)
+      self.print_out(f'# {status}: {e.msg}')
     except CallError as e:
       status = f'CALL ERROR in stage {stage_name} of case {self.idx} ("{self.label}")'
       self.record_error(status, e.msg)
@@ -392,6 +429,7 @@ class TestCase:
       self.print_out(f'# {status} {short_details}')
 
     finally:
+      self.deadline = None
       try:
         self.print_out("\n### Test case TEARDOWN")
         run_segments_of(self.teardown)
@@ -399,6 +437,10 @@ class TestCase:
         status = f'unexpected TEST FAILURE in stage TEARDOWN  of case {self.idx} ("{self.label}")'
         self.record_error(status, f'test failure in stage TEARDOWN  of case {self.idx} ("{self.label}")')
         self.print_out(f'# {status}')
+      except CallTimeout as e:
+        status = f'TIMEOUT in stage TEARDOWN of case {self.idx} ("{self.label}")'
+        self.record_error(status, e.msg)
+        self.print_out(f'# {status}: {e.msg}')
       except CallError as e:
         status = f'CALL ERROR in stage TEARDOWN  of case {self.idx} ("{self.label}")'
         self.record_error(status, e.msg)
@@ -442,40 +484,49 @@ class TestCase:
       logging.info("    Output:")
       logging.info(self.get_output(4, "| ") + "\n")
 
+    self.release_last_capture()
     self.end_time = datetime.now()
     return len(self.failures) + len(self.errors)
 
+  def replay(self, output: str):
+    """Records `output` from an earlier passing run instead of running again."""
+    self.start_time = datetime.now()
+    self.output.write(output)
+    logging.info(f'---- Test case {self.idx:d}: "{self.label:s}" '
+                 'PASSED (cached) -----------------------')
+    self.end_time = datetime.now()
+    return 0
+
   def get_output(self, indent=0, header=""):
-    return reindent(copy.deepcopy(self.output), indent, header)
+    return self.output.indented(indent, header)
 
   def run_segment(self, spec_segment):
-    if len(spec_segment) > 1:
-      logging.error(f'multiple spec segments, expected only one: {spec_segment}')
-      raise ConfigError('more than one spec segment')
-
-    for directive, segment in spec_segment.items():
-      if directive not in self.builtins:
-        raise ConfigError(f'unknown YAML directive: "{directive}"')
-
-      howto = self.builtins[directive]
-      if howto[1] == None:
-        raise ConfigError(f'directive only available inside a code directive: "{directive}"')
-
-      args, kwargs = howto[1](segment)
-      if args is None and kwargs is None:
-        return
-      args = args or []
-      kwargs = kwargs or {}
-
-      howto[0](*args, **kwargs)
+    operation = Operation.of(spec_segment, call_target_key(self.environment),
+                             self.source)
+    if operation:
+      operation.run(self)
 
   #### Helper methods
 
   def last_output_contains(self, substr, **kwargs):
+    return self.last_output_contains_each([substr], **kwargs)[0]
+
+  def last_output_contains_each(self, substrs, **kwargs):
+    """Returns, for each of `substrs`, whether it occurs in the last output.
+
+    The output is only read (and, unless `case_sensitive`, lower-cased) once
+    for all of `substrs`.
+    """
     case_sensitive = kwargs.get('case_sensitive', False)
+    substrs = [str(substr) for substr in substrs]
+    if self.last_capture and self.last_capture.spilled():
+      return chunks_contain_each(self.last_capture.text_chunks(), substrs,
+                                 case_sensitive)
     if case_sensitive:
-      return substr in self.last_call_output
-    return substr.lower() in self.last_call_output.lower()
+      return [substr in self.last_call_output for substr in substrs]
+    if self.folded_call_output is None:
+      self.folded_call_output = self.last_call_output.lower()
+    return [substr.lower() in self.folded_call_output for substr in substrs]
 
   def format_string(self, msg, *args):
     """Returns `msg` formatted with `*args`.
@@ -526,7 +577,7 @@ class TestCase:
     return parts[key_variable], parts[key_name]
 
   def params_for_call(self, parts):
-    key_cmd = self.environment.get_testcase_settings().get('call.target', 'target')
+    key_cmd = call_target_key(self.environment)
     key_params = "params"
     key_args = "args"
     if len(parts) < 1 or not key_cmd in parts:
@@ -602,7 +653,7 @@ class TestCase:
           .format(key_variable, key_literal, map))
     for type, item in map.items():
       if type == key_variable:
-        item = self.local_symbols[item]
+        item = self.lookup_symbol(item)
       elif type != key_literal:
         raise ConfigError(
             f'expected "{key_variable}" or "{key_literal}", '
@@ -616,7 +667,369 @@ class TestCase:
     value of the variable with that name, if such exists, or the quoted string
     itself..
     """
-    return [self.local_symbols.get(p, '"{}"'.format(str(p))) for p in strings]
+    return [self.lookup_symbol(p, '"{}"'.format(str(p))) for p in strings]
+
+  def lookup_symbol(self, name, *default):
+    """Returns the value of the variable or builtin `name`.
+
+    If there is no such symbol, returns `default` if specified, or else raises
+    KeyError.
+    """
+    if name in self.local_symbols:
+      return self.local_symbols[name]
+    if name in self.BUILTINS:
+      return self.BUILTINS[name][0](self)
+    if default:
+      return default[0]
+    raise KeyError(name)
+
+  # The key is the external binding available through `code` and directly through yaml keys.
+  #
+  # The value is a pair. The first element is a function that returns the test
+  # variable or function when passed the TestCase. The second element, if not
+  # None, is the "yaml_prep" method that returns a pair of ([arguments],
+  # {kwargs}) for passing to the function; if the yaml_prep returns None, the
+  # test function is not called (this is useful to provide an alternate
+  # representation in the YAML)
+  #
+  # This table is shared by all instances, rather than built for each one.
+  BUILTINS = {
+      ### Variables: meta info about the test case, last output
+      "testcase_num": (lambda self: self.idx, None),
+      "testcase_id": (lambda self: self.label, None),
+      "_last_call_output": (lambda self: self.last_call_output, None),
+
+      ### Functions to execute processes
+      "call": (lambda self: self.call_no_error, params_for_call),
+      "call_may_fail": (lambda self: self.call_allow_error, params_for_call),
+      "shell": (lambda self: self.shell, yaml_args_string),
+
+      ### Other functions available to the test suite
+      "uuid": (lambda self: self.get_uuid, yaml_get_uuid),
+      "env": (lambda self: self.get_env, yaml_get_env),
+      "log": (lambda self: self.print_out, yaml_args_string),
+      "extract_match": (lambda self: self.extract_match, yaml_extract_match),
+
+      ### Code
+      "code": (lambda self: self.execute, lambda self, p: ([p], {})),
+
+      # Functions to fail the test: these are intended for code only
+      "fail": (lambda self: self.fail, None),
+      "expect": (lambda self: self.expect, None),
+      "abort": (lambda self: self.abort, None),
+      "assert_that": (lambda self: self.assert_that, None),
+
+      ### Functions to fail the test: intended for YAML, may be used in code as well.
+      # contains any of a list
+      "assert_contains_any": (
+          lambda self: self.contain_checker(self.assert_that, any, True),
+          params_for_contains),
+      # does not contain any of a list (all list elements absent)
+      "assert_excludes": (
+          lambda self: self.contain_checker(self.assert_that, all, False),
+          params_for_contains),
+      # alias for "assert_excludes"
+      "assert_not_contains": (
+          lambda self: self.contain_checker(self.assert_that, all, False),
+          params_for_contains),
+
+      # contains all of a list
+      "assert_contains": (
+          lambda self: self.contain_checker(self.assert_that, all, True),
+          params_for_contains),
+      # does not contain some of the list (at least one list element absent)
+      "assert_excludes_any": (
+          lambda self: self.contain_checker(self.assert_that, any, False),
+          params_for_contains),
+      "assert_success": (lambda self: self.assert_success, yaml_args_string),
+      "assert_failure": (lambda self: self.assert_failure, yaml_args_string),
+      # Due to feedback in the spec, we only allow assert_ functions (which exit
+      # the test case immediately) and not expect_ functions (which would allow
+      # the test to continue even if an expectation is not met).
+      # "expect_contains_any": (lambda self: self.contain_checker(self.expect, any, True),
+      #                         params_for_contains),
+      # "expect_not_contains": (lambda self: self.contain_checker(self.expect, all, False),
+      #                         params_for_contains),
+      # "expect_contains": (lambda self: self.contain_checker(self.expect, all, True),
+      #                     params_for_contains),
+      # "expect_not_contains_some": (lambda self: self.contain_checker(self.expect, any, False),
+      #                              params_for_contains),
+  }
+
+### Compiled test specs
+
+class Operation:
+  """A single, checked spec segment, bound to the builtin implementing it.
+
+  The arguments are still prepared (see `TestCase.BUILTINS`) each time the
+  operation runs, since they may refer to variables set earlier in the case.
+  """
+  __slots__ = ('directive', 'argument', 'function', 'prepare')
+
+  def __init__(self, directive: str, argument, target_key: str = 'target',
+               source: str = None):
+    """Initializes Operation, raising ConfigError if the directive is invalid.
+
+    Args:
+      target_key: the key naming the artifact in `call` directives
+      source: the path of the file defining the directive, for `code`
+    """
+    builtin = TestCase.BUILTINS.get(directive)
+    if builtin is None:
+      raise ConfigError(f'unknown YAML directive: "{directive}"')
+    if builtin[1] is None:
+      raise ConfigError(f'directive only available inside a code directive: "{directive}"')
+    check = ARGUMENT_CHECKS.get(directive)
+    problem = check(argument, target_key) if check else None
+    if problem:
+      raise ConfigError(f'invalid "{directive}" directive: {problem}')
+    if directive == 'code':
+      compile_code(argument, source)
+
+    self.directive = directive
+    self.argument = argument
+    self.function, self.prepare = builtin
+
+  @staticmethod
+  def of(spec_segment, target_key: str = 'target', source: str = None):
+    """Returns the Operation for `spec_segment`, or None if it is empty."""
+    if not isinstance(spec_segment, dict):
+      raise ConfigError(f'expected a directive, got: {spec_segment}')
+    if len(spec_segment) > 1:
+      logging.error(f'multiple spec segments, expected only one: {spec_segment}')
+      raise ConfigError('more than one spec segment')
+    for directive, argument in spec_segment.items():
+      return Operation(directive, argument, target_key, source)
+    return None
+
+  def run(self, tcase: TestCase):
+    args, kwargs = self.prepare(tcase, self.argument)
+    if args is None and kwargs is None:
+      return
+    self.function(tcase)(*(args or []), **(kwargs or {}))
+
+
+class CompiledSpec(tuple):
+  """The Operations of one stage (setup, test or teardown) of a test spec."""
+  pass
+
+
+def compile_spec(stage_spec, target_key: str = 'target',
+                 source: str = None) -> CompiledSpec:
+  """Returns `stage_spec` compiled into Operations.
+
+  This raises ConfigError for the first invalid segment, so that no part of a
+  malformed spec runs. `stage_spec` may also be an already compiled spec.
+  """
+  if isinstance(stage_spec, CompiledSpec):
+    return stage_spec
+  if not stage_spec:
+    return CompiledSpec()
+  if not isinstance(stage_spec, list):
+    raise ConfigError(f'expected a list of directives, got: {stage_spec}')
+  operations = [Operation.of(segment, target_key, source)
+                for segment in stage_spec]
+  return CompiledSpec(operation for operation in operations if operation)
+
+
+def call_target_key(environment: testenv.Base) -> str:
+  """Returns the key naming the artifact in `call` directives."""
+  return (environment.get_testcase_settings() or {}).get('call.target', 'target')
+
+
+# The checks on the arguments of YAML directives that would certainly fail when
+# run. Each is passed the argument and the `call` target key, and returns a
+# description of the problem, if any.
+
+def check_value(value):
+  if not isinstance(value, dict) or len(value) != 1:
+    return f'expected exactly one of "variable" or "literal", got {value}'
+  kind = next(iter(value))
+  if kind not in ('variable', 'literal'):
+    return f'expected "variable" or "literal", got "{kind}"'
+  return None
+
+
+def check_call(argument, target_key):
+  if not isinstance(argument, dict) or target_key not in argument:
+    return f'the first parameter must be "- {target_key}: TARGET"'
+  for key, value in argument.items():
+    if key == 'params':
+      if not isinstance(value, dict):
+        return '"params" must be a mapping'
+      values = value.values()
+    elif key == 'args':
+      if not isinstance(value, list):
+        return '"args" must be a list'
+      values = value
+    elif key == target_key:
+      continue
+    else:
+      return f'unknown argument "{key}"'
+    for problem in map(check_value, values):
+      if problem:
+        return problem
+  return None
+
+
+def check_contains(argument, target_key):
+  if not isinstance(argument, list) or not argument:
+    return 'expected a list of values'
+  values = argument
+  if isinstance(argument[0], dict) and TestCase.KEY_CONTAINS_MESSAGE in argument[0]:
+    values = argument[1:]
+  for problem in map(check_value, values):
+    if problem:
+      return problem
+  return None
+
+
+def check_args_string(argument, target_key):
+  if isinstance(argument, dict):
+    return 'expected a list whose first element is a string'
+  return None
+
+
+def check_set(argument, target_key):
+  if not isinstance(argument, dict) or not {'name', 'variable'} <= argument.keys():
+    return 'need both "name" and "variable"'
+  return None
+
+
+def check_variable_name(argument, target_key):
+  if not isinstance(argument, str):
+    return f'expected a variable name, got {argument}'
+  return None
+
+
+def check_extract_match(argument, target_key):
+  if not isinstance(argument, dict) or not argument.get('pattern'):
+    return 'requires pattern to match'
+  if not argument.get('variable') and not argument.get('groups'):
+    return 'requires variable or groups'
+  if argument.get('variable') and argument.get('groups'):
+    return 'cannot accept both variables and groups'
+  if not isinstance(argument.get('streaming', False), bool):
+    return 'expected "streaming" to be true or false'
+  try:
+    compile_pattern(argument['pattern'])
+  except ConfigError as e:
+    return e.msg
+  return None
+
+
+def check_code(argument, target_key):
+  if not isinstance(argument, str):
+    return 'expected a string of Python code'
+  return None
+
+
+ARGUMENT_CHECKS = {
+    'call': check_call,
+    'call_may_fail': check_call,
+    'shell': check_args_string,
+    'log': check_args_string,
+    'assert_success': check_args_string,
+    'assert_failure': check_args_string,
+    'uuid': check_variable_name,
+    'env': check_set,
+    'extract_match': check_extract_match,
+    'code': check_code,
+    'assert_contains_any': check_contains,
+    'assert_excludes': check_contains,
+    'assert_not_contains': check_contains,
+    'assert_contains': check_contains,
+    'assert_excludes_any': check_contains,
+}
+
+
+### Helpers for `code` directives
+
+@functools.lru_cache(maxsize=1024)
+def compile_code(code: str, source: str = None):
+  """Returns the compiled `code` of a `code` directive in the file `source`.
+
+  The code objects are cached, since the same `code` directive (eg in a suite's
+  setup) typically runs for many cases and environments. If `code` appears
+  exactly once in `source`, the line numbers in tracebacks and syntax errors
+  are those in `source`; otherwise they are relative to the start of `code`.
+  """
+  offset = code_line_offset(code, source) if source else None
+  if offset is None:
+    filename = '<code in {}>'.format(source) if source else '<code>'
+    offset = 0
+  else:
+    filename = source
+  try:
+    tree = ast.parse(code, filename)
+  except SyntaxError as e:
+    raise ConfigError('syntax error in code at {}, line {}: {}'
+                      .format(filename, (e.lineno or 1) + offset, e.msg))
+  ast.increment_lineno(tree, offset)
+  return compile(tree, filename, 'exec')
+
+
+def code_line_offset(code: str, source: str):
+  """Returns the line number in `source` just before `code` starts, if unique.
+
+  Returns None if the first non-blank line of `code` does not end exactly one
+  line of `source`.
+  """
+  code_lines = code.splitlines()
+  first = next((idx for idx, line in enumerate(code_lines) if line.strip()),
+               None)
+  if first is None:
+    return None
+  needle = code_lines[first].strip()
+  matches = [idx for idx, line in enumerate(source_lines(source))
+             if line.rstrip().endswith(needle)]
+  if len(matches) != 1:
+    return None
+  return matches[0] - first
+
+
+@functools.lru_cache(maxsize=64)
+def source_lines(source: str):
+  try:
+    with open(source, 'r') as stream:
+      return tuple(stream.read().splitlines())
+  except (OSError, UnicodeDecodeError):
+    return ()
+
+
+### Helpers for `extract_match` directives
+
+@functools.lru_cache(maxsize=1024)
+def compile_pattern(pattern: str):
+  """Returns the compiled regex `pattern`, raising ConfigError if invalid.
+
+  Like `compile_code`, this is cached because the same directive typically runs
+  for many cases and environments; checking the test plan before running it
+  (see `compile_spec`) compiles every pattern in advance.
+  """
+  try:
+    return re.compile(pattern)
+  except (re.error, TypeError) as e:
+    raise ConfigError(f'invalid pattern "{pattern}": {e}')
+
+
+def chunks_search(regex, chunks, max_match: int = execution.CHUNK_SIZE):
+  """Returns the first match of `regex` in the concatenation of `chunks`.
+
+  The chunks are never joined in memory: each is searched together with the
+  last `max_match` characters of the text before it, so matches longer than
+  `max_match` may be missed. A match that reaches the end of the text searched
+  so far is only returned once the next chunk shows it can't grow any longer.
+  Note that `^` and `\\A` also match at the start of each searched window.
+  """
+  window = ''
+  match = regex.search(window)
+  for chunk in chunks:
+    window = (window[-max_match:] if max_match > 0 else '') + chunk
+    match = regex.search(window)
+    if match and match.end() < len(window):
+      return match
+  return match
 
 ### Helpers for substituting symbol values
 
@@ -630,6 +1043,84 @@ def interpolate_symbols(msg, resolver):
   """
   return _interpolated_symbol_re.sub(lambda match: resolver(match.group(1)), msg)
 
+### Helpers for searching output
+
+def chunks_contain(chunks, substr: str, case_sensitive: bool) -> bool:
+  """Returns whether `substr` occurs in the concatenation of `chunks`."""
+  return chunks_contain_each(chunks, [substr], case_sensitive)[0]
+
+
+def chunks_contain_each(chunks, substrs: List[str],
+                        case_sensitive: bool) -> List[bool]:
+  """Returns, for each of `substrs`, whether it occurs in the concatenation of
+  `chunks`.
+
+  The chunks are read once for all of `substrs`, stopping as soon as every one
+  has been found. Only the last `len(longest substr) - 1` characters of each
+  chunk are carried over to the next one, so the chunks need never be joined
+  in memory.
+  """
+  if not case_sensitive:
+    substrs = [substr.lower() for substr in substrs]
+  found = [False] * len(substrs)
+  remaining = list(range(len(substrs)))
+  overlap = max([len(substr) for substr in substrs] + [1]) - 1
+  tail = ''
+  for chunk in chunks:
+    if not case_sensitive:
+      chunk = chunk.lower()
+    window = tail + chunk
+    for idx in remaining:
+      found[idx] = substrs[idx] in window
+    remaining = [idx for idx in remaining if not found[idx]]
+    if not remaining:
+      return found
+    tail = window[-overlap:] if overlap > 0 else ''
+  for idx in remaining:
+    found[idx] = substrs[idx] in tail
+  return found
+
+### Output log
+
+class OutputBuffer:
+  """Accumulates the output log of a test case.
+
+  Text is appended as a list of chunks, which are only joined when the log is
+  rendered. The rendered text and its indented views are cached until more
+  text is written, so repeated rendering (eg by several reporters) is cheap.
+  """
+
+  def __init__(self):
+    self._chunks = []
+    self._text = ''
+    self._views = {}
+
+  def write(self, text: str):
+    """Appends `text` to the log."""
+    if not text:
+      return
+    self._chunks.append(text)
+    self._views = {}
+
+  def getvalue(self) -> str:
+    """Returns the entire log."""
+    if self._chunks:
+      self._text = ''.join([self._text] + self._chunks)
+      self._chunks = []
+    return self._text
+
+  def indented(self, indent: int = 0, header: str = '') -> str:
+    """Returns the log with each line prefixed by `indent` spaces and `header`."""
+    key = (indent, header)
+    view = self._views.get(key)
+    if view is None:
+      view = reindent(self.getvalue(), indent, header)
+      self._views[key] = view
+    return view
+
+  def __str__(self):
+    return self.getvalue()
+
 ### General helpers
 
 class TestFailure(Exception):
@@ -645,6 +1136,10 @@ class CallError(Exception):
   def __init__(self, msg):
     self.msg = msg
 
+class CallTimeout(CallError):
+  """Exception raised when a call is killed for exceeding its time limit."""
+  pass
+
 
 # heavily adapted from from https://www.oreilly.com/library/view/python-cookbook/0596001673/ch03s12.html
 def reindent(s, numSpaces, prompt):
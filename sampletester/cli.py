@@ -44,11 +44,16 @@ from typing import Tuple
 
 from sampletester import convention
 from sampletester import environment_registry
+from sampletester import execution
 from sampletester import inputs
+from sampletester import parser
+from sampletester import resultcache
 from sampletester import runner
 from sampletester import summary
 from sampletester import testplan
+from sampletester import timings
 from sampletester import xunit
+from sampletester.convention import tag
 
 VERSION = '0.16.3'
 EXITCODE_SUCCESS = 0
@@ -62,6 +67,9 @@ EXITCODE_USER_ABORT = 4
 DEBUGME=False
 
 def main():
+  if len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+    exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
   args, usage = parse_cli()
   if not args:
     exit(EXITCODE_SETUP_ERROR)
@@ -78,14 +86,32 @@ def main():
   DEBUGME = DEBUGME or (log_level == logging.DEBUG)
 
   try:
-    indexed_docs = inputs.index_docs(*args.files)
-
-    registry = environment_registry.new(args.convention, indexed_docs)
+    parse_cache = None
+    if not args.no_parse_cache:
+      parse_cache = parser.ParseCache(
+          parser.default_cache_directory(),
+          max_age=args.parse_cache_max_age * SECONDS_PER_DAY,
+          max_bytes=args.parse_cache_max_mb * BYTES_PER_MB)
+    indexed_docs = inputs.index_docs(
+        *args.files, parse_cache=parse_cache, jobs=args.parse_jobs,
+        prune=inputs.DEFAULT_PRUNED_DIRECTORIES.union(args.skip_dir))
+
+    registry = environment_registry.new(args.convention, indexed_docs,
+                                        args.manifest_snapshot)
     test_suites = testplan.suites_from(indexed_docs, args.suites, args.cases)
 
     if len(test_suites) == 0:
       exit(EXITCODE_SUCCESS)
-    manager = testplan.Manager(registry, test_suites, args.envs)
+
+    timing_db = timings.Database(args.timings).load() if args.timings else None
+    manager = testplan.Manager(
+        registry, test_suites, args.envs,
+        duration_estimator=timing_db.estimate if timing_db else None)
+    if args.shard_count > 1:
+      shard_timings = (timings.Database(args.shard_timings).load()
+                       if args.shard_timings else None)
+      manager.shard(args.shard_index, args.shard_count,
+                    shard_timings.estimate if shard_timings else None)
 
   except Exception as e:
     logging.error(f'fatal error: {repr(e)}')
@@ -98,15 +124,56 @@ def main():
 
   verbosity = VERBOSITY_LEVELS[args.verbosity]
   quiet = verbosity == summary.Detail.NONE
-  visitor = testplan.MultiVisitor(runner.Visitor(args.fail_fast),
-                                  summary.SummaryVisitor(verbosity,
-                                                         not args.suppress_failures,
-                                                         debug=DEBUGME))
+  python_pool = None
+  if args.python_workers > 0:
+    python_pool = execution.PythonPool(args.python_workers,
+                                       args.python_preload)
+  engine = execution.new(args.engine, args.max_output_bytes, python_pool)
+  result_cache = None
+  if not args.no_result_cache:
+    result_cache = resultcache.ResultCache(
+        args.result_cache_dir,
+        max_age=args.result_cache_max_age * SECONDS_PER_DAY,
+        max_bytes=args.result_cache_max_mb * BYTES_PER_MB)
+  run_visitor = runner.Visitor(args.fail_fast, engine=engine,
+                               call_timeout=args.call_timeout,
+                               case_timeout=args.case_timeout,
+                               result_cache=result_cache)
+  problems = run_visitor.compile_plan(manager)
+  if problems:
+    print('\nERROR: could not run tests because the test plan is invalid:\n  {}\n'
+          .format('\n  '.join(problems)))
+    engine.close()
+    exit(EXITCODE_SETUP_ERROR)
+  summary_visitor = summary.SummaryVisitor(verbosity,
+                                           not args.suppress_failures,
+                                           debug=DEBUGME)
   try:
-    success = manager.accept(visitor)
+    if args.jobs > 1 or args.env_jobs > 1:
+      # Test cases finish out of order when run concurrently, so we print the
+      # summary once they have all run rather than as we go.
+      success = manager.accept(run_visitor, jobs=args.jobs,
+                               env_jobs=args.env_jobs)
+      manager.accept(summary_visitor)
+    else:
+      success = manager.accept(testplan.MultiVisitor(run_visitor,
+                                                     summary_visitor))
   except KeyboardInterrupt:
     print('\nkeyboard interrupt; aborting')
     exit(EXITCODE_USER_ABORT)
+  finally:
+    engine.close()
+    if result_cache:
+      result_cache.evict()
+    if parse_cache:
+      parse_cache.evict()
+
+  if timing_db:
+    manager.accept(timings.Recorder(timing_db))
+    try:
+      timing_db.save()
+    except Exception as e:
+      print("could not write timings to {}: {}".format(args.timings, e))
 
   if not quiet or (not success and not args.suppress_failures):
     print()
@@ -136,6 +203,13 @@ DEFAULT_LOG_LEVEL = "none"
 VERBOSITY_LEVELS = {"quiet": summary.Detail.NONE, "summary": summary.Detail.BRIEF, "detailed": summary.Detail.FULL}
 DEFAULT_VERBOSITY_LEVEL = "summary"
 
+SECONDS_PER_DAY = 24 * 60 * 60
+BYTES_PER_MB = 1024 * 1024
+DEFAULT_RESULT_CACHE_MAX_AGE_DAYS = 7
+DEFAULT_RESULT_CACHE_MAX_MB = 256
+DEFAULT_PARSE_CACHE_MAX_AGE_DAYS = 7
+DEFAULT_PARSE_CACHE_MAX_MB = 256
+
 def parse_cli():
   epilog = """CONFIGS consists of any number of the following, in any order:
 
@@ -213,8 +287,290 @@ def parse_cli():
             "additional test cases/suites/environments from running"),
       action="store_true")
 
+  parser.add_argument(
+      "-j",
+      "--jobs",
+      metavar="N",
+      type=positive_int,
+      help=("number of test cases to run concurrently within each " +
+            "environment (default: 1)"),
+      default=1)
+
+  parser.add_argument(
+      "--env-jobs",
+      metavar="N",
+      type=positive_int,
+      help=("number of environments to run concurrently, each with its " +
+            "own set-up and tear-down (default: 1)"),
+      default=1)
+
+  parser.add_argument(
+      "--engine",
+      help=('how to run the processes invoked by test cases (default: "{}")'
+            .format(execution.DEFAULT)),
+      choices=list(execution.ENGINES.keys()),
+      default=execution.DEFAULT)
+
+  parser.add_argument(
+      "--max-output-bytes",
+      metavar="BYTES",
+      type=positive_int,
+      help=("how much of the output of each call to keep in memory; the rest " +
+            "is spilled to a temporary file (default: no limit)"))
+
+  parser.add_argument(
+      "--python-workers",
+      metavar="N",
+      type=nonnegative_int,
+      help=("number of warm Python interpreters in which to run the samples " +
+            'tagged "sample_tester_execution: python-pool" in the manifest (default: 0, ' +
+            "which runs them via their invocation instead)"),
+      default=0)
+
+  parser.add_argument(
+      "--python-preload",
+      metavar="MODULE",
+      action="append",
+      help=("module for the warm Python interpreters (see " +
+            "--python-workers) to import before running any sample; may be " +
+            "repeated"),
+      default=[])
+
+  parser.add_argument(
+      "--call-timeout",
+      metavar="SECONDS",
+      type=positive_float,
+      help=("default number of seconds each call may run before it and " +
+            "its child processes are killed (default: no limit)"))
+
+  parser.add_argument(
+      "--case-timeout",
+      metavar="SECONDS",
+      type=positive_float,
+      help=("default number of seconds the set-up and test stages of each " +
+            "test case may take in total (default: no limit)"))
+
+  parser.add_argument(
+      "--timings",
+      metavar="FILE",
+      help=("file in which to record test case durations across runs; when " +
+            "running concurrently, the longest test cases are started first"))
+
+  parser.add_argument(
+      "--shard-count",
+      metavar="N",
+      type=positive_int,
+      help=("split the selected test cases into N shards, of which only the " +
+            "one given by --shard-index is run (default: 1)"),
+      default=1)
+
+  parser.add_argument(
+      "--shard-index",
+      metavar="I",
+      type=int,
+      help="the shard to run, from 0 to N-1 (default: 0)",
+      default=0)
+
+  parser.add_argument(
+      "--shard-timings",
+      metavar="FILE",
+      help=("balance the shards by the test case durations recorded in FILE " +
+            "(eg by --timings in an earlier run), which must be identical " +
+            "on every machine and is not updated by this run (default: " +
+            "balance by number of test cases)"))
+
+  parser.add_argument(
+      "--skip-dir",
+      metavar="NAME",
+      action="append",
+      help=("when searching directories for YAML configuration files, skip " +
+            "directories with this name; may be repeated (always skipped: " +
+            "hidden directories and {})"
+            .format(", ".join(sorted(inputs.DEFAULT_PRUNED_DIRECTORIES)))),
+      default=[])
+
+  parser.add_argument(
+      "--parse-jobs",
+      metavar="N",
+      type=positive_int,
+      help=("number of processes in which to parse the YAML configuration " +
+            "files concurrently (default: 1)"),
+      default=1)
+
+  parser.add_argument(
+      "--no-parse-cache",
+      help=("parse every input file, rather than reusing the cached " +
+            "parsed contents of files that are unchanged since the last run"),
+      action="store_true")
+
+  parser.add_argument(
+      "--parse-cache-max-age",
+      metavar="DAYS",
+      type=positive_float,
+      help=("discard cached parsed files unused for longer than this " +
+            "(default: {})".format(DEFAULT_PARSE_CACHE_MAX_AGE_DAYS)),
+      default=DEFAULT_PARSE_CACHE_MAX_AGE_DAYS)
+
+  parser.add_argument(
+      "--parse-cache-max-mb",
+      metavar="MB",
+      type=positive_float,
+      help=("discard the least recently used cached parsed files once the " +
+            "cache exceeds this size (default: {})"
+            .format(DEFAULT_PARSE_CACHE_MAX_MB)),
+      default=DEFAULT_PARSE_CACHE_MAX_MB)
+
+  parser.add_argument(
+      "--manifest-snapshot",
+      metavar="FILE",
+      help=("load the indexed sample manifests from FILE, as written by " +
+            "`sample-tester compile-manifest`, unless any of the manifest " +
+            "files changed since"))
+
+  parser.add_argument(
+      "--no-result-cache",
+      help=("run every selected test case, rather than replaying passing " +
+            "results for cases whose samples, manifest entries and test " +
+            "spec are unchanged since they last passed"),
+      action="store_true")
+
+  parser.add_argument(
+      "--result-cache-dir",
+      metavar="DIR",
+      help=('directory in which to cache passing results (default: "{}")'
+            .format(resultcache.default_directory())),
+      default=resultcache.default_directory())
+
+  parser.add_argument(
+      "--result-cache-max-age",
+      metavar="DAYS",
+      type=positive_float,
+      help=("discard cached results older than this (default: {})"
+            .format(DEFAULT_RESULT_CACHE_MAX_AGE_DAYS)),
+      default=DEFAULT_RESULT_CACHE_MAX_AGE_DAYS)
+
+  parser.add_argument(
+      "--result-cache-max-mb",
+      metavar="MB",
+      type=positive_float,
+      help=("discard the least recently used cached results once the cache " +
+            "exceeds this size (default: {})"
+            .format(DEFAULT_RESULT_CACHE_MAX_MB)),
+      default=DEFAULT_RESULT_CACHE_MAX_MB)
+
   parser.add_argument("files", metavar="CONFIGS", nargs=argparse.REMAINDER)
-  return parser.parse_args(), parser.format_usage()
+  args = parser.parse_args()
+  if not 0 <= args.shard_index < args.shard_count:
+    parser.error('--shard-index must be between 0 and {}'
+                 .format(args.shard_count - 1))
+  if (args.shard_timings and args.timings and
+      os.path.abspath(args.shard_timings) == os.path.abspath(args.timings)):
+    parser.error('--shard-timings must not be the --timings file, which each '
+                 'shard rewrites with only its own test cases')
+  return args, parser.format_usage()
+
+
+def merge_xunit(argv: List[str]) -> int:
+  """Runs the `merge-xunit` command with arguments `argv`.
+
+  Returns the exit code.
+  """
+  parser = argparse.ArgumentParser(
+      prog="sample-tester merge-xunit",
+      description=("Merges the xUnit files written by several runs (eg " +
+                   "different shards) into one"))
+  parser.add_argument(
+      "-o", "--output", metavar="FILE",
+      help="merged xunit output file (use `-` for stdout, the default)",
+      default="-")
+  parser.add_argument("inputs", metavar="XUNIT_FILE", nargs="+")
+  args = parser.parse_args(argv)
+
+  try:
+    documents = []
+    for path in args.inputs:
+      with open(path, 'r') as stream:
+        documents.append(stream.read())
+    merged = xunit.merge(*documents)
+    with smart_open(args.output) as output:
+      output.write(merged)
+  except Exception as e:
+    print(f'\nERROR: could not merge xUnit files because {e}\n')
+    if DEBUGME:
+      traceback.print_exc(file=sys.stdout)
+    return EXITCODE_FLAG_ERROR
+  return EXITCODE_SUCCESS
+
+
+def compile_manifest(argv: List[str]) -> int:
+  """Runs the `compile-manifest` command with arguments `argv`.
+
+  Returns the exit code.
+  """
+  parser = argparse.ArgumentParser(
+      prog="sample-tester compile-manifest",
+      description=("Indexes the sample manifests in CONFIGS and writes them " +
+                   "to a snapshot that `--manifest-snapshot` loads quickly"))
+  parser.add_argument(
+      "-o", "--output", metavar="FILE", required=True,
+      help="snapshot file to write")
+  parser.add_argument(
+      "-c", "--convention", metavar="CONVENTION:ARG,ARG,...",
+      help=('the convention the snapshot will be used with; must be "tag" ' +
+            '(default: "{}")'.format(convention.DEFAULT)),
+      default=convention.DEFAULT)
+  parser.add_argument(
+      "--skip-dir", metavar="NAME", action="append",
+      help=("when searching directories for YAML configuration files, skip " +
+            "directories with this name; may be repeated"),
+      default=[])
+  parser.add_argument("files", metavar="CONFIGS", nargs="*")
+  args = parser.parse_args(argv)
+
+  convention_name, convention_parameters, _ = (
+      environment_registry.parse_convention_spec(args.convention))
+  if convention_name != "tag" or not convention_parameters:
+    parser.error('--convention must be "tag" with at least one argument')
+
+  try:
+    indexed_docs = inputs.index_docs(
+        *args.files,
+        prune=inputs.DEFAULT_PRUNED_DIRECTORIES.union(args.skip_dir))
+    manifest = tag.compile_manifest(indexed_docs, convention_parameters,
+                                    args.output)
+  except Exception as e:
+    print(f'\nERROR: could not compile the manifests because {e}\n')
+    if DEBUGME:
+      traceback.print_exc(file=sys.stdout)
+    return EXITCODE_SETUP_ERROR
+  print('compiled {} manifest items into "{}"'.format(
+      len(list(manifest.get_all_elements())), args.output))
+  return EXITCODE_SUCCESS
+
+
+def positive_int(value: str) -> int:
+  """Parses `value` as an int greater than zero (for use by argparse)."""
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError(f'expected a positive integer, got {value}')
+  return number
+
+
+def nonnegative_int(value: str) -> int:
+  """Parses `value` as an int of at least zero (for use by argparse)."""
+  number = int(value)
+  if number < 0:
+    raise argparse.ArgumentTypeError(
+        f'expected a non-negative integer, got {value}')
+  return number
+
+
+def positive_float(value: str) -> float:
+  """Parses `value` as a float greater than zero (for use by argparse)."""
+  number = float(value)
+  if number <= 0:
+    raise argparse.ArgumentTypeError(f'expected a positive number, got {value}')
+  return number
 
 
 # from https://stackoverflow.com/a/17603000
@@ -232,5 +588,12 @@ def smart_open(filename: str=None):
       fh.close()
 
 
+# Commands other than running tests, selected by the first argument.
+COMMANDS = {
+    "compile-manifest": compile_manifest,
+    "merge-xunit": merge_xunit,
+}
+
+
 if __name__ == "__main__":
   main()
@@ -39,7 +39,8 @@ for convention in all_conventions:
     logging.info('registering convention "{}"'.format(convention))
     environment_creators[convention] = module.test_environments
 
-def generate_environments(requested_conventions, testcase_args, manifest_options, indexed_docs):
+def generate_environments(requested_conventions, testcase_args, manifest_options, indexed_docs,
+                          manifest_snapshot=None):
   """Generates the environments for the requested conventions with the given args.
 
   Note that a given convention may (and usually will) generate multiple
@@ -55,6 +56,8 @@ def generate_environments(requested_conventions, testcase_args, manifest_options
       convention. These are intended to address how the convention itself parses
       the manifest file.
     files: A list of files needed by the convention to instantiate environments.
+    manifest_snapshot: The path of a snapshot of the indexed manifests to use
+      instead of the manifest files, if still up to date.
   """
   all_environments = []
   for convention in requested_conventions:
@@ -62,7 +65,8 @@ def generate_environments(requested_conventions, testcase_args, manifest_options
     if create_fn is None:
       raise ValueError('convention "{}" not implemented'.format(convention))
     try:
-      all_environments.extend(create_fn(indexed_docs, testcase_args, manifest_options))
+      all_environments.extend(create_fn(indexed_docs, testcase_args, manifest_options,
+                                         manifest_snapshot=manifest_snapshot))
     except Exception as ex:
       raise ValueError( 'could not create test environments '
                         f'for convention "{convention}": {ex}')
@@ -17,7 +17,8 @@ from sampletester import parser
 
 def test_environments(indexed_docs: parser.IndexedDocs,
                       convention_parameters,
-                      _unused):
+                      _unused,
+                      manifest_snapshot: str = None):
   files = [doc.path for doc in indexed_docs.of_type(parser.SCHEMA_TYPE_ABSENT)]
   num_params = 0 if convention_parameters is None else len(convention_parameters)
   if num_params != 0:
@@ -12,8 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import glob
 import logging
+import re
+import shlex
 from typing import Iterable
 
 from sampletester import parser
@@ -46,6 +49,24 @@ PLACEHOLDER_CHAR = sample_manifest.RESERVED_SYMBOL_PREFIX
 # run time with the arguments to be passed to the artifact.
 PLACEHOLDER_ARGS = PLACEHOLDER_CHAR + 'args'
 
+# The value of TIMEOUT_KEY in the manifest, if specified, is the number of
+# seconds an invocation of the artifact may run before it is killed. It
+# overrides any call timeout given in the testplan or on the command line.
+TIMEOUT_KEY = 'timeout'
+
+# The value of EXECUTION_KEY in the manifest, if specified, selects how the
+# artifact is run; unknown values are ignored with a warning. (The key is
+# prefixed so as not to clash with tags manifests already use.) With EXECUTION_PYTHON_POOL, the artifact at PATH_KEY is a
+# Python script that may run in a warm interpreter instead of via its
+# invocation, if the test runner has a pool of them (see `--python-workers`).
+# The interpreter is the one that starts the invocation (or else BINARY_KEY),
+# which must therefore name a Python executable (see `python_interpreter`),
+# and the invocation may contain nothing but it, PATH_KEY and PLACEHOLDER_ARGS.
+# This is typically set on all the artifacts of an environment.
+EXECUTION_KEY = 'sample_tester_execution'
+EXECUTION_PYTHON_POOL = 'python-pool'
+EXECUTIONS = [EXECUTION_PYTHON_POOL]
+
 # (deprecated) The value of BINARY_KEY in the manifest denotes the program used
 # to invoke the artifact in question if INVOCATION_KEY is not specified
 BINARY_KEY = 'bin'
@@ -105,6 +126,12 @@ class ManifestEnvironment(testenv.Base):
     self.manifest_options = (manifest_options
                              if manifest_options is not None else {})
 
+    # The manifest is not re-indexed once environments are created, so we
+    # resolve each call target once: `_artifacts` maps the target to its
+    # (indices, artifact) and `_calls` maps it to its (invocation, chdir).
+    self._artifacts = {}
+    self._calls = {}
+
   def get_symbol(self, symbol):
     """Returns the artifact manifest tag specified in `symbol`.
 
@@ -135,13 +162,19 @@ class ManifestEnvironment(testenv.Base):
 
   def get_call(self, *args, **kwargs):
     full_call, cli_args = testenv.process_args(*args, **kwargs)
+    template, chdir = self.resolve_call(full_call)
+    return template.render({PLACEHOLDER_ARGS: cli_args}), chdir
 
-    indices = self.const_indices.copy()
-    indices.extend(full_call.split(' '))
-    artifact = self.manifest.get_one(*indices)
-    if not artifact:
-      raise Exception('object "{}" not defined'.format(indices))
+  def resolve_call(self, full_call):
+    """Returns the compiled invocation Template and chdir for `full_call`.
+
+    The result is memoized.
+    """
+    resolved = self._calls.get(full_call)
+    if resolved is not None:
+      return resolved
 
+    indices, artifact = self.get_artifact(full_call)
     invocation_key = self.manifest_options.get(INVOCATION_KEY,
                                                INVOCATION_KEY)
     invocation = artifact.get(invocation_key, None)
@@ -156,7 +189,43 @@ class ManifestEnvironment(testenv.Base):
 
     chdir_key = self.manifest_options.get(CHDIR_KEY, CHDIR_KEY)
     chdir = artifact.get(chdir_key, None)
-    return insert_into(invocation, (PLACEHOLDER_ARGS, cli_args)), chdir
+    resolved = self._calls[full_call] = (compile_invocation(invocation), chdir)
+    return resolved
+
+  def get_call_timeout(self, *args, **kwargs):
+    full_call, _ = testenv.process_args(*args, **kwargs)
+    indices, artifact = self.get_artifact(full_call)
+    try:
+      return parse_timeout(artifact.get(TIMEOUT_KEY, None))
+    except ValueError as e:
+      raise Exception('object "{}" has an invalid "{}": {}'
+                      .format(indices, TIMEOUT_KEY, e))
+
+  def get_call_script(self, *args, **kwargs):
+    full_call, cli_args = testenv.process_args(*args, **kwargs)
+    indices, artifact = self.get_artifact(full_call)
+    if artifact.get(EXECUTION_KEY, None) != EXECUTION_PYTHON_POOL:
+      return None
+    interpreter = python_interpreter(
+        artifact, self.manifest_options.get(INVOCATION_KEY, INVOCATION_KEY))
+    if not interpreter:
+      raise Exception('object "{}" does not name its Python interpreter: {}'
+                      .format(indices, artifact))
+    return interpreter, artifact.get(PATH_KEY), shlex.split(cli_args)
+
+  def get_artifact(self, full_call):
+    """Returns the manifest indices and the artifact for `full_call`, memoized."""
+    resolved = self._artifacts.get(full_call)
+    if resolved is not None:
+      return resolved
+
+    indices = self.const_indices.copy()
+    indices.extend(full_call.split(' '))
+    artifact = self.manifest.get_one(*indices)
+    if not artifact:
+      raise Exception('object "{}" not defined'.format(indices))
+    resolved = self._artifacts[full_call] = (indices, artifact)
+    return resolved
 
   def adjust_suite_name(self, name):
     return self.adjust_name(name)
@@ -174,27 +243,195 @@ def insert_into(host: str, *replacements): #  placeholder: str, guest: str):
   """Returns a copy of host with all the specified replacements applied.
 
   Each element of `replacements` is a pair of a `placeholder` string (which must
-  begin with PLACEHOLDER_CHAR) and a `subst` string to replace it. After
-  freezing escaped instances of PLACEHOLDER_CHAR in `host`, each `placeholder`
-  is then substituted by its `subst`. The previously frozen escaped instances of
-  PLACEHOLDER_CHAR are then substituted with a literal PLACEHOLDER_CHAR, and the
-  resulting string is then returned.
+  begin with PLACEHOLDER_CHAR) and a `subst` string to replace it. Escaped
+  instances of PLACEHOLDER_CHAR in `host` are replaced by a literal
+  PLACEHOLDER_CHAR, and each `placeholder` is substituted by its `subst`.
+
+  This compiles `host` on every call; use `compile_invocation` to render the
+  same host repeatedly.
+  """
+  template = Template(host, [placeholder for placeholder, _ in replacements])
+  return template.render(dict(replacements))
+
+
+class Template:
+  """A string with placeholders, compiled into literal chunks and slots.
+
+  A placeholder is one of the strings passed to the constructor, each of which
+  must begin with PLACEHOLDER_CHAR. Two consecutive PLACEHOLDER_CHARs denote a
+  literal PLACEHOLDER_CHAR. Any other PLACEHOLDER_CHAR is kept literally, and
+  the word following it is recorded in `unknown_placeholders`.
   """
-  escaped_token = '\x10'  # arbitrary non-printable char to mark escaped spots
-  escaped_inclusion = PLACEHOLDER_CHAR*2
-  escaped = host.replace(escaped_inclusion, escaped_token)
-  for placeholder, subst in replacements:
-    if placeholder[0] != PLACEHOLDER_CHAR:
-      raise InternalInvalidPlaceholderDefinition(
-          'placeholder "{}" does not begin with PLACEHOLDER_CHAR "{}"'
-          .format(placeholder, PLACEHOLDER_CHAR))
-    escaped = escaped.replace(placeholder, subst)
-  return escaped.replace(escaped_token, PLACEHOLDER_CHAR)
+
+  def __init__(self, host: str, placeholders: Iterable[str]):
+    placeholders = sorted(placeholders, key=len, reverse=True)
+    for placeholder in placeholders:
+      if placeholder[0] != PLACEHOLDER_CHAR:
+        raise InternalInvalidPlaceholderDefinition(
+            'placeholder "{}" does not begin with PLACEHOLDER_CHAR "{}"'
+            .format(placeholder, PLACEHOLDER_CHAR))
+
+    # The rendered string is `''.join(self.parts)` after filling each slot
+    # `self.parts[position]` with the value for its placeholder.
+    self.parts = []
+    self.slots = []
+    self.unknown_placeholders = []
+
+    literal = []
+    start = 0
+    while True:
+      found = host.find(PLACEHOLDER_CHAR, start)
+      if found < 0:
+        literal.append(host[start:])
+        break
+      literal.append(host[start:found])
+      if host.startswith(_ESCAPED_PLACEHOLDER_CHAR, found):
+        literal.append(PLACEHOLDER_CHAR)
+        start = found + len(_ESCAPED_PLACEHOLDER_CHAR)
+        continue
+
+      placeholder = next((placeholder for placeholder in placeholders
+                          if host.startswith(placeholder, found)), None)
+      if placeholder is None:
+        self.unknown_placeholders.append(
+            _placeholder_re.match(host, found).group(0))
+        literal.append(PLACEHOLDER_CHAR)
+        start = found + len(PLACEHOLDER_CHAR)
+        continue
+
+      self.parts.append(''.join(literal))
+      literal = []
+      self.slots.append((len(self.parts), placeholder))
+      self.parts.append('')
+      start = found + len(placeholder)
+    self.parts.append(''.join(literal))
+
+  def render(self, values) -> str:
+    """Returns the string with each placeholder replaced by `values[placeholder]`."""
+    parts = self.parts.copy()
+    for position, placeholder in self.slots:
+      parts[position] = values[placeholder]
+    return ''.join(parts)
+
+
+_ESCAPED_PLACEHOLDER_CHAR = PLACEHOLDER_CHAR * 2
+_placeholder_re = re.compile(re.escape(PLACEHOLDER_CHAR) + r'\w*')
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_invocation(invocation: str) -> Template:
+  return Template(invocation, [PLACEHOLDER_ARGS])
+
+
+def compile_invocation(invocation: str) -> Template:
+  """Returns the Template for an INVOCATION_KEY value, compiling it only once."""
+  if not isinstance(invocation, str):
+    raise sample_manifest.ManifestSyntaxError(
+        'invocation must be a string: {}'.format(invocation))
+  return _compile_invocation(invocation)
+
+
+_python_interpreter_re = re.compile(r'(^|/)python[0-9.]*(\.exe)?$')
+
+
+def python_interpreter(artifact, invocation_key: str):
+  """Returns the Python interpreter that runs `artifact`, or None if unknown.
+
+  This is the first word of the artifact's invocation or, if it has none, of
+  its BINARY_KEY, provided that word names a Python executable (eg
+  `python3` or `/path/to/venv/bin/python`).
+  """
+  command = artifact.get(invocation_key, None) or artifact.get(BINARY_KEY, None)
+  if not isinstance(command, str):
+    return None
+  try:
+    words = shlex.split(command)
+  except ValueError:
+    return None
+  if not words or not _python_interpreter_re.search(words[0]):
+    return None
+  return words[0]
+
+
+def parse_timeout(timeout):
+  """Returns a TIMEOUT_KEY value in seconds, or None if it is None.
+
+  Raises ValueError unless `timeout` is a positive number, or a string of one.
+  """
+  if timeout is None:
+    return None
+  try:
+    seconds = float(timeout)
+  except (TypeError, ValueError):
+    seconds = None
+  if isinstance(timeout, bool) or seconds is None or not seconds > 0:
+    raise ValueError('expected a positive number of seconds, got {!r}'
+                     .format(timeout))
+  return seconds
+
+
+def check_invocations(manifest: sample_manifest.Manifest, invocation_key: str):
+  """Compiles the invocation of every artifact in `manifest`.
+
+  This reports malformed invocations (as well as TIMEOUT_KEY and EXECUTION_KEY
+  values) when the manifest is loaded rather than when the affected artifacts
+  are called.
+  """
+  for artifact in manifest.get_all_elements():
+    try:
+      parse_timeout(artifact.get(TIMEOUT_KEY, None))
+    except ValueError as e:
+      raise sample_manifest.ManifestSyntaxError(
+          'invalid "{}" in artifact {}: {}'.format(TIMEOUT_KEY, artifact, e))
+    execution = artifact.get(EXECUTION_KEY, None)
+    if execution is not None and execution not in EXECUTIONS:
+      logging.warning(
+          'ignoring unknown "{}" value "{}" (expected one of {}) in '
+          'artifact {}'.format(EXECUTION_KEY, execution, EXECUTIONS, artifact))
+    if execution == EXECUTION_PYTHON_POOL:
+      if not artifact.get(PATH_KEY, None):
+        raise sample_manifest.ManifestSyntaxError(
+            '"{}: {}" requires "{}" in artifact {}'
+            .format(EXECUTION_KEY, execution, PATH_KEY, artifact))
+      interpreter = python_interpreter(artifact, invocation_key)
+      if not interpreter:
+        raise sample_manifest.ManifestSyntaxError(
+            '"{}: {}" requires "{}" or "{}" to start with a Python '
+            'interpreter in artifact {}'
+            .format(EXECUTION_KEY, execution, invocation_key, BINARY_KEY,
+                    artifact))
+      # A pooled call passes the script only the call's arguments, so anything
+      # else in the invocation would be dropped.
+      path = artifact[PATH_KEY]
+      command = (artifact.get(invocation_key, None) or
+                 '{} {} {}'.format(artifact.get(BINARY_KEY), path,
+                                   PLACEHOLDER_ARGS))
+      if shlex.split(command) != [interpreter, path, PLACEHOLDER_ARGS]:
+        raise sample_manifest.ManifestSyntaxError(
+            '"{}: {}" requires the invocation to be exactly "{} {} {}" in '
+            'artifact {}'.format(EXECUTION_KEY, execution, interpreter,
+                                 shlex.quote(path), PLACEHOLDER_ARGS, artifact))
+
+    invocation = artifact.get(invocation_key, None)
+    if not invocation:
+      continue
+    try:
+      template = compile_invocation(invocation)
+    except sample_manifest.ManifestSyntaxError as e:
+      raise sample_manifest.ManifestSyntaxError(
+          '{} in artifact {}'.format(e, artifact))
+    if template.unknown_placeholders:
+      logging.warning(
+          'unknown placeholders {} in "{}" will be used literally (escape '
+          '"{}" as "{}" to avoid this warning)'.format(
+              template.unknown_placeholders, invocation, PLACEHOLDER_CHAR,
+              _ESCAPED_PLACEHOLDER_CHAR))
 
 
 def test_environments(indexed_docs: parser.IndexedDocs,
                       convention_parameters,
-                      manifest_options):
+                      manifest_options,
+                      manifest_snapshot: str = None):
   if convention_parameters is None:
     convention_parameters = []
   num_params = len(convention_parameters)
@@ -202,9 +439,8 @@ def test_environments(indexed_docs: parser.IndexedDocs,
     raise Exception('expected at least 1 parameter to convention "tag", got %d: %s'
                     .format(num_params, convention_parameters))
 
-  manifest = sample_manifest.Manifest(ENVIRONMENT_KEY, *convention_parameters) # read only, so don't need a copy
-  manifest.from_docs(indexed_docs)
-  manifest.index()
+  manifest = build_manifest(indexed_docs, convention_parameters,
+                            manifest_snapshot)
   logging.debug('manifest >>> \n{}\n<<<\n'.format(manifest.string()))
 
 
@@ -218,6 +454,7 @@ def test_environments(indexed_docs: parser.IndexedDocs,
   num_options = len(manifest_options) if manifest_options else 0
   manifest_options_dict[INVOCATION_KEY] = manifest_options[0] if num_options > 0 else INVOCATION_KEY
   manifest_options_dict[CHDIR_KEY] = manifest_options[1] if num_options > 1 else CHDIR_KEY
+  check_invocations(manifest, manifest_options_dict[INVOCATION_KEY])
 
   environments = []
   for name in env_names:
@@ -231,5 +468,36 @@ def test_environments(indexed_docs: parser.IndexedDocs,
   return environments
 
 
+def build_manifest(indexed_docs: parser.IndexedDocs, convention_parameters,
+                   snapshot_path: str = None) -> sample_manifest.Manifest:
+  """Returns the manifests in `indexed_docs`, indexed for this convention.
+
+  If `snapshot_path` names a snapshot written by `compile_manifest` from the
+  same, unchanged manifest files, the indexed manifest is loaded from there
+  instead of being built from the manifest files.
+  """
+  manifest = sample_manifest.Manifest(ENVIRONMENT_KEY, *convention_parameters) # read only, so don't need a copy
+  if snapshot_path and manifest.read_snapshot(
+      snapshot_path,
+      indexed_docs.paths_of_type(sample_manifest.SCHEMA.primary_type)):
+    return manifest
+  manifest.from_docs(indexed_docs)
+  manifest.index()
+  return manifest
+
+
+def compile_manifest(indexed_docs: parser.IndexedDocs, convention_parameters,
+                     snapshot_path: str) -> sample_manifest.Manifest:
+  """Indexes the manifests in `indexed_docs` and snapshots them to a file.
+
+  The snapshot at `snapshot_path` can then be passed to `test_environments`.
+  """
+  manifest = build_manifest(indexed_docs, convention_parameters)
+  manifest.write_snapshot(
+      snapshot_path,
+      indexed_docs.paths_of_type(sample_manifest.SCHEMA.primary_type))
+  return manifest
+
+
 class InternalInvalidPlaceholderDefinition(Exception):
   pass
@@ -21,7 +21,8 @@ from sampletester import convention
 from sampletester import parser
 
 def new(convention_spec: str,
-        indexed_docs: parser.IndexedDocs = None):
+        indexed_docs: parser.IndexedDocs = None,
+        manifest_snapshot: str = None):
   """Returns a new registry based on the `convention_spec` and `user_paths`.
 
   The registry contains all the environments generated by the named convention
@@ -31,17 +32,24 @@ def new(convention_spec: str,
   "NAME:PLAN_ARG,PLAN_ARG,...:MANIFEST_ARG,MANIFEST_ARG,....". The arrays of
   *_ARGs is passed to the NAMEd convention upon initialization.
   """
-  parts = convention_spec.split(":", 2)
-  convention_name = parts[0]
-  testcase_args = parts[1].split(",") if len(parts) > 1 else None
-  manifest_options = parts[2].split(",") if len(parts) > 2 else None
+  convention_name, testcase_args, manifest_options = parse_convention_spec(
+      convention_spec)
 
   registry = Registry()
   registry.add(*convention.generate_environments([convention_name],
                                                  testcase_args, manifest_options,
-                                                 indexed_docs))
+                                                 indexed_docs,
+                                                 manifest_snapshot))
   return registry
 
+def parse_convention_spec(convention_spec: str):
+  """Returns the name, PLAN_ARGs and MANIFEST_ARGs in `convention_spec`."""
+  parts = convention_spec.split(":", 2)
+  convention_name = parts[0]
+  testcase_args = parts[1].split(",") if len(parts) > 1 else None
+  manifest_options = parts[2].split(",") if len(parts) > 2 else None
+  return convention_name, testcase_args, manifest_options
+
 class Registry:
   """Stores the registered test execution environments."""
 
@@ -0,0 +1,495 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import codecs
+import json
+import logging
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Tuple
+
+# The size of the reads from the output streams of child processes.
+CHUNK_SIZE = 64 * 1024
+
+
+class Capture:
+  """Accumulates the output of a process, bounding how much is kept in memory.
+
+  The first `max_bytes` bytes of output are kept in memory; anything beyond
+  that is spilled to an anonymous temporary file, which is removed by
+  `close()`. If `max_bytes` is None, all output is kept in memory.
+  """
+
+  def __init__(self, max_bytes: int = None):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self._chunks = []
+    self._in_memory = 0
+    self._spill = None
+
+  def write(self, data: bytes):
+    """Appends `data` to the captured output."""
+    self.size += len(data)
+    if self._spill is None:
+      room = (len(data) if self.max_bytes is None
+              else self.max_bytes - self._in_memory)
+      if room >= len(data):
+        self._chunks.append(data)
+        self._in_memory += len(data)
+        return
+      if room > 0:
+        self._chunks.append(data[:room])
+        self._in_memory += room
+        data = data[room:]
+      self._spill = tempfile.TemporaryFile(prefix='sampletester-')
+    self._spill.write(data)
+
+  def spilled(self) -> bool:
+    """Returns whether some of the output is not held in memory."""
+    return self._spill is not None
+
+  def head(self) -> bytes:
+    """Returns the part of the output held in memory."""
+    if len(self._chunks) > 1:
+      self._chunks = [b''.join(self._chunks)]
+    return self._chunks[0] if self._chunks else b''
+
+  def head_text(self) -> str:
+    """Returns the part of the output held in memory, decoded.
+
+    If the output was spilled, any character split at the spill boundary is
+    dropped.
+    """
+    if not self.spilled():
+      return self.head().decode('utf-8')
+    return codecs.getincrementaldecoder('utf-8')().decode(self.head())
+
+  def getvalue(self) -> bytes:
+    """Returns the entire output, reading back any spilled part."""
+    return b''.join(self.read_chunks())
+
+  def read_chunks(self) -> Iterator[bytes]:
+    """Yields the entire output in chunks, without loading it all at once."""
+    yield self.head()
+    if not self._spill:
+      return
+    self._spill.flush()
+    self._spill.seek(0)
+    for chunk in iter(lambda: self._spill.read(CHUNK_SIZE), b''):
+      yield chunk
+    self._spill.seek(0, 2)  # back to the end, in case of further writes
+
+  def text_chunks(self) -> Iterator[str]:
+    """Yields the entire output in decoded chunks."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in self.read_chunks():
+      text = decoder.decode(chunk)
+      if text:
+        yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+      yield text
+
+  def close(self):
+    """Removes any spilled output."""
+    if self._spill is not None:
+      self._spill.close()
+
+
+class Engine:
+  """Runs the external commands issued by test cases.
+
+  Engines may be shared by test cases running concurrently in different
+  threads, so `run()` must be thread-safe.
+
+  The output of each command is read incrementally into a `Capture` that keeps
+  at most `max_output_bytes` in memory (or everything, if that is None).
+
+  If the engine has a `python_pool`, the calls that environments allow to run
+  in a warm Python interpreter (see `run_python()`) are run there.
+  """
+
+  def __init__(self, max_output_bytes: int = None,
+               python_pool: 'PythonPool' = None):
+    self.max_output_bytes = max_output_bytes
+    self.python_pool = python_pool
+
+  def run(self, cmd: str, cwd: str = None,
+          timeout: float = None) -> Tuple[int, Capture]:
+    """Runs `cmd` in a shell from directory `cwd`.
+
+    Returns a pair consisting of the return code and the `Capture` of the
+    combined stdout and stderr of the command. The caller is responsible for
+    closing the `Capture`.
+
+    If `timeout` is not None and the command has not completed after that many
+    seconds, its entire process group is killed and `TimeoutExpired` is
+    raised. Commands with a timeout are started in a new session so that they
+    can be killed along with any processes they spawned.
+    """
+    raise NotImplementedError('run() invoked on Engine (should be overridden)')
+
+  def run_python(self, cmd: str, interpreter: str, script: str,
+                 argv: List[str], cwd: str = None,
+                 timeout: float = None) -> Tuple[int, Capture]:
+    """Runs the Python `script` with arguments `argv` from directory `cwd`.
+
+    If this engine has a `python_pool`, the script runs in one of its warm
+    instances of `interpreter`. Otherwise, `cmd`, the shell command equivalent
+    to the script call, is run as by `run()`.
+    """
+    if self.python_pool is None:
+      return self.run(cmd, cwd, timeout)
+    return self.python_pool.run(interpreter, script, argv, cwd, timeout,
+                                self.max_output_bytes)
+
+  def close(self):
+    """Releases any resources held by this engine."""
+    if self.python_pool is not None:
+      self.python_pool.close()
+
+
+class SubprocessEngine(Engine):
+  """Runs each command via a blocking call in the calling thread."""
+
+  def run(self, cmd: str, cwd: str = None,
+          timeout: float = None) -> Tuple[int, Capture]:
+    capture = Capture(self.max_output_bytes)
+    timed_out = threading.Event()
+    # Guards `done`, which is set once the output has been read to the end and
+    # the shell has exited. Until then, the process group is killed when the
+    # timeout expires, even if the shell itself has already exited: a process
+    # it left running in the background may still hold its stdout open.
+    lock = threading.Lock()
+    done = False
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT, shell=True,
+                          cwd=cwd,
+                          start_new_session=timeout is not None) as process:
+      timer = None
+      if timeout is not None:
+        def expire():
+          with lock:
+            if not done:
+              timed_out.set()
+              kill_process_group(process.pid)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+      try:
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+          capture.write(chunk)
+        return_code = process.wait()
+        with lock:
+          done = True
+      finally:
+        if timer:
+          timer.cancel()
+    if timed_out.is_set():
+      raise TimeoutExpired(cmd, timeout, capture)
+    return return_code, capture
+
+
+class AsyncioEngine(Engine):
+  """Runs all commands on a single asyncio event loop.
+
+  The event loop runs in a background thread, so the I/O of all the child
+  processes in flight is multiplexed on that one thread. `run()` may be called
+  from any thread; it blocks the caller until its command completes, so this
+  does not reduce the number of threads needed to run test cases concurrently.
+  """
+
+  def __init__(self, max_output_bytes: int = None,
+               python_pool: 'PythonPool' = None):
+    super().__init__(max_output_bytes, python_pool)
+    self.loop = asyncio.new_event_loop()
+    if sys.version_info < (3, 8):
+      # Before Python 3.8, the child watcher needs to be attached to the loop
+      # we spawn processes from. This must happen in the main thread.
+      asyncio.get_child_watcher().attach_loop(self.loop)
+    self.thread = threading.Thread(target=self.loop.run_forever,
+                                   name='sampletester-engine', daemon=True)
+    self.thread.start()
+
+  def run(self, cmd: str, cwd: str = None,
+          timeout: float = None) -> Tuple[int, Capture]:
+    future = asyncio.run_coroutine_threadsafe(self._run(cmd, cwd, timeout),
+                                              self.loop)
+    return future.result()
+
+  async def _run(self, cmd: str, cwd: str, timeout: float):
+    process = await asyncio.create_subprocess_shell(
+        cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+        cwd=cwd, start_new_session=timeout is not None)
+    capture = Capture(self.max_output_bytes)
+    try:
+      return_code = await asyncio.wait_for(self._read(process, capture),
+                                           timeout)
+    except asyncio.TimeoutError:
+      kill_process_group(process.pid)
+      await process.wait()
+      raise TimeoutExpired(cmd, timeout, capture)
+    return return_code, capture
+
+  async def _read(self, process, capture: Capture):
+    while True:
+      chunk = await process.stdout.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      capture.write(chunk)
+    return await process.wait()
+
+  def close(self):
+    super().close()
+    if self.loop.is_closed():
+      return
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.loop.close()
+
+
+class PythonPool:
+  """Runs Python scripts in warm interpreters.
+
+  Each of up to `size` worker processes (see `pyworker.py`) starts a Python
+  interpreter and imports the `preload` modules just once, and then forks a
+  fresh child for each script it runs. Scripts thus skip the interpreter
+  start-up and those imports, yet don't see any state left behind by other
+  scripts. Workers are started as they are first needed, for the interpreter
+  each script asks for, and `run()` may be called from any thread.
+  """
+
+  def __init__(self, size: int, preload: Iterable[str] = ()):
+    self.size = size
+    self.preload = list(preload)
+
+    # Guards the fields below, and is notified whenever a worker becomes idle
+    # or a slot for a new worker frees up.
+    self._condition = threading.Condition()
+    self._idle = []
+    self._workers = []
+    self._num_workers = 0  # including the ones still starting
+
+  def run(self, interpreter: str, script: str, argv: List[str],
+          cwd: str = None, timeout: float = None,
+          max_output_bytes: int = None) -> Tuple[int, Capture]:
+    """Runs `script` with arguments `argv` from `cwd` in a warm `interpreter`.
+
+    Returns and raises as `Engine.run()`.
+    """
+    worker = self._acquire(interpreter)
+    try:
+      result = worker.run(script, argv, cwd, timeout, max_output_bytes)
+    except TimeoutExpired:
+      self._release(worker)
+      raise
+    except BaseException:
+      # The worker may be in an unknown state.
+      self._discard(worker)
+      raise
+    self._release(worker)
+    return result
+
+  def _acquire(self, interpreter: str) -> '_PythonWorker':
+    retired = None
+    with self._condition:
+      while True:
+        for worker in self._idle:
+          if worker.interpreter == interpreter:
+            self._idle.remove(worker)
+            return worker
+        if self._num_workers < self.size:
+          break
+        if self._idle:
+          # Make room by stopping a worker idling for another interpreter.
+          retired = self._idle.pop(0)
+          self._workers.remove(retired)
+          break
+        self._condition.wait()
+      if not retired:
+        self._num_workers += 1
+    if retired:
+      retired.close()
+
+    try:
+      worker = _PythonWorker(interpreter, self.preload)
+    except BaseException:
+      with self._condition:
+        self._num_workers -= 1
+        self._condition.notify()
+      raise
+    with self._condition:
+      self._workers.append(worker)
+    return worker
+
+  def _release(self, worker: '_PythonWorker'):
+    with self._condition:
+      self._idle.append(worker)
+      self._condition.notify()
+
+  def _discard(self, worker: '_PythonWorker'):
+    with self._condition:
+      self._workers.remove(worker)
+      self._num_workers -= 1
+      self._condition.notify()
+    worker.kill()
+
+  def close(self):
+    """Stops all the workers."""
+    with self._condition:
+      workers, self._workers = self._workers, []
+      self._num_workers -= len(workers)
+      self._idle = []
+    for worker in workers:
+      worker.close()
+
+
+class _PythonWorker:
+  """A single worker process of a `PythonPool`, running one script at a time."""
+
+  SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'pyworker.py')
+
+  def __init__(self, interpreter: str, preload: List[str]):
+    self.interpreter = interpreter
+    try:
+      self.process = subprocess.Popen([interpreter, self.SCRIPT] + preload,
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE)
+    except OSError as e:
+      raise PythonPoolError('could not start Python worker "{}": {}'
+                            .format(interpreter, e))
+    reply = self._receive()
+    if 'ready' not in reply:
+      self.close()
+      raise PythonPoolError('could not start Python worker: {}'
+                            .format(reply.get('error', reply)))
+    logging.debug('started Python worker {}'.format(self.process.pid))
+
+  def run(self, script: str, argv: List[str], cwd: str, timeout: float,
+          max_output_bytes: int) -> Tuple[int, Capture]:
+    fd, output_path = tempfile.mkstemp(prefix='sampletester-')
+    os.close(fd)
+    try:
+      self._send({'script': script, 'argv': argv, 'cwd': cwd,
+                  'output': output_path})
+      pid = self._receive()['started']
+      timed_out = threading.Event()
+      timer = None
+      if timeout is not None:
+        def expire():
+          timed_out.set()
+          kill_process_group(pid)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+      try:
+        return_code = self._receive()['exit']
+      finally:
+        if timer:
+          timer.cancel()
+
+      capture = Capture(max_output_bytes)
+      with open(output_path, 'rb') as output:
+        for chunk in iter(lambda: output.read(CHUNK_SIZE), b''):
+          capture.write(chunk)
+    finally:
+      os.remove(output_path)
+    if timed_out.is_set():
+      raise TimeoutExpired(' '.join(shlex.quote(part)
+                                    for part in [script] + argv),
+                           timeout, capture)
+    return return_code, capture
+
+  def _send(self, message):
+    try:
+      self.process.stdin.write((json.dumps(message) + '\n').encode('utf-8'))
+      self.process.stdin.flush()
+    except OSError as e:
+      raise PythonPoolError('could not send to Python worker: {}'.format(e))
+
+  def _receive(self):
+    line = self.process.stdout.readline()
+    if not line:
+      raise PythonPoolError('Python worker {} exited unexpectedly'
+                            .format(self.process.pid))
+    return json.loads(line.decode('utf-8'))
+
+  def close(self):
+    """Stops the worker once it finishes any script it is running."""
+    try:
+      self.process.stdin.close()
+    except OSError:
+      pass
+    self.process.wait()
+    self.process.stdout.close()
+
+  def kill(self):
+    """Stops the worker right away."""
+    self.process.kill()
+    self.close()
+
+
+def kill_process_group(pid: int):
+  """Kills the process group led by `pid`, ignoring it if already gone."""
+  try:
+    os.killpg(pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+
+
+class PythonPoolError(Exception):
+  """Raised when a `PythonPool` worker fails to start or stops unexpectedly."""
+  pass
+
+
+class TimeoutExpired(Exception):
+  """Raised when a command does not complete within its timeout.
+
+  `capture` holds whatever output the command produced before it was killed.
+  """
+
+  def __init__(self, cmd: str, timeout: float, capture: Capture):
+    super().__init__('command timed out after {} seconds: {}'
+                     .format(timeout, cmd))
+    self.cmd = cmd
+    self.timeout = timeout
+    self.capture = capture
+
+
+ENGINES = {
+    'subprocess': SubprocessEngine,
+    'asyncio': AsyncioEngine,
+}
+DEFAULT = 'subprocess'
+
+
+def new(name: str = DEFAULT, max_output_bytes: int = None,
+        python_pool: PythonPool = None) -> Engine:
+  """Returns a new instance of the engine registered as `name`."""
+  engine_class = ENGINES.get(name, None)
+  if engine_class is None:
+    raise ValueError('engine "{}" not implemented'.format(name))
+  logging.debug('using execution engine "{}"'.format(name))
+  return engine_class(max_output_bytes, python_pool)
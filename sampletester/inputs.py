@@ -17,6 +17,7 @@ import itertools
 import logging
 import os
 from functools import reduce
+from typing import Iterable
 from typing import Set
 
 from sampletester import parser
@@ -24,6 +25,15 @@ from sampletester.parser import SCHEMA_TYPE_ABSENT as UNKNOWN_TYPE
 from sampletester.sample_manifest import SCHEMA as MANIFEST_SCHEMA
 from sampletester.testplan import SCHEMA as TESTPLAN_SCHEMA
 
+# Directories that are never searched for YAML files, in addition to hidden
+# ones. These hold dependencies or build outputs rather than test inputs.
+DEFAULT_PRUNED_DIRECTORIES = frozenset({
+    '__pycache__',
+    'node_modules',
+    'site-packages',
+    'venv',
+})
+
 
 def untyped_yaml_resolver(unknown_doc: parser.Document) -> str :
   """Determines how `parser.IndexedDocs` should classify `unknown_doc`
@@ -45,7 +55,11 @@ def untyped_yaml_resolver(unknown_doc: parser.Document) -> str :
   return UNKNOWN_TYPE
 
 
-def index_docs(*file_patterns: str) -> parser.IndexedDocs:
+def index_docs(*file_patterns: str,
+               parse_cache: parser.ParseCache = None,
+               jobs: int = 1,
+               prune: Iterable[str] = DEFAULT_PRUNED_DIRECTORIES
+               ) -> parser.IndexedDocs:
   """Obtains manifests and testplans by indexing the specified paths or cwd.
 
   This function works in the following sequence:
@@ -64,27 +78,39 @@ def index_docs(*file_patterns: str) -> parser.IndexedDocs:
         other words, if no manifests are found via the globs in `file_patterns`,
         it attempts to get manifests under the cwd, and similarly for testplans.
 
+  Directories are searched via `find_yaml_files`, skipping those named in
+  `prune`, and each file is parsed at most once.
+
+  If `parse_cache` is set, files that have not changed since they were last
+  parsed are loaded from it rather than parsed again. The files are parsed in up
+  to `jobs` processes concurrently.
+
   Returns: the indexed docs of the files that were searched for.
   """
   def log_files(indexed_files):
     "Helper to be called before exiting this method"
-    manifest_paths = [doc.path for doc in indexed_files.of_type(MANIFEST_SCHEMA.primary_type)]
-    testplan_paths = [doc.path for doc in indexed_files.of_type(TESTPLAN_SCHEMA.primary_type)]
+    # Only the paths are needed, so don't force lazily indexed files to be
+    # parsed (eg manifests, which may be loaded from a snapshot instead).
+    manifest_paths = sorted(
+        indexed_files.paths_of_type(MANIFEST_SCHEMA.primary_type))
+    testplan_paths = sorted(
+        indexed_files.paths_of_type(TESTPLAN_SCHEMA.primary_type))
     logging.info('manifest files:\n  {}'.format('\n  '.join(manifest_paths)))
     logging.info('testplan files:\n  {}'.format('\n  '.join(testplan_paths)))
     return indexed_files
 
-  if not file_patterns:
-    file_patterns = ['**/*.yaml']
-
-  explicit_paths = get_globbed(*file_patterns)
-  explicit_directories = {path for path in explicit_paths
-                          if os.path.isdir(path)}
-  files_in_directories = get_globbed(*{f'{path}/**/*.yaml'
-                                       for path in explicit_directories})
-  explicit_paths |= files_in_directories
-
-  indexed_explicit = create_indexed_docs(*explicit_paths)
+  if file_patterns:
+    explicit_paths = get_globbed(*file_patterns)
+    explicit_directories = {path for path in explicit_paths
+                            if os.path.isdir(path)}
+    files_in_directories = find_yaml_files(*explicit_directories, prune=prune)
+    explicit_paths |= files_in_directories
+  else:
+    explicit_paths = find_yaml_files('', prune=prune)
+    files_in_directories = set()
+
+  indexed_explicit = create_indexed_docs(*explicit_paths,
+                                         parse_cache=parse_cache, jobs=jobs)
   has_manifests = indexed_explicit.contains(MANIFEST_SCHEMA.primary_type)
   has_testplans = indexed_explicit.contains(TESTPLAN_SCHEMA.primary_type)
 
@@ -92,14 +118,20 @@ def index_docs(*file_patterns: str) -> parser.IndexedDocs:
     # We have successfully found needed inputs already.
     return log_files(indexed_explicit)
 
-  if files_in_directories:
+  if files_in_directories or not file_patterns:
     # Because directories were specified, we use this as a signal to *not*
     # recurse into the cwd. The caller of this method is responsible for
-    # reporting that one or both of the needed file types is missing.
+    # reporting that one or both of the needed file types is missing. If no
+    # patterns were specified, we have already searched the cwd.
     return log_files(indexed_explicit)
 
-  implicit_files = get_globbed('**/*.yaml')
-  indexed_implicit = create_indexed_docs(*implicit_files)
+  # The files we already indexed contain none of the missing types, so there is
+  # no need to parse them again.
+  indexed_paths = {os.path.abspath(path) for path in explicit_paths}
+  implicit_files = {path for path in find_yaml_files('', prune=prune)
+                    if os.path.abspath(path) not in indexed_paths}
+  indexed_implicit = create_indexed_docs(*implicit_files,
+                                         parse_cache=parse_cache, jobs=jobs)
   if not has_testplans:
     indexed_explicit.add_documents(*indexed_implicit.of_type(TESTPLAN_SCHEMA.primary_type))
   if not has_manifests:
@@ -107,16 +139,60 @@ def index_docs(*file_patterns: str) -> parser.IndexedDocs:
 
   return log_files(indexed_explicit)
 
-def create_indexed_docs(*all_paths: Set[str]) -> parser.IndexedDocs:
+def create_indexed_docs(*all_paths: Set[str],
+                        parse_cache: parser.ParseCache = None,
+                        jobs: int = 1) -> parser.IndexedDocs:
   """Returns a parser.IndexedDocs that contains all documents in `all_paths`.
 
   This is a helper for `indexed_docs()`, and is also used heavily in tests.
   """
-  indexed_docs = parser.IndexedDocs(resolver=untyped_yaml_resolver)
-  indexed_docs.from_files(*all_paths)
+  indexed_docs = parser.IndexedDocs(resolver=untyped_yaml_resolver,
+                                    parse_cache=parse_cache, lazy=True)
+  indexed_docs.from_files(*all_paths, jobs=jobs)
   return indexed_docs
 
 
+def find_yaml_files(*directories: str,
+                    prune: Iterable[str] = DEFAULT_PRUNED_DIRECTORIES
+                    ) -> Set[str]:
+  """Returns the paths of all the YAML files under `directories`, recursively.
+
+  Like globbing `**/*.yaml`, this skips hidden files and directories. It also
+  skips directories whose names are in `prune`. An empty string in
+  `directories` denotes the cwd, and the paths under it are returned relative to
+  it.
+  """
+  prune = set(prune)
+  found = set()
+  visited = set()
+  pending = list(directories)
+  while pending:
+    directory = pending.pop()
+    real_directory = os.path.realpath(directory or '.')
+    if real_directory in visited:
+      continue  # reached again via a symbolic link
+    visited.add(real_directory)
+    try:
+      entries = os.scandir(directory or '.')
+    except OSError as e:
+      logging.info(f'skipping unreadable directory "{directory}": {e}')
+      continue
+    with entries:
+      for entry in entries:
+        if entry.name.startswith('.'):
+          continue
+        path = os.path.join(directory, entry.name) if directory else entry.name
+        try:
+          if entry.is_dir():
+            if entry.name not in prune:
+              pending.append(path)
+          elif entry.name.endswith('.yaml') and entry.is_file():
+            found.add(path)
+        except OSError:
+          continue
+  return found
+
+
 def get_globbed(*file_patterns: str) -> Set[str]:
   """Returns the set of files returned from globbing `file_patterns`"""
   return {filename
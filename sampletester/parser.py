@@ -13,8 +13,14 @@
 # limitations under the License.
 
 import collections
+import concurrent.futures
+import functools
+import hashlib
 import logging
 import os
+import pickle
+import tempfile
+import time
 import yaml
 
 from dataclasses import dataclass
@@ -33,6 +39,13 @@ SCHEMA_VERSION_KEY = 'schema_version'
 
 Document = collections.namedtuple('Document', ['path', 'obj'])
 
+# The YAML loader used to parse all files: libyaml's C implementation if PyYAML
+# was built with it, since it is several times faster than the pure-Python one.
+try:
+  SafeLoader = yaml.CSafeLoader
+except AttributeError:
+  SafeLoader = yaml.SafeLoader
+
 @dataclass
 class SchemaDescriptor:
   '''Class for storing the parts of the schema type describing YAML files'''
@@ -54,7 +67,9 @@ class SchemaDescriptor:
 class IndexedDocs(object):
   def __init__(self,
                strict: bool = False,
-               resolver: Callable[[Document], str] = None):
+               resolver: Callable[[Document], str] = None,
+               parse_cache: 'ParseCache' = None,
+               lazy: bool = False):
     """Initialized IndexedDocs
 
     Args:
@@ -63,22 +78,86 @@ class IndexedDocs(object):
         categorize documents that do not have a top-level 'type' field. The
         function is passed an uncategorized doc and should return a type string
         that will be used to categorize the document.
+      parse_cache: if set, the cache from which `from_files` obtains the
+        documents of files that have not changed since they were last parsed
+      lazy: if set, `from_files` only determines the types of the documents in
+        each file (see `sniff_types`), and parses the file the first time
+        `of_type` is called with one of those types. Untyped documents are then
+        categorized by passing the resolver a Document whose `obj` is None, so
+        the resolver must categorize them by path alone.
     """
     self.keyed_docs = collections.defaultdict(list)
     self.strict = strict
     self.resolver = resolver
+    self.parse_cache = parse_cache
+    self.lazy = lazy
+
+    # The paths of the files not yet parsed, keyed by the types they contain.
+    self.pending = collections.defaultdict(list)
+    self.parsed_paths = set()
+    self.jobs = 1
 
   def contains(self, *type_names: str) -> bool:
     """Returns True iff 1+ docs exist for each schema type in`type_names`"""
-    return all(name in self.keyed_docs for name in type_names)
+    return all(name in self.keyed_docs or name in self.pending
+               for name in type_names)
+
+  def from_files(self, *paths: str, jobs: int = 1):
+    """Adds all the documents found in `paths`.
+
+    The files are parsed (or, if `lazy` is set, sniffed) in up to `jobs`
+    processes concurrently. Either way, their documents are added in the order
+    of the sorted file paths.
+    """
+    file_paths = sorted(os.path.abspath(file_name)
+                        for file_name in only_files_in(paths))
+    self.jobs = max(self.jobs, jobs)
+    if not self.lazy:
+      self.parse_files(file_paths)
+      return
+
+    sniff = functools.partial(sniff_file, parse_cache=self.parse_cache)
+    for file_path, (documents, doc_types) in zip(
+        file_paths, map_in_processes(sniff, file_paths, jobs)):
+      if documents is not None:
+        self.parsed_paths.add(file_path)
+        self.add_documents(*documents)
+      else:
+        self.add_pending(file_path, doc_types)
 
-  def from_files(self, *paths: str):
-    """Adds all the documents found in `paths`."""
-    for file_name in only_files_in(paths):
-      file_path = os.path.abspath(file_name)
-      with open(file_path, 'r') as stream:
-        content = stream.read()
-        self.add(content, file_path)
+  def parse_files(self, file_paths: List[str]):
+    """Parses `file_paths` and adds their documents in that order."""
+    load = functools.partial(load_file, parse_cache=self.parse_cache)
+    for file_path, documents in zip(
+        file_paths, map_in_processes(load, file_paths, self.jobs)):
+      self.parsed_paths.add(file_path)
+      self.add_documents(*documents)
+
+  def add_pending(self, file_path: str, doc_types: List[str]):
+    """Records that `file_path` contains documents of `doc_types`.
+
+    The file is parsed immediately if any of `doc_types` is
+    SNIFFED_TYPE_UNKNOWN, or if any is None and `strict` is set (so that the
+    usual error is raised).
+    """
+    if (SNIFFED_TYPE_UNKNOWN in doc_types or
+        (self.strict and None in doc_types)):
+      self.parse_files([file_path])
+      return
+
+    type_names = []
+    for specified_type in doc_types:
+      if specified_type is not None:
+        type_name = specified_type.split(SCHEMA_TYPE_SEPARATOR, 1)[0]
+      elif self.resolver:
+        type_name = (self.resolver(Document(file_path, None)) or
+                     SCHEMA_TYPE_ABSENT)
+      else:
+        type_name = SCHEMA_TYPE_ABSENT
+      if type_name not in type_names:
+        type_names.append(type_name)
+    for type_name in type_names:
+      self.pending[type_name].append(file_path)
 
   def from_strings(self, *sources: Tuple[str, str]):
     """Adds all the documents found in `sources`.
@@ -101,7 +180,7 @@ class IndexedDocs(object):
     provided, the untyped documents are put into their own list with type given
     by `SCHEMA_TYPE_ABSENT`.
     """
-    self.add_documents(*[Document(file_name, doc) for doc in yaml.safe_load_all(content)])
+    self.add_documents(*parse(content, file_name))
 
   def add_documents(self, *documents: Document):
     """Adds each doc in `documents` under the right schema type key."""
@@ -131,14 +210,23 @@ class IndexedDocs(object):
 
   def of_type(self, type_name: str) -> List[Document]:
     """Returns a list of all `Document`s with the given type."""
+    pending = self.pending.pop(type_name, None)
+    if pending:
+      self.parse_files([path for path in pending
+                        if path not in self.parsed_paths])
     return self.keyed_docs.get(type_name, [])
 
+  def paths_of_type(self, type_name: str) -> Set[str]:
+    """Returns the paths of the files with `type_name` docs, without parsing."""
+    return ({doc.path for doc in self.keyed_docs.get(type_name, [])} |
+            set(self.pending.get(type_name, [])))
+
   def resolve_uncategorized(self):
     """Categorizes all documents of unknown type by calling the resolver."""
     if not self.resolver:
       return
 
-    unknowns = self.of_type(SCHEMA_TYPE_ABSENT)
+    unknowns = self.keyed_docs.get(SCHEMA_TYPE_ABSENT, [])
     for idx, unknown_doc in enumerate(unknowns):
       new_type = self.resolver(unknown_doc)
       if not new_type or new_type == SCHEMA_TYPE_ABSENT:
@@ -152,6 +240,260 @@ class IndexedDocs(object):
     self.keyed_docs[SCHEMA_TYPE_ABSENT] = [doc for doc in unknowns if doc]
 
 
+def parse(content: str, file_name: str) -> List[Document]:
+  """Returns a Document for each YAML document in `content`."""
+  return [Document(file_name, doc)
+          for doc in yaml.load_all(content, Loader=SafeLoader)]
+
+
+# Returned by `sniff_types` for documents whose type cannot be determined
+# without parsing them fully. This is a string (compared by value) rather than a
+# unique object so that it survives being pickled from a worker process.
+SNIFFED_TYPE_UNKNOWN = '(type needs parsing)'
+
+# The YAML tag of strings, which are the only valid values of SCHEMA_TYPE_KEY.
+_STRING_TAG = 'tag:yaml.org,2002:str'
+_MERGE_KEY = '<<'
+_tag_resolver = yaml.resolver.Resolver()
+
+
+def sniff_types(content: str) -> List[str]:
+  """Returns the top-level SCHEMA_TYPE_KEY of each YAML document in `content`.
+
+  This only scans the YAML event stream, which is much cheaper than
+  constructing the documents. The value for each document is None if it does
+  not have a string SCHEMA_TYPE_KEY at the top level, and SNIFFED_TYPE_UNKNOWN
+  if that cannot be determined from the events alone (eg the type is given via
+  an alias or a merge key).
+  """
+  doc_types = []
+  depth = 0
+  in_mapping = False  # whether the root node of the document is a mapping
+  position = 0  # of the current node in the top-level mapping
+  key = None
+  for event in yaml.parse(content, Loader=SafeLoader):
+    if isinstance(event, yaml.DocumentStartEvent):
+      doc_types.append(None)
+      continue
+    if isinstance(event, yaml.CollectionEndEvent):
+      depth -= 1
+      if depth == 1:
+        position += 1
+      continue
+    if not isinstance(event, yaml.NodeEvent):
+      continue
+
+    if depth == 0:
+      if isinstance(event, yaml.CollectionStartEvent):
+        depth = 1
+        in_mapping = isinstance(event, yaml.MappingStartEvent)
+        position = 0
+      continue
+    if depth > 1 or not in_mapping:
+      if isinstance(event, yaml.CollectionStartEvent):
+        depth += 1
+      continue
+
+    # A node directly in the top-level mapping.
+    is_key = position % 2 == 0
+    if isinstance(event, yaml.CollectionStartEvent):
+      depth += 1  # `position` advances at the matching end event
+      key = None
+      continue
+    position += 1
+    if isinstance(event, yaml.AliasEvent):
+      if not is_key and key == SCHEMA_TYPE_KEY:
+        doc_types[-1] = SNIFFED_TYPE_UNKNOWN
+      key = None
+      continue
+    if is_key:
+      key = event.value
+      if key == _MERGE_KEY:
+        doc_types[-1] = SNIFFED_TYPE_UNKNOWN
+    elif key == SCHEMA_TYPE_KEY and doc_types[-1] != SNIFFED_TYPE_UNKNOWN:
+      tag = event.tag
+      if not tag or tag == '!':
+        tag = _tag_resolver.resolve(yaml.ScalarNode, event.value,
+                                    event.implicit)
+      doc_types[-1] = event.value if tag == _STRING_TAG else None
+  return doc_types
+
+
+def sniff_file(file_path: str, parse_cache: 'ParseCache' = None):
+  """Returns a pair of the Documents in `file_path` and their types.
+
+  If `parse_cache` has up-to-date Documents for the file, these are returned
+  as the first element. Otherwise, the first element is None and the second is
+  the list returned by `sniff_types`.
+  """
+  if parse_cache:
+    documents = parse_cache.current_documents(file_path)
+    if documents is not None:
+      return documents, None
+  with open(file_path, 'r') as stream:
+    return None, sniff_types(stream.read())
+
+
+def map_in_processes(function, items: List, jobs: int):
+  """Yields `function` applied to each of `items`, in up to `jobs` processes."""
+  if jobs <= 1 or len(items) <= 1:
+    yield from map(function, items)
+    return
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    chunksize = max(1, len(items) // (4 * jobs))
+    yield from executor.map(function, items, chunksize=chunksize)
+
+
+def load_file(file_path: str, parse_cache: 'ParseCache' = None
+              ) -> List[Document]:
+  """Returns the Documents in `file_path`, from `parse_cache` if possible."""
+  if parse_cache:
+    return parse_cache.documents(file_path)
+  with open(file_path, 'r') as stream:
+    return parse(stream.read(), file_path)
+
+
+class ParseCache:
+  """Stores the parsed Documents of YAML files on disk, one entry per file.
+
+  Each entry records the modification time, size and content hash of the file
+  it was parsed from. The entry is used as-is if the modification time and size
+  of the file still match, and otherwise only if the hash of the file's current
+  content matches, so that files that were touched but not changed are still
+  not parsed again.
+
+  Entries unused for more than `max_age` seconds are evicted, as are the least
+  recently used entries once the entries take up more than `max_bytes`.
+  """
+
+  # Bump this whenever the entry format or the parsed representation changes.
+  FORMAT_VERSION = 1
+
+  def __init__(self, directory: str, max_age: float = None,
+               max_bytes: int = None):
+    self.directory = directory
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+
+  def current_documents(self, file_path: str) -> List[Document]:
+    """Returns the cached Documents in `file_path` if it is unmodified.
+
+    Unlike `documents`, this never reads `file_path`, and returns None if the
+    file may have changed since its entry was written.
+    """
+    stat = os.stat(file_path)
+    entry_path = self._entry_path(file_path)
+    entry = self._read(entry_path, file_path)
+    if (entry and entry['mtime'] == stat.st_mtime_ns and
+        entry['size'] == stat.st_size):
+      self._touch(entry_path)
+      return entry['documents']
+    return None
+
+  def documents(self, file_path: str) -> List[Document]:
+    """Returns the Documents in `file_path`, parsing it only if it changed."""
+    stat = os.stat(file_path)
+    entry_path = self._entry_path(file_path)
+    entry = self._read(entry_path, file_path)
+    if (entry and entry['mtime'] == stat.st_mtime_ns and
+        entry['size'] == stat.st_size):
+      self._touch(entry_path)
+      return entry['documents']
+
+    with open(file_path, 'r') as stream:
+      content = stream.read()
+    content_hash = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    if entry and entry['hash'] == content_hash:
+      documents = entry['documents']
+    else:
+      documents = parse(content, file_path)
+    self._write(entry_path, {'version': self.FORMAT_VERSION,
+                             'path': file_path,
+                             'mtime': stat.st_mtime_ns,
+                             'size': stat.st_size,
+                             'hash': content_hash,
+                             'documents': documents})
+    return documents
+
+  def evict(self):
+    """Removes expired entries, then the least recently used ones over size."""
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return
+    entries = []
+    now = time.time()
+    for name in names:
+      path = os.path.join(self.directory, name)
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+      if self.max_age is not None and now - stat.st_mtime > self.max_age:
+        remove_quietly(path)
+        continue
+      entries.append((stat.st_mtime, stat.st_size, path))
+
+    if self.max_bytes is None:
+      return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      remove_quietly(path)
+      total -= size
+
+  def _touch(self, entry_path: str):
+    """Marks the entry at `entry_path` as recently used."""
+    try:
+      os.utime(entry_path)
+    except OSError:
+      pass
+
+  def _entry_path(self, file_path: str) -> str:
+    name = hashlib.sha256(file_path.encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, name + '.pickle')
+
+  def _read(self, entry_path: str, file_path: str):
+    try:
+      with open(entry_path, 'rb') as stream:
+        entry = pickle.load(stream)
+    except FileNotFoundError:
+      return None
+    except Exception as e:
+      logging.info(f'ignoring unreadable parse cache entry "{entry_path}": {e}')
+      return None
+    if (not isinstance(entry, dict) or
+        entry.get('version') != self.FORMAT_VERSION or
+        entry.get('path') != file_path):
+      return None
+    return entry
+
+  def _write(self, entry_path: str, entry):
+    try:
+      os.makedirs(self.directory, exist_ok=True)
+      fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.entry-')
+      with os.fdopen(fd, 'wb') as stream:
+        pickle.dump(entry, stream, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, entry_path)
+    except OSError as e:
+      logging.warning(f'could not write parse cache entry "{entry_path}": {e}')
+
+
+def remove_quietly(path: str):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
+
+
+def default_cache_directory() -> str:
+  """Returns the per-user directory in which to cache parsed files."""
+  cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_home, 'sampletester', 'parsed')
+
+
 def only_files_in(paths: Iterable[str]) -> Set[str]:
   """Returns only those elements of `paths` that are files"""
   return {fname for fname in paths if os.path.isfile(fname)}
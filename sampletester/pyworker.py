@@ -0,0 +1,127 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A warm Python interpreter that runs scripts on request.
+
+This is run as a script (not imported) by `execution.PythonPool`, with the
+names of the modules to pre-import as its arguments. It then reads one JSON
+request per line from stdin, each naming a `script` to run with the arguments
+`argv` from the directory `cwd`, writing its output to the file `output`. For
+each request, it forks a child that runs the script as `__main__`, so that the
+script starts with the pre-imported modules but sees no state left behind by
+previous scripts. It replies on stdout with one JSON line when the child starts
+(`{"started": PID}`) and another when it exits (`{"exit": RETURN_CODE}`).
+
+This only uses the standard library, so that it can run in any interpreter.
+"""
+
+import importlib
+import json
+import os
+import runpy
+import sys
+import traceback
+
+
+def main(preload):
+  requests = sys.stdin.buffer
+  replies = os.fdopen(os.dup(1), 'w')
+
+  # Anything else printed to stdout, eg while importing, must not get mixed up
+  # with the replies.
+  os.dup2(2, 1)
+
+  # sys.path[0] is the directory of this script, which would let the preloaded
+  # modules and the scripts import the tester's own modules. Each script's
+  # directory takes its place in `run_script`.
+  del sys.path[0]
+  for module in preload:
+    try:
+      importlib.import_module(module)
+    except Exception as e:
+      send(replies, {'error': 'could not import {}: {}'.format(module, e)})
+      return 1
+  send(replies, {'ready': True})
+
+  for line in requests:
+    request = json.loads(line.decode('utf-8'))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+      run_script(request)  # does not return
+    send(replies, {'started': pid})
+    _, status = os.waitpid(pid, 0)
+    send(replies, {'exit': return_code(status)})
+  return 0
+
+
+def run_script(request):
+  """Runs the script in `request` in this (child) process, and then exits."""
+  code = 1
+  try:
+    # Make this the leader of a new process group, so that it can be killed
+    # along with any processes it spawns.
+    os.setsid()
+    output = os.open(request['output'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+    os.dup2(output, 1)
+    os.dup2(output, 2)
+    sys.stdin = open(os.devnull)
+    sys.stdout = open(1, 'w', buffering=1, closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+    if request.get('cwd'):
+      os.chdir(request['cwd'])
+    script = request['script']
+    sys.argv = [script] + request['argv']
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name='__main__')
+    code = 0
+  except SystemExit as e:
+    code = exit_code(e.code)
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(code)
+
+
+def exit_code(code):
+  """Returns the process exit code for `sys.exit(code)`."""
+  if code is None:
+    return 0
+  if isinstance(code, int):
+    return code
+  print(code, file=sys.stderr)
+  return 1
+
+
+def return_code(status):
+  """Returns the return code of a process, as in `subprocess.Popen`."""
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+
+def send(replies, message):
+  replies.write(json.dumps(message) + '\n')
+  replies.flush()
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,203 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import shlex
+import tempfile
+import threading
+import time
+
+from sampletester import testenv
+
+# Bump this whenever the key computation or the entry format changes, so that
+# stale entries are never replayed.
+FORMAT_VERSION = '1'
+
+# Directives whose effects we cannot determine statically. Test cases using
+# any of these are never cached.
+UNCACHEABLE_DIRECTIVES = {'code', 'shell'}
+
+# Directives that invoke artifacts through the environment.
+CALL_DIRECTIVES = {'call', 'call_may_fail'}
+
+
+class ResultCache:
+  """Stores the results of passing test cases, keyed by their inputs.
+
+  The key of a test case is a hash of everything that can affect its outcome
+  that we can determine without running it: the environment name, the suite
+  set-up and tear-down, the case spec, the resolved invocation and working
+  directory of each artifact it calls (as returned by the environment's
+  `get_call`), and the contents of any files named in those invocations. Test
+  cases that run arbitrary code or shell commands are never cached.
+
+  Each entry is a small JSON file under `directory`. Entries older than
+  `max_age` seconds are evicted, as are the least recently used entries once
+  the entries take up more than `max_bytes`.
+  """
+
+  def __init__(self, directory: str, max_age: float = None,
+               max_bytes: int = None):
+    self.directory = directory
+    self.max_age = max_age
+    self.max_bytes = max_bytes
+
+    # Memoized file hashes, keyed by (path, mtime, size).
+    self._file_hashes = {}
+    self._lock = threading.Lock()
+
+  def key(self, environment: testenv.Base, setup, spec, teardown) -> str:
+    """Returns the cache key for a test case, or None if it is not cacheable."""
+    hasher = hashlib.sha256()
+    hash_strings(hasher, FORMAT_VERSION, environment.name())
+    settings = environment.get_testcase_settings() or {}
+    target_key = settings.get('call.target', 'target')
+
+    for segment in itertools.chain(setup or [], spec or [], teardown or []):
+      if not isinstance(segment, dict):
+        return None
+      for directive, value in segment.items():
+        if directive in UNCACHEABLE_DIRECTIVES:
+          return None
+        if directive == 'env':
+          env_var = value.get('name') if isinstance(value, dict) else None
+          hash_strings(hasher, 'env', str(env_var),
+                       str(os.environ.get(str(env_var))))
+        if directive in CALL_DIRECTIVES:
+          if not isinstance(value, dict) or target_key not in value:
+            return None
+          try:
+            call, chdir = environment.get_call(value[target_key])
+          except Exception:
+            return None  # the case will report the error when it runs
+          hash_strings(hasher, 'call', call, str(chdir))
+          for file_hash in self.hash_referenced_files(call, chdir):
+            hash_strings(hasher, file_hash)
+
+    hash_strings(hasher, json.dumps([setup, spec, teardown], sort_keys=True,
+                                    default=str))
+    return hasher.hexdigest()
+
+  def hash_referenced_files(self, call: str, chdir: str):
+    """Yields the hashes of the files named by the words in `call`."""
+    try:
+      words = shlex.split(call)
+    except ValueError:
+      words = call.split()
+    for word in words:
+      path = os.path.join(chdir, word) if chdir else word
+      if not os.path.isfile(path):
+        continue
+      yield self.hash_file(path)
+
+  def hash_file(self, path: str) -> str:
+    """Returns the hash of the contents of `path`, memoized by mtime and size."""
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with self._lock:
+      known = self._file_hashes.get(memo_key)
+    if known:
+      return known
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as stream:
+      for chunk in iter(lambda: stream.read(1 << 16), b''):
+        hasher.update(chunk)
+    digest = hasher.hexdigest()
+    with self._lock:
+      self._file_hashes[memo_key] = digest
+    return digest
+
+  def get(self, key: str):
+    """Returns the entry stored under `key`, or None if there is none."""
+    path = self._path(key)
+    try:
+      with open(path, 'r') as stream:
+        entry = json.load(stream)
+      os.utime(path)  # mark as recently used
+    except (OSError, ValueError):
+      return None
+    age = time.time() - entry.get('created', 0)
+    if self.max_age is not None and age > self.max_age:
+      return None
+    return entry
+
+  def put(self, key: str, output: str, duration: float):
+    """Stores the `output` and `duration` of a passing test case."""
+    path = self._path(key)
+    entry = {'created': time.time(), 'duration': duration, 'output': output}
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                       prefix='.entry-')
+      with os.fdopen(fd, 'w') as stream:
+        json.dump(entry, stream)
+      os.replace(temp_path, path)
+    except OSError as e:
+      logging.warning('could not write result cache entry "{}": {}'
+                      .format(path, e))
+
+  def evict(self):
+    """Removes expired entries, then the least recently used ones over size."""
+    entries = []
+    now = time.time()
+    for root, _, files in os.walk(self.directory):
+      for name in files:
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        if self.max_age is not None and now - stat.st_mtime > self.max_age:
+          remove_quietly(path)
+          continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    if self.max_bytes is None:
+      return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      remove_quietly(path)
+      total -= size
+
+  def _path(self, key: str) -> str:
+    return os.path.join(self.directory, key[:2], key + '.json')
+
+
+def default_directory() -> str:
+  """Returns the per-user directory in which to cache results."""
+  cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'))
+  return os.path.join(cache_home, 'sampletester', 'results')
+
+
+def hash_strings(hasher, *strings: str):
+  """Feeds `strings` to `hasher` unambiguously."""
+  for string in strings:
+    data = string.encode('utf-8')
+    hasher.update(str(len(data)).encode('utf-8'))
+    hasher.update(b':')
+    hasher.update(data)
+
+
+def remove_quietly(path: str):
+  try:
+    os.remove(path)
+  except OSError:
+    pass
@@ -13,23 +13,120 @@
 # limitations under the License.
 
 import logging
+import threading
 import yaml
 
 from sampletester import caserunner
+from sampletester import execution
+from sampletester import resultcache
 from sampletester import testplan
 
 
 class Visitor(testplan.Visitor):
 
-  def __init__(self, fail_fast=False):
+  def __init__(self, fail_fast=False, engine: execution.Engine = None,
+               call_timeout: float = None, case_timeout: float = None,
+               result_cache: resultcache.ResultCache = None):
     self.run_passed = True
     self.fail_fast = fail_fast
+    self.engine = engine
+
+    # If set, passing cases whose inputs are unchanged are replayed from here.
+    self.result_cache = result_cache
+
+    # The default timeouts, which the testplan may override per suite or case.
+    self.call_timeout = call_timeout
+    self.case_timeout = case_timeout
     self.encountered_failure = False
 
+    # Guards the suite counters and `encountered_failure`, which are updated by
+    # concurrently running test cases when visiting in parallel.
+    self.lock = threading.Lock()
+
+    # The compiled test specs, keyed by the id of the spec (which the value
+    # keeps alive) and the `call` target key of the environment. The value is
+    # the spec and either its caserunner.CompiledSpec or a ConfigError message.
+    self.compiled_specs = {}
+
+  def compile_plan(self, manager: testplan.Manager):
+    """Compiles the specs of all the selected test cases, before running any.
+
+    The compiled specs are then used when the test cases run.
+
+    Returns:
+      a list describing each problem found in the specs
+    """
+    problems = []
+    for environment in manager.environments:
+      if not environment.selected():
+        continue
+      for suite in environment.suites:
+        if not suite.selected():
+          continue
+        where = '{}: suite "{}"'.format(suite.source(), suite.name())
+        problems.extend(check_timeouts(suite, where))
+        for stage, spec in [('setup', suite.setup()),
+                            ('teardown', suite.teardown())]:
+          problems.append(self._check(environment, suite, spec,
+                                      '{}, {}'.format(where, stage)))
+        for tcase in suite.cases:
+          if tcase.selected():
+            case_where = '{}, case "{}"'.format(where, tcase.name())
+            problems.extend(check_timeouts(tcase, case_where))
+            problems.append(self._check(environment, suite, tcase.spec(),
+                                        case_where))
+
+    unique_problems = []
+    for problem in problems:
+      if problem and problem not in unique_problems:
+        unique_problems.append(problem)
+    return unique_problems
+
+  def _check(self, environment, suite, spec, where):
+    """Returns a description of the problem compiling `spec`, if any."""
+    try:
+      self.compiled_spec(environment, suite, spec)
+    except caserunner.ConfigError as e:
+      return '{}: {}'.format(where, e.msg)
+    return None
+
+  def compiled_spec(self, environment: testplan.Environment,
+                    suite: testplan.Suite, spec) -> caserunner.CompiledSpec:
+    """Returns `spec` compiled for `environment`, raising ConfigError if invalid.
+    """
+    target_key = caserunner.call_target_key(environment.config)
+    key = (id(spec), target_key)
+    with self.lock:
+      entry = self.compiled_specs.get(key)
+    if entry is None:
+      try:
+        compiled = caserunner.compile_spec(spec, target_key, suite.source())
+      except caserunner.ConfigError as e:
+        compiled = e.msg
+      entry = (spec, compiled)
+      with self.lock:
+        self.compiled_specs[key] = entry
+    if not isinstance(entry[1], caserunner.CompiledSpec):
+      raise caserunner.ConfigError(entry[1])
+    return entry[1]
+
+  def compiled_or_raw(self, environment, suite, spec):
+    """Returns `spec` compiled if valid, or else as-is.
+
+    An invalid spec is reported as a configuration error when its case runs.
+    """
+    try:
+      return self.compiled_spec(environment, suite, spec)
+    except caserunner.ConfigError:
+      return spec
+
   def start_visit(self):
     logging.info("========== Running test!")
     return self.visit_environment, self.visit_environment_end
 
+  def parallelizable(self):
+    return True
+
   def visit_environment(self, environment: testplan.Environment, do_environment: bool):
     if not do_environment:
       logging.info('skipping environment "{}"'.format(environment.name()))
@@ -54,7 +151,6 @@ class Visitor(testplan.Visitor):
       logging.info('fail fast: not running suite "{}"'.format(suite.name))
       return None
 
-    suite.attempted = True
     logging.info(
         "\n==== SUITE {}:{}:{} START  =========================================="
         .format(environment.name(), idx, suite.name()))
@@ -73,26 +169,58 @@ class Visitor(testplan.Visitor):
       return
 
     tcase.attempted = True
+    with self.lock:
+      # Only now, since with fail_fast the suite may end up not running any
+      # cases.
+      suite.attempted = True
     case_runner = caserunner.TestCase(environment.config, idx, tcase.name(),
-                                      suite.setup(), tcase.spec(),
-                                      suite.teardown())
+                                      self.compiled_or_raw(environment, suite,
+                                                           suite.setup()),
+                                      self.compiled_or_raw(environment, suite,
+                                                           tcase.spec()),
+                                      self.compiled_or_raw(environment, suite,
+                                                           suite.teardown()),
+                                      engine=self.engine,
+                                      call_timeout=first_set(tcase.call_timeout(),
+                                                             suite.call_timeout(),
+                                                             self.call_timeout),
+                                      case_timeout=first_set(tcase.case_timeout(),
+                                                             suite.case_timeout(),
+                                                             self.case_timeout),
+                                      source=suite.source())
     tcase.runner = case_runner
-    case_runner.run()
-    num_failures = len(case_runner.failures)
-    tcase.num_failures += num_failures
-    suite.num_failures += tcase.num_failures
-    if tcase.num_failures > 0:
-      suite.num_failing_cases += 1
 
+    cache_key = None
+    if self.result_cache:
+      cache_key = self.result_cache.key(environment.config, suite.setup(),
+                                        tcase.spec(), suite.teardown())
+    cached = self.result_cache.get(cache_key) if cache_key else None
+    if cached:
+      case_runner.replay(cached['output'])
+      tcase.cached = True
+    else:
+      case_runner.run()
+      if cache_key and not case_runner.failures and not case_runner.errors:
+        duration = case_runner.end_time - case_runner.start_time
+        self.result_cache.put(cache_key, case_runner.output.getvalue(),
+                              duration.total_seconds())
+    num_failures = len(case_runner.failures)
     num_errors = len(case_runner.errors)
+    tcase.num_failures += num_failures
     tcase.num_errors += num_errors
-    suite.num_errors += tcase.num_errors
-    if tcase.num_errors > 0:
-      suite.num_erroring_cases += 1
-
     tcase.update_times(case_runner.start_time, case_runner.end_time)
-    suite.update_times(case_runner.start_time, case_runner.end_time)
-    self.encountered_failure = self.encountered_failure or num_errors > 0 or num_failures > 0
+
+    with self.lock:
+      suite.num_failures += tcase.num_failures
+      if tcase.num_failures > 0:
+        suite.num_failing_cases += 1
+
+      suite.num_errors += tcase.num_errors
+      if tcase.num_errors > 0:
+        suite.num_erroring_cases += 1
+
+      suite.update_times(case_runner.start_time, case_runner.end_time)
+      self.encountered_failure = self.encountered_failure or num_errors > 0 or num_failures > 0
     tcase.completed = True
 
   def visit_suite_end(self, idx, suite: testplan.Suite,
@@ -116,11 +244,12 @@ class Visitor(testplan.Visitor):
       logging.info(
           "==== SUITE {}:{}:{} FAILURE ========================================"
           .format(environment.name(), idx, suite.name()))
-      suite.completed = True
+    suite.completed = suite.attempted
 
   def visit_environment_end(self, environment: testplan.Environment, do_environment: bool):
     if not environment.success():
-      self.run_passed = False
+      with self.lock:
+        self.run_passed = False
     environment.completed = True
     environment.config.teardown()
 
@@ -130,3 +259,25 @@ class Visitor(testplan.Visitor):
 
   def success(self):
     return self.run_passed
+
+
+def check_timeouts(wrapper, where):
+  """Returns descriptions of the problems with the timeouts of `wrapper`.
+
+  `wrapper` is a testplan.Suite or testplan.TestCase.
+  """
+  problems = []
+  for key, timeout in [(testplan.SUITE_CALL_TIMEOUT, wrapper.call_timeout()),
+                       (testplan.SUITE_CASE_TIMEOUT, wrapper.case_timeout())]:
+    problem = testplan.check_timeout(timeout)
+    if problem:
+      problems.append('{}: invalid "{}": {}'.format(where, key, problem))
+  return problems
+
+
+def first_set(*values):
+  """Returns the first of `values` that is not None, or None if all are."""
+  for value in values:
+    if value is not None:
+      return value
+  return None
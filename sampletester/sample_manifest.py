@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
 import io
 import logging
 import os.path
+import pickle
+import tempfile
 import yaml
 
 from sampletester import parser
@@ -50,7 +53,8 @@ class Manifest:
   specifying the label name corresponding to the index keys. Look up by index
   (ie label value for the indexed label names) is O(1). Look up by a non-index
   key (label name/value pairs for non-indexed labels) is O(n) in the number of
-  labels.
+  artifacts sharing the index keys the first time a given label name is used
+  with those keys, and O(1) on average after that.
 
   For simplicity, we refer to the sequence of index label values (order
   determined by which the label names were configured) as the "keys", and the
@@ -89,6 +93,13 @@ class Manifest:
     # read_sources() and used by index()
     self.sources = []
 
+    # Secondary indexes over the non-index labels, built on demand by get():
+    # filter_indices[(key1, ..., keyn), label_name][label_value] == [metadata, ...]
+    self.filter_indices = {}
+
+    # Shared by all sources, since they tend to repeat the same tag values.
+    self.inclusion_resolver = InclusionResolver()
+
     self.set_indices(*indices)
 
   def set_indices(self, *indices: str):
@@ -151,6 +162,8 @@ class Manifest:
   def index(self):
     """Indexes all items in self.sources using appropriate interpreters."""
     self.tags = {}
+    self.filter_indices = {}
+    self.inclusion_resolver = InclusionResolver()
     for name, manifest, interpreter, implicit_tags in self.sources:
       try:
         interpreter(manifest, implicit_tags)
@@ -171,19 +184,22 @@ class Manifest:
         resolve_inclusions(
             extend_all_with(implicit_tags,
                             check_tag_names(
-                                get_flattened_elements_v1_v2(input)))))
+                                get_flattened_elements_v1_v2(input))),
+            self.inclusion_resolver))
 
   def index_source_v3(self, input, implicit_tags):
     self._index_elements(
         resolve_inclusions(
             extend_all_with(implicit_tags,
                             check_tag_names(
-                                get_elements_v3(input)))))
+                                get_elements_v3(input))),
+            self.inclusion_resolver))
 
   def _index_elements(self, all_elements):
     if not all_elements:
       return
 
+    self.filter_indices = {}
     max_idx = len(self.indices) - 1
     for element in all_elements:
 
@@ -240,13 +256,40 @@ class Manifest:
       tags = self.tags
       for idx in range(0, len(self.indices)):
         tags = tags[keys[idx]]
-      return [element
-              for element in tags
-              if all(tag_filter in element.items()
-                     for tag_filter in filters.items())]
+      keys = tuple(keys[:len(self.indices)])
     except Exception as e:
       return None
 
+    # Narrow the candidates down to those matching the most selective filter,
+    # then check the remaining filters on just those.
+    candidates = tags
+    for name, value in filters.items():
+      try:
+        matches = self._filter_index(keys, name, tags).get(value, [])
+      except TypeError:  # unhashable value
+        continue
+      if len(matches) < len(candidates):
+        candidates = matches
+    return [element
+            for element in candidates
+            if all(tag_filter in element.items()
+                   for tag_filter in filters.items())]
+
+  def _filter_index(self, keys, name, elements):
+    """Returns the index of `elements` (found under `keys`) by label `name`."""
+    filter_index = self.filter_indices.get((keys, name))
+    if filter_index is None:
+      filter_index = {}
+      for element in elements:
+        if name not in element:
+          continue
+        try:
+          filter_index.setdefault(element[name], []).append(element)
+        except TypeError:  # unhashable values never equal a hashable filter
+          pass
+      self.filter_indices[(keys, name)] = filter_index
+    return filter_index
+
   def get_one(self, *keys, **filters):
     """Returns the single artifact associated with these keys and filters, or None otherwise"""
     values = self.get(*keys, **filters)
@@ -258,6 +301,73 @@ class Manifest:
       raise ItemNotUniqueError(f'more than one item with the requested fields {requested}')
     return values[0]
 
+  # Bump this whenever the snapshot format or the structure of `tags` changes.
+  SNAPSHOT_VERSION = 1
+
+  def write_snapshot(self, snapshot_path: str, source_paths: Iterable[str]):
+    """Writes the indexed manifest to `snapshot_path`.
+
+    The snapshot records the content hash of each of `source_paths`, which
+    should be the files the manifest was read from, so that `read_snapshot` can
+    tell when it is stale.
+    """
+    snapshot = {'version': self.SNAPSHOT_VERSION,
+                'indices': list(self.indices),
+                'sources': {path: file_hash(path) for path in source_paths},
+                'tags': self.tags}
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+    try:
+      with os.fdopen(fd, 'wb') as stream:
+        pickle.dump(snapshot, stream, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(temp_path, snapshot_path)
+    except BaseException:
+      os.remove(temp_path)
+      raise
+
+  def read_snapshot(self, snapshot_path: str,
+                    source_paths: Iterable[str]) -> bool:
+    """Loads the indexed manifest written by `write_snapshot`, if still valid.
+
+    The snapshot is valid only if it was written with the same indices as this
+    manifest's, from exactly `source_paths`, none of which has changed since.
+
+    Returns:
+      whether the snapshot was loaded. If it was not, this manifest is
+      unchanged.
+    """
+    try:
+      with open(snapshot_path, 'rb') as stream:
+        snapshot = pickle.load(stream)
+    except Exception as e:
+      logging.warning(f'ignoring unreadable manifest snapshot "{snapshot_path}": {e}')
+      return False
+
+    if (not isinstance(snapshot, dict) or
+        snapshot.get('version') != self.SNAPSHOT_VERSION or
+        snapshot.get('indices') != list(self.indices)):
+      logging.warning(f'ignoring incompatible manifest snapshot "{snapshot_path}"')
+      return False
+    sources = snapshot['sources']
+    if set(sources.keys()) != set(source_paths):
+      logging.warning(f'ignoring manifest snapshot "{snapshot_path}": '
+                      'it was compiled from different manifest files')
+      return False
+    for path, expected_hash in sources.items():
+      try:
+        current_hash = file_hash(path)
+      except OSError:
+        current_hash = None
+      if current_hash != expected_hash:
+        logging.warning(f'ignoring manifest snapshot "{snapshot_path}": '
+                        f'"{path}" changed since it was compiled')
+        return False
+
+    self.tags = snapshot['tags']
+    self.filter_indices = {}
+    logging.debug(f'loaded manifest snapshot "{snapshot_path}"')
+    return True
+
 
 ### Helpers for V3
 
@@ -325,52 +435,87 @@ class CycleError(Exception):
   pass
 
 
-def resolve_inclusions(all_elements):
+def resolve_inclusions(all_elements, resolver: 'InclusionResolver' = None):
   """Resolves tag inclusions in each element"""
   if not all_elements:
     return None
+  resolver = resolver or InclusionResolver()
   for element in all_elements:
-    resolve_element_inclusions(element)
+    resolver.resolve_element(element)
   logging.debug('resolved inclusions')
   return all_elements
 
 def resolve_element_inclusions(element):
   """Resolves tag inclusions in element tags"""
-  resolved=set()
-  for tag_name in element.keys():
-    resolve_tag_inclusion(element, tag_name, history=set(), resolved=resolved,
-                          original_element = element.copy(), original_tag = tag_name)
+  InclusionResolver().resolve_element(element)
 
-def resolve_tag_inclusion (element, tag_name, history,
-                           resolved, original_element, original_tag):
-    """Recursive helper function for resolve_element_inclusions
 
-    Args:
-       element: the element whose tags we are to resolve
-       tag_name: the tag to resolve in this invocation
-       history: the tags that we have attempted to resolve in the process of
-          resolving original_tag. Used to check for cycles.
-       original_element: a copy of the element before any tag inclusions, for
-          reporting errors
-       original_tag: the original tag we are trying to resolve, for
-          reporting errors
-    """
-    if tag_name in resolved:
-      return element
+class InclusionResolver:
+  """Resolves tag inclusions, parsing each distinct tag value only once.
+
+  Many elements typically share tag values (eg via YAML anchors and merge keys),
+  so this remembers the Inclusions parsed from each tag value, as well as the
+  result of resolving each tag value with given included values.
+  """
+
+  def __init__(self):
+    # tag value -> Inclusions
+    self.inclusions = {}
+
+    # (tag value, (included value, ...)) -> resolved tag value
+    self.resolved = {}
+
+  def resolve_element(self, element):
+    """Resolves the tag inclusions in `element`, in dependency order."""
+    inclusions = {}
+    for tag_name, value in element.items():
+      if not isinstance(value, str):
+        continue
+      inclusion = self.inclusions.get(value)
+      if inclusion is None:
+        inclusion = self.inclusions[value] = Inclusions.determine(value, element,
+                                                                  tag_name)
+      inclusions[tag_name] = inclusion
+
+    for tag_name in resolution_order(element, inclusions):
+      inclusion = inclusions[tag_name]
+      included = tuple(str(element[needed]) for needed in inclusion.needs)
+      key = (element[tag_name], included)
+      resolved = self.resolved.get(key)
+      if resolved is None:
+        resolved = self.resolved[key] = inclusion.resolve(
+            dict(zip(inclusion.needs, included)))
+      element[tag_name] = resolved
+
+
+def resolution_order(element, inclusions):
+  """Returns the tags of `element` in `inclusions` in dependency order.
+
+  Each tag is preceded by the tags it includes. Raises CycleError if the
+  inclusions form a loop. `element` is not modified, so it is reported as-is.
+  """
+  order = []
+  done = set()
+
+  def visit(tag_name, history, original_tag):
+    if tag_name in done:
+      return
     if tag_name in history:
       raise CycleError(
           'resolution of tag "{}"" creates a loop at included tag "{}" in item {}'
-          .format(original_tag, tag_name, original_element))
+          .format(original_tag, tag_name, element))
+    inclusion = inclusions.get(tag_name)
+    if inclusion is None:
+      done.add(tag_name)
+      return
+    for child_tag_name in inclusion.needs:
+      visit(child_tag_name, history | {tag_name}, original_tag)
+    done.add(tag_name)
+    order.append(tag_name)
 
-    new_history = history.copy()
-    new_history.add(tag_name)
-    inclusion = Inclusions.determine(element[tag_name], element, tag_name)
-    for child_tag_name in inclusion.needs.keys():
-      resolve_tag_inclusion(element, child_tag_name, new_history, resolved,
-                            original_element, original_tag)
-    element[tag_name] = inclusion.resolve(element)
-    resolved.add(tag_name)
-    return element
+  for tag_name in inclusions:
+    visit(tag_name, frozenset(), tag_name)
+  return order
 
 
 class Inclusions:
@@ -391,11 +536,12 @@ class Inclusions:
       needed_where.append(idx)
 
   def resolve(self, values):
-    """Resolves `self` by substituting inclusions with items from `values`."""
+    """Returns `self` with inclusions substituted by items from `values`."""
+    parts = self.parts.copy()
     for tag, locs in self.needs.items():
       for idx in locs:
-        self.parts[idx] = values[tag]
-    return ''.join(self.parts)
+        parts[idx] = str(values[tag])
+    return ''.join(parts)
 
   def determine(value, element, tag_name):
     """Static method to instantiate Inclusions for tag_name in element"""
@@ -497,6 +643,15 @@ def extend_all_with(src, dst):
 
 ### Low-level helpers
 
+def file_hash(path: str) -> str:
+  """Returns the hash of the contents of the file at `path`."""
+  hasher = hashlib.sha256()
+  with open(path, 'rb') as stream:
+    for chunk in iter(lambda: stream.read(1 << 16), b''):
+      hasher.update(chunk)
+  return hasher.hexdigest()
+
+
 def get_or_create(d, key, empty_value):
   """Returns the specified `key` from `d`, creating it if absent."""
   value = d.get(key)
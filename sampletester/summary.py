@@ -70,8 +70,9 @@ class SummaryVisitor(testplan.Visitor):
     if not status:
       return
 
-    self.append_lines(self.indent * 2 + '{}: Test case: "{}"'
-                      .format(status, name))
+    self.append_lines(self.indent * 2 + '{}: Test case: "{}"{}'
+                      .format(status, name,
+                              ' (cached)' if tcase.cached else ''))
     if runner and (self.verbosity == Detail.FULL or (self.show_errors and not tcase.success())):
       self.append_lines(runner.get_output(6, '| '))
     if self.debug and runner:
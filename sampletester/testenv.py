@@ -38,6 +38,25 @@ class Base:
     logging.fatal(
         'get_call() invoked on Base (should be overridden)')
 
+  def get_call_timeout(self, *args, **kwargs):
+    """Returns the timeout in seconds for the call with these arguments.
+
+    Returns None if this environment does not specify a timeout for the call,
+    in which case the test runner's default applies.
+    """
+    return None
+
+  def get_call_script(self, *args, **kwargs):
+    """Returns the Python script run by the call with these arguments, if any.
+
+    If the call may run in a warm Python interpreter (see
+    `execution.PythonPool`), this returns a triple consisting of the
+    interpreter, the path to the script, and the list of its arguments.
+    Otherwise, it returns None, and the call is run via the command returned by
+    `get_call`.
+    """
+    return None
+
   def get_symbol(self, symbol):
     """Returns a symbol defined in this environment.
 
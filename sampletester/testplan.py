@@ -12,9 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import concurrent.futures
+import functools
+import heapq
 import logging
 import re
+import statistics
+import threading
+import types
 import yaml
 
 from typing import List
@@ -22,7 +27,14 @@ from typing import List
 from sampletester import parser
 
 
+# The Wrapper hierarchy is instantiated once per environment, so its classes
+# use __slots__ and share their (read-only) configurations across environments
+# rather than copying them: each per-environment object only adds its results.
+
+
 class Wrapper:
+  __slots__ = ('start_time', 'end_time', 'num_errors', 'num_failures',
+               'selected_to_run', 'attempted', 'completed')
 
   def __init__(self):
     self.start_time = None
@@ -56,11 +68,13 @@ class Wrapper:
 
 
 class Environment(Wrapper):
+  __slots__ = ('config', 'suites', 'num_failing_cases', 'num_failing_suites',
+               'num_erroring_cases', 'num_erroring_suites')
 
   def __init__(self, env_config, test_suites, env_filter):
     super().__init__()
     self.config = env_config
-    self.suites = copy.deepcopy(test_suites)
+    self.suites = [suite.copy() for suite in test_suites]
     self.num_failing_cases = 0
     self.num_failing_suites = 0
     self.num_erroring_cases = 0
@@ -73,19 +87,32 @@ class Environment(Wrapper):
 
 
 class Suite(Wrapper):
+  __slots__ = ('config', 'cases', 'num_failing_cases', 'num_erroring_cases')
 
   def __init__(self, suite_config, suite_filter, case_filter):
     super().__init__()
-    self.config = copy.deepcopy(suite_config)
+    self.config = types.MappingProxyType(
+        {key: value for key, value in suite_config.items()
+         if key != SUITE_CASES})
     self.cases = [
         TestCase(test_config, case_filter)
         for test_config in suite_config.get(SUITE_CASES, [])
     ]
-    self.config[SUITE_CASES] = None
     self.num_failing_cases = 0
     self.num_erroring_cases = 0
     self.selected_to_run = passes_filter(suite_filter, self.name())
 
+  def copy(self) -> 'Suite':
+    """Returns a copy sharing this suite's configuration, but no results."""
+    suite = Suite.__new__(Suite)
+    Wrapper.__init__(suite)
+    suite.config = self.config
+    suite.cases = [tcase.copy() for tcase in self.cases]
+    suite.num_failing_cases = 0
+    suite.num_erroring_cases = 0
+    suite.selected_to_run = self.selected_to_run
+    return suite
+
   def selected(self):
     return self.enabled() and super().selected()
 
@@ -104,34 +131,82 @@ class Suite(Wrapper):
   def source(self):
     return self.config[SUITE_SOURCE]
 
+  def call_timeout(self):
+    return self.config.get(SUITE_CALL_TIMEOUT, None)
+
+  def case_timeout(self):
+    return self.config.get(SUITE_CASE_TIMEOUT, None)
+
   def __repr__(self):
     return (f'Suite("{self.name()}" selected: {self.selected()}  '
             f'enabled: {self.enabled()} cases: {self.cases})')
 
 
 class TestCase(Wrapper):
+  __slots__ = ('config', 'runner', 'cached')
 
   def __init__(self, test_config, case_filter):
     super().__init__()
-    self.config = copy.deepcopy(test_config)
+    self.config = types.MappingProxyType(test_config)
     self.runner = None
+    self.cached = False  # whether the result was replayed from a result cache
     self.selected_to_run = passes_filter(case_filter, self.name())
 
+  def copy(self) -> 'TestCase':
+    """Returns a copy sharing this case's configuration, but no results."""
+    tcase = TestCase.__new__(TestCase)
+    Wrapper.__init__(tcase)
+    tcase.config = self.config
+    tcase.runner = None
+    tcase.cached = False
+    tcase.selected_to_run = self.selected_to_run
+    return tcase
+
   def name(self):
     return self.config.get(CASE_NAME, "(missing name)")
 
   def spec(self):
     return self.config.get(CASE_SPEC, "")
 
+  def call_timeout(self):
+    return self.config.get(CASE_CALL_TIMEOUT, None)
+
+  def case_timeout(self):
+    return self.config.get(CASE_CASE_TIMEOUT, None)
+
   def __repr__(self):
     return f'Case("{self.name()}": selected: {self.selected()})'
 
+def check_timeout(timeout) -> str:
+  """Returns a description of the problem with a testplan `timeout`, if any.
+
+  A timeout may be absent (None) or else must be a positive number of seconds.
+  """
+  if timeout is None:
+    return None
+  if (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or
+      not timeout > 0):
+    return 'expected a positive number of seconds, got {!r}'.format(timeout)
+  return None
+
 def passes_filter(filter: str, name: str):
   if not filter:
     return True
-  found = re.search(filter, name)
+  found = compile_filter(filter).search(name)
   return found is not None
 
+@functools.lru_cache(maxsize=None)
+def compile_filter(filter: str):
+  """Returns the compiled regex `filter`, raising ValueError if it is invalid.
+
+  Since the same filter is applied to the name of every environment, suite or
+  test case, it is only compiled once.
+  """
+  try:
+    return re.compile(filter)
+  except re.error as e:
+    raise ValueError('invalid filter "{}": {}'.format(filter, e))
+
 
 class Visitor:
   """Visit a `Wrapper` hierarchy.
@@ -149,19 +224,28 @@ class Visitor:
   vary.
   """
 
-  # To parallelize any of these traversals, we could modify the parent visitor
-  # to return a flag determining whether parallelization is allowed. For
-  # example, visit_suite can return true to signal that the loop over testcases
-  # can be parallelized.
-
   def start_visit(self):
     return self.visit_environment, self.visit_environment_end
 
+  def parallelizable(self):
+    """Returns whether test cases may be visited concurrently.
+
+    If this returns True, `Manager` may call the function returned by
+    `visit_suite` from several threads at once, for test cases across all the
+    suites in an environment. `visit_suite_end` for each suite is still called
+    from the thread traversing that environment, and only after all of that
+    suite's test cases have been visited.
+
+    `Manager` may also traverse different environments concurrently, each in
+    its own thread, so any state shared across environments must be guarded.
+    """
+    return False
+
   def visit_environment(self, environment: Environment, doit: bool):
     return self.visit_suite, self.visit_suite_end
 
   def visit_suite(self, idx: int, suite: Suite, doit: bool):
-    return self.visit_test_case
+    return self.visit_testcase
 
   def visit_testcase(self, idx: int, testcase: TestCase, doit: bool):
     pass
@@ -220,6 +304,9 @@ class MultiVisitor(Visitor):
       if visit:
         visit(environment, doit)
 
+  def parallelizable(self):
+    return all(visitor.parallelizable() for visitor in self.visitors if visitor)
+
   def end_visit(self):
     results = [visitor.end_visit() for visitor in self.visitors]
     return all(results)
@@ -231,47 +318,233 @@ SUITE_TEARDOWN = "teardown"
 SUITE_NAME = "name"
 SUITE_SOURCE = "source"
 SUITE_CASES = "cases"
+SUITE_CALL_TIMEOUT = "call_timeout"
+SUITE_CASE_TIMEOUT = "case_timeout"
 CASE_NAME = "name"
 CASE_SPEC = "spec"
+CASE_CALL_TIMEOUT = "call_timeout"
+CASE_CASE_TIMEOUT = "case_timeout"
 
 class Manager:
   """Hosts Visitors to a Wrapper hierarchy"""
-  def __init__(self, environment_registry, test_suites, env_filter:str = None):
+  def __init__(self, environment_registry, test_suites, env_filter:str = None,
+               duration_estimator=None):
+    """Initializes Manager.
+
+    Args:
+      duration_estimator: an optional function that is passed an environment,
+        suite, and test case and returns the expected duration of that test
+        case in seconds, or None if unknown. If provided, concurrent visits
+        start the longest test cases (and environments) first, so that a long
+        test case doesn't end up being the last one to finish.
+    """
     self.test_suites = test_suites
+    self.duration_estimator = duration_estimator
 
+    if env_filter:
+      compile_filter(env_filter)
     logging.debug("envs: {}".format(environment_registry.get_names()))
     self.environments = [Environment(env, test_suites, env_filter)
                          for env in environment_registry.list()]
 
-  def accept(self, visitor: Visitor):
+  def shard(self, index: int, count: int, duration_estimator=None):
+    """Restricts the selected test cases to shard `index` of `count` shards.
+
+    The selected (environment, suite, case) triples are partitioned so that
+    every machine given the same inputs computes the same partition. Without
+    a `duration_estimator` (like the one passed to `__init__`, but which must
+    return the same estimates on every machine), cases are dealt round-robin
+    in sorted order so that each shard gets the same number of cases. With
+    one, cases are assigned longest-first to the shard with the least expected
+    total duration. Cases with no recorded duration are assumed to take the
+    median known duration.
+
+    Suites and environments left with no cases in this shard are deselected,
+    so that they are not set up at all.
+    """
+    if count < 1 or not 0 <= index < count:
+      raise ValueError('invalid shard {} of {}'.format(index, count))
+
+    selected = sorted(
+        ((env.name(), suite_num, case_num), env, suite, case)
+        for env in self.environments if env.selected()
+        for suite_num, suite in enumerate(env.suites) if suite.selected()
+        for case_num, case in enumerate(suite.cases) if case.selected())
+
+    if duration_estimator:
+      estimates = [duration_estimator(env, suite, case)
+                   for _, env, suite, case in selected]
+      known = [estimate for estimate in estimates if estimate is not None]
+      default = statistics.median(known) if known else 1.0
+      ordered = sorted(
+          zip(selected, estimates),
+          key=lambda item: (-(item[1] if item[1] is not None else default),
+                            item[0][0]))
+      loads = [(0.0, shard) for shard in range(count)]
+      assignment = []
+      for item, estimate in ordered:
+        load, shard = heapq.heappop(loads)
+        assignment.append((item, shard))
+        heapq.heappush(loads, (load + (estimate if estimate is not None
+                                       else default), shard))
+    else:
+      assignment = [(item, position % count)
+                    for position, item in enumerate(selected)]
+
+    for (_, _, _, case), shard in assignment:
+      if shard != index:
+        case.selected_to_run = False
+
+    for env in self.environments:
+      for suite in env.suites:
+        if not any(case.selected() for case in suite.cases):
+          suite.selected_to_run = False
+      if not any(suite.selected() for suite in env.suites):
+        env.selected_to_run = False
+
+  def accept(self, visitor: Visitor, jobs: int = 1, env_jobs: int = 1):
+    """Visits the Wrapper hierarchy with `visitor`.
+
+    If `visitor` is parallelizable, up to `env_jobs` environments are visited
+    concurrently, each in its own worker thread, and within each environment
+    the test cases are visited by a pool of `jobs` worker threads. Otherwise,
+    everything is visited serially, in order.
+    """
     visit_environment, visit_environment_end = visitor.start_visit()
     if not visit_environment:
       return visitor.end_visit()
 
-    run_passed = True
-    for env in self.environments:
-      do_env = env.selected()
-      visit_suite, visit_suite_end = visit_environment(env, do_env)
-      if not visit_suite:
-        continue
-
-      for suite_num, suite in enumerate(env.suites):
-        do_suite = do_env and suite.selected()
-        visit_testcase = visit_suite(suite_num, suite, do_suite)
-        if not visit_testcase:
-          continue
-
-        for idx, case in enumerate(suite.cases):
-          do_case = do_suite and case.selected()
-          visit_testcase(idx, case, do_case)
+    if (jobs > 1 or env_jobs > 1) and not visitor.parallelizable():
+      logging.debug('visitor is not parallelizable; visiting serially')
+      jobs = env_jobs = 1
+
+    if env_jobs > 1:
+      environments = self.environments
+      if self.duration_estimator:
+        environments = sorted(environments, key=self._estimate_environment,
+                              reverse=True)
+      with concurrent.futures.ThreadPoolExecutor(max_workers=env_jobs) as executor:
+        futures = [executor.submit(self._visit_environment, env,
+                                   visit_environment, visit_environment_end,
+                                   jobs)
+                   for env in environments]
+        try:
+          for future in futures:
+            future.result()
+        except BaseException:
+          for future in futures:
+            future.cancel()
+          raise
+    else:
+      for env in self.environments:
+        self._visit_environment(env, visit_environment, visit_environment_end,
+                                jobs)
 
-        if visit_suite_end is not None:
-          visit_suite_end(suite_num, suite, do_suite)
+    return visitor.end_visit()
 
-      if visit_environment_end:
-        visit_environment_end(env, do_env)
+  def _visit_environment(self, env, visit_environment, visit_environment_end,
+                         jobs):
+    do_env = env.selected()
+    visit_suite, visit_suite_end = visit_environment(env, do_env)
+    if not visit_suite:
+      return
+
+    if jobs > 1:
+      self._visit_suites_concurrently(env, do_env, visit_suite,
+                                      visit_suite_end, jobs)
+    else:
+      self._visit_suites(env, do_env, visit_suite, visit_suite_end)
+
+    if visit_environment_end:
+      visit_environment_end(env, do_env)
+
+  def _visit_suites(self, env, do_env, visit_suite, visit_suite_end):
+    for suite_num, suite in enumerate(env.suites):
+      do_suite = do_env and suite.selected()
+      visit_testcase = visit_suite(suite_num, suite, do_suite)
+      if not visit_testcase:
+        continue
 
-    return visitor.end_visit()
+      for idx, case in enumerate(suite.cases):
+        do_case = do_suite and case.selected()
+        visit_testcase(idx, case, do_case)
+
+      if visit_suite_end is not None:
+        visit_suite_end(suite_num, suite, do_suite)
+
+  def _visit_suites_concurrently(self, env, do_env, visit_suite,
+                                 visit_suite_end, jobs):
+    """Visits all the test cases in `env` using `jobs` worker threads.
+
+    All the test cases of all the suites are queued up front so that small
+    suites don't leave workers idle. If we have a `duration_estimator`, they
+    are queued longest first, which greedily balances the work across the
+    workers. Each suite is visited when the first of its cases is dequeued (so
+    that, eg, a fail-fast visitor can skip suites that have not started yet),
+    and the suite-end visits happen in suite order once each suite's cases are
+    done.
+    """
+    suite_visits = {}  # suite_num -> visit_testcase, once the suite is visited
+    lock = threading.Lock()
+
+    def visit_suite_once(suite_num):
+      with lock:
+        if suite_num not in suite_visits:
+          suite = env.suites[suite_num]
+          suite_visits[suite_num] = visit_suite(suite_num, suite,
+                                                do_env and suite.selected())
+        return suite_visits[suite_num]
+
+    def visit_case(suite_num, idx, case, do_case):
+      visit_testcase = visit_suite_once(suite_num)
+      if visit_testcase:
+        visit_testcase(idx, case, do_case)
+
+    queue = [(suite_num, idx, case,
+              do_env and suite.selected() and case.selected())
+             for suite_num, suite in enumerate(env.suites)
+             for idx, case in enumerate(suite.cases)]
+
+    if self.duration_estimator:
+      queue.sort(key=lambda item: self._estimate_case(env, env.suites[item[0]],
+                                                      item[2]),
+                 reverse=True)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+      futures = {suite_num: [] for suite_num in range(len(env.suites))}
+      for suite_num, idx, case, do_case in queue:
+        futures[suite_num].append(executor.submit(visit_case, suite_num, idx,
+                                                  case, do_case))
+
+      try:
+        for suite_num, suite in enumerate(env.suites):
+          for future in futures[suite_num]:
+            future.result()
+          # Suites without cases are only visited here.
+          if visit_suite_once(suite_num) and visit_suite_end is not None:
+            visit_suite_end(suite_num, suite, do_env and suite.selected())
+      except BaseException:
+        # Don't start any more cases (eg on KeyboardInterrupt); the ones
+        # already running finish before the executor shuts down.
+        for suite_futures in futures.values():
+          for future in suite_futures:
+            future.cancel()
+        raise
+
+  def _estimate_case(self, env, suite, case):
+    """Returns the expected duration of `case`, or infinity if unknown.
+
+    Cases without a history are treated as the longest, so that a new slow
+    case is not started last.
+    """
+    estimate = self.duration_estimator(env, suite, case)
+    return float('inf') if estimate is None else estimate
+
+  def _estimate_environment(self, env):
+    """Returns the expected duration of all the selected cases in `env`."""
+    return sum(self._estimate_case(env, suite, case)
+               for suite in env.suites if suite.selected()
+               for case in suite.cases if case.selected())
 
 
 SCHEMA = parser.SchemaDescriptor('test','samples', 1)
@@ -299,6 +572,9 @@ def suites_from_doc_list(test_docs: List[parser.Document],
                          suite_filter: str = None,
                          case_filter: str = None) -> List[Suite]:
   """Creates Suite objects from the given YAML test_docs"""
+  for filter in [suite_filter, case_filter]:
+    if filter:
+      compile_filter(filter)
   return [Suite(spec, suite_filter, case_filter) for spec in suite_configs_from(test_docs)]
 
 def suites_from(indexed_docs: parser.IndexedDocs,
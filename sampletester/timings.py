@@ -0,0 +1,112 @@
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import logging
+import os
+import tempfile
+
+from sampletester import testplan
+
+
+class Database:
+  """Stores the durations of test cases across runs.
+
+  The durations are kept in a JSON file as a nested map of environment name to
+  suite name to case name to the duration in seconds. Each newly recorded
+  duration is averaged with the previous one (weighted by `SMOOTHING`) so that
+  a single unusually fast or slow run doesn't dominate the estimate.
+  """
+
+  # The weight given to a newly recorded duration relative to the stored one.
+  SMOOTHING = 0.5
+
+  def __init__(self, path: str):
+    self.path = path
+    self.durations = {}
+
+  def load(self):
+    """Reads the durations from `self.path`, if it exists."""
+    if not os.path.exists(self.path):
+      return self
+    try:
+      with open(self.path, 'r') as stream:
+        durations = json.load(stream)
+    except (OSError, ValueError) as e:
+      logging.warning('ignoring unreadable timing database "{}": {}'
+                      .format(self.path, e))
+      return self
+    if isinstance(durations, dict):
+      self.durations = durations
+    return self
+
+  def save(self):
+    """Writes the durations to `self.path`, atomically replacing it."""
+    directory = os.path.dirname(os.path.abspath(self.path))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.timings-')
+    try:
+      with os.fdopen(fd, 'w') as stream:
+        json.dump(self.durations, stream, indent=1, sort_keys=True)
+      os.replace(temp_path, self.path)
+    except BaseException:
+      os.unlink(temp_path)
+      raise
+
+  def get(self, env_name: str, suite_name: str, case_name: str) -> float:
+    """Returns the stored duration of the case, or None if unknown."""
+    return (self.durations.get(env_name, {})
+            .get(suite_name, {})
+            .get(case_name, None))
+
+  def record(self, env_name: str, suite_name: str, case_name: str,
+             seconds: float):
+    """Records a new duration for the case."""
+    cases = self.durations.setdefault(env_name, {}).setdefault(suite_name, {})
+    previous = cases.get(case_name, None)
+    if previous is not None:
+      seconds = self.SMOOTHING * seconds + (1 - self.SMOOTHING) * previous
+    cases[case_name] = seconds
+
+  def estimate(self, environment: testplan.Environment,
+               suite: testplan.Suite, tcase: testplan.TestCase) -> float:
+    """Returns the expected duration of `tcase`, for use by testplan.Manager."""
+    return self.get(environment.name(), suite.name(), tcase.name())
+
+
+class Recorder(testplan.Visitor):
+  """Records the durations of all the test cases that ran into a Database."""
+
+  def __init__(self, database: Database):
+    self.database = database
+
+  def visit_environment(self, environment: testplan.Environment, doit: bool):
+    if not doit or not environment.attempted:
+      return None, None
+    return (lambda idx, suite, do_suite:
+            self.visit_suite(idx, suite, do_suite, environment)), None
+
+  def visit_suite(self, idx, suite: testplan.Suite, doit: bool,
+                  environment: testplan.Environment):
+    if not doit or not suite.attempted:
+      return None
+    return lambda idx, tcase, do_case: self.visit_testcase(idx, tcase, do_case,
+                                                           environment, suite)
+
+  def visit_testcase(self, idx, tcase: testplan.TestCase, doit: bool,
+                     environment: testplan.Environment, suite: testplan.Suite):
+    if not doit or not tcase.completed or tcase.cached:
+      return
+    self.database.record(environment.name(), suite.name(), tcase.name(),
+                         tcase.duration().total_seconds())
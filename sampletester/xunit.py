@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import html
+import xml.etree.ElementTree as ElementTree
 
 from sampletester import testplan
 
@@ -94,3 +95,52 @@ class Visitor(testplan.Visitor):
     self.lines.extend(lines)
     self.lines.append('</testsuites>\n')
     return '\n'.join(self.lines)
+
+
+def merge(*documents: str) -> str:
+  """Merges several xUnit `documents` (eg from different shards) into one.
+
+  The resulting `<testsuites>` element contains all the test suites of all
+  the `documents`, in order, and the sums of their failure and error counts.
+  Test suites with the same name (eg a suite whose test cases were split across
+  shards) are combined into one, which contains all their test cases and the
+  sums of their failures, errors and times, and has the earliest of their
+  timestamps.
+  """
+  merged = ElementTree.Element('testsuites')
+  suites_by_name = {}
+  num_failures = 0
+  num_errors = 0
+  for document in documents:
+    root = ElementTree.fromstring(document)
+    if root.tag != 'testsuites':
+      raise ValueError('expected <testsuites> at the top level, got <{}>'
+                       .format(root.tag))
+    num_failures += int(root.get('failures', 0))
+    num_errors += int(root.get('errors', 0))
+    for suite in root:
+      name = suite.get('name')
+      if suite.tag == 'testsuite' and name in suites_by_name:
+        merge_suite(suites_by_name[name], suite)
+        continue
+      if suite.tag == 'testsuite':
+        suites_by_name[name] = suite
+      merged.append(suite)
+  merged.set('failures', str(num_failures))
+  merged.set('errors', str(num_errors))
+  return ElementTree.tostring(merged, encoding='unicode') + '\n'
+
+
+def merge_suite(suite: ElementTree.Element, other: ElementTree.Element):
+  """Adds the test cases and counts of `other` to those of `suite`."""
+  for count in ['failures', 'errors']:
+    suite.set(count, str(int(suite.get(count, 0)) + int(other.get(count, 0))))
+  time = float(suite.get('time', 0)) + float(other.get('time', 0))
+  suite.set('time', str(round(time, 6)))
+
+  # ISO 8601 timestamps written by `Visitor` sort chronologically as strings.
+  timestamps = [timestamp for timestamp in
+                [suite.get('timestamp'), other.get('timestamp')] if timestamp]
+  if timestamps:
+    suite.set('timestamp', min(timestamps))
+  suite.extend(list(other))
@@ -13,18 +13,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import os
 import re
+import tempfile
+import threading
+import time
+import traceback
 import unittest
 import yaml
+from textwrap import dedent
+from xml.etree import ElementTree
 
 from sampletester import caserunner
 from sampletester import convention
 from sampletester import environment_registry
+from sampletester import execution
 from sampletester import inputs
 from sampletester import parser
 from sampletester import runner
 from sampletester import summary
+from sampletester import xunit
+from sampletester import testenv
 from sampletester import testplan
 
 _ABS_FILE = os.path.abspath(__file__)
@@ -119,6 +129,125 @@ class TestCaseRunner(unittest.TestCase):
                     '{}: {}'.format(message, suite_name))
 
 
+class TestCaseRunnerParallel(TestCaseRunner):
+
+  def setUp(self):
+    self.environment_registry = environment_registry.new(
+        convention.DEFAULT,
+        inputs.create_indexed_docs(
+            *full_paths('testdata/caserunner_test.manifest.yaml')))
+    self.manager = testplan.Manager(
+        self.environment_registry,
+        testplan.suites_from(
+            inputs.create_indexed_docs(
+                *full_paths('testdata/caserunner_test.yaml'))))
+    self.results = Visitor()
+    self.manager.accept(runner.Visitor(), jobs=4)
+    if self.manager.accept(self.results) is not None:
+      self.fail('error running test plan: {}'.format(self.results.error))
+
+  def test_all_completed(self):
+    for name, tcase in self.results.cases.items():
+      self.assertTrue(tcase.completed, 'expected case to complete: {}'.format(name))
+
+
+class CountingEnvironment(testenv.Base):
+  """Records the threads that set it up and tear it down.
+
+  Each setup waits at `barrier` for the other environments sharing it, so that
+  `overlapped` is only set if they are set up concurrently.
+  """
+
+  def __init__(self, name, barrier):
+    super().__init__(name)
+    self.barrier = barrier
+    self.setup_threads = []
+    self.teardown_threads = []
+    self.overlapped = False
+
+  def setup(self):
+    self.setup_threads.append(threading.get_ident())
+    try:
+      self.barrier.wait(timeout=10)
+      self.overlapped = True
+    except threading.BrokenBarrierError:
+      pass
+
+  def teardown(self):
+    self.teardown_threads.append(threading.get_ident())
+
+  def adjust_suite_name(self, name):
+    return '{}:{}'.format(name, self.name())
+
+  def adjust_case_name(self, name):
+    return '{}:{}'.format(name, self.name())
+
+
+class TestCaseRunnerEnvParallel(unittest.TestCase):
+
+  def setUp(self):
+    config = parser.IndexedDocs()
+    config.from_strings(('plan', dedent('''\
+        type: test/samples
+        schema_version: 1
+        test:
+          suites:
+          - name: Mixed
+            cases:
+            - name: passes
+              spec:
+                - log: fine
+            - name: fails
+              spec:
+                - code: abort()
+          - name: Passing
+            cases:
+            - name: passes
+              spec:
+                - log: fine
+        ''')))
+    barrier = threading.Barrier(2)
+    self.configs = [CountingEnvironment(name, barrier)
+                    for name in ['python', 'java']]
+    registry = environment_registry.Registry()
+    registry.add(*self.configs)
+    self.manager = testplan.Manager(registry, testplan.suites_from(config))
+    self.run_passed = self.manager.accept(runner.Visitor(fail_fast=False),
+                                          jobs=2, env_jobs=2)
+
+  def test_environments_set_up_in_their_workers(self):
+    main_thread = threading.get_ident()
+    for config in self.configs:
+      self.assertTrue(config.overlapped,
+                      'expected environments to run concurrently')
+      self.assertEqual(1, len(config.setup_threads), config.name())
+      self.assertEqual(config.setup_threads, config.teardown_threads,
+                       config.name())
+      self.assertNotEqual(main_thread, config.setup_threads[0], config.name())
+
+  def test_results(self):
+    self.assertFalse(self.run_passed)
+    for env in self.manager.environments:
+      self.assertTrue(env.completed, env.name())
+      self.assertEqual(1, env.num_failing_suites, env.name())
+      self.assertEqual([True, True], [suite.completed for suite in env.suites])
+      self.assertEqual([False, True], [suite.success() for suite in env.suites])
+
+    output = ElementTree.fromstring(self.manager.accept(xunit.Visitor()))
+    failures = sum(env.num_failures for env in self.manager.environments)
+    errors = sum(env.num_errors for env in self.manager.environments)
+    self.assertEqual(2, failures + errors)
+    self.assertEqual(str(failures), output.get('failures'))
+    self.assertEqual(str(errors), output.get('errors'))
+    self.assertEqual(6, len(list(output.iter('testcase'))))
+
+    summary_visitor = summary.SummaryVisitor(summary.Detail.BRIEF, True,
+                                             progress_out=io.StringIO())
+    self.manager.accept(summary_visitor)
+    self.assertIn('FAILED', summary_visitor.output())
+    self.assertNotIn('RUNNING', summary_visitor.output())
+
+
 class TestCaseRunnerSkipsCasesWhenSetupFails(unittest.TestCase):
   def setUp(self):
     self.environment_registry = environment_registry.new(
@@ -143,7 +272,7 @@ class TestCaseRunnerSkipsCasesWhenSetupFails(unittest.TestCase):
                        'expected test suite to fail: {}'.format(suite_name))
       self.assertFalse(self.results.cases[case_name].success(),
                        'expected test case to fail: {}'.format(case_name))
-      case_output = self.results.cases[case_name].runner.output
+      case_output = self.results.cases[case_name].runner.get_output()
       fname_match = self.fname_re.search(case_output)
       self.assertFalse(fname_match is None, 'could not extract filename in output:>>>\n{}\n<<<'.format(case_output))
       fname = fname_match.group(1)
@@ -183,6 +312,34 @@ class TestCaseRunnerCatchExceptions(unittest.TestCase):
     for _, tcase in self.results.cases.items():
       self.assertFalse(tcase.completed, 'keyboard interrupt should cause incomplete test case')
 
+class TestCaseRunnerFailFastParallel(unittest.TestCase):
+  def setUp(self):
+    self.environment_registry = environment_registry.new(
+        convention.DEFAULT, inputs.create_indexed_docs())
+    self.manager = testplan.Manager(
+        self.environment_registry,
+        testplan.suites_from(
+            inputs.create_indexed_docs(
+                *full_paths('testdata/caserunner_test_fail_fast.yaml'))))
+
+  def test_unrun_suite_not_attempted(self):
+    self.assertFalse(self.manager.accept(runner.Visitor(fail_fast=True),
+                                         jobs=2))
+    failing, not_run = self.manager.environments[0].suites
+    self.assertTrue(failing.completed)
+    self.assertFalse(not_run.attempted)
+    self.assertFalse(not_run.cases[0].attempted)
+
+    output = ElementTree.fromstring(self.manager.accept(xunit.Visitor()))
+    self.assertEqual(['Failing:(nolang)'], [suite.get('name')
+                                            for suite in output.iter('testsuite')])
+
+    summary_visitor = summary.SummaryVisitor(summary.Detail.BRIEF, True,
+                                             progress_out=io.StringIO())
+    self.manager.accept(summary_visitor)
+    self.assertNotIn('RUNNING', summary_visitor.output())
+
+
 class TestCaseRunnerNoMatchForCallTarget(unittest.TestCase):
   def setUp(self):
     self.environment_registry = environment_registry.new(
@@ -227,6 +384,50 @@ class TestCaseRunnerMatchesForCallTarget(unittest.TestCase):
     self.assertEqual(0, self.results.environments['alps'].num_erroring_cases,
                      "expected no error when the key name in 'call.target' is present in manifest")
 
+class TestTimeouts(unittest.TestCase):
+
+  def setUp(self):
+    self.environment_registry = environment_registry.new(
+        convention.DEFAULT,
+        inputs.create_indexed_docs(
+            *full_paths('testdata/caserunner_test_timeout.manifest.yaml')))
+    self.manager = testplan.Manager(
+        self.environment_registry,
+        testplan.suites_from(
+            inputs.create_indexed_docs(
+                *full_paths('testdata/caserunner_test_timeout.yaml'))))
+
+  def check_timeouts(self, engine):
+    start = time.monotonic()
+    self.manager.accept(runner.Visitor(engine=engine), jobs=4)
+    self.assertLess(time.monotonic() - start, 10,
+                    'timed-out processes were not killed promptly')
+
+    for env in self.manager.environments:
+      for suite in env.suites:
+        for tcase in suite.cases:
+          name = '{}:{}'.format(suite.name(), tcase.name())
+          statuses = [status for status, _ in tcase.runner.get_errors()]
+          if 'timing out' in tcase.name():
+            self.assertEqual(1, len(statuses),
+                             'expected one error for {}'.format(name))
+            self.assertTrue(statuses[0].startswith('TIMEOUT'),
+                            'expected a timeout for {}: {}'.format(name, statuses))
+          else:
+            self.assertTrue(tcase.success(),
+                            'expected {} to pass: {}'.format(name, statuses))
+
+  def test_subprocess_engine(self):
+    self.check_timeouts(execution.SubprocessEngine())
+
+  def test_asyncio_engine(self):
+    engine = execution.AsyncioEngine()
+    try:
+      self.check_timeouts(engine)
+    finally:
+      engine.close()
+
+
 class TestChdir(unittest.TestCase):
 
   def setUp(self):
@@ -267,6 +468,204 @@ class TestSymbolInterpolation(unittest.TestCase):
                      caserunner.interpolate_symbols('Want {H} or {Ur}?',
                                                     resolver))
 
+  def test_builtins(self):
+    spec = [{'log': ['case {} is {}', 'testcase_num', 'testcase_id']},
+            {'code': 'log("code sees case {}", testcase_num)\n'
+                     'assert_that(callable(assert_contains), "no builtin")'}]
+    tcase = caserunner.TestCase(testenv.Base('env'), 7, 'seven', None, spec,
+                                None)
+    self.assertNotIn('log', tcase.local_symbols)
+    self.assertEqual(0, tcase.run())
+    self.assertIn('case 7 is seven', tcase.get_output())
+    self.assertIn('code sees case 7', tcase.get_output())
+    self.assertIs(caserunner.TestCase.BUILTINS, tcase.BUILTINS)
+
+
+class TestCompileSpec(unittest.TestCase):
+  def test_compile_spec(self):
+    compiled = caserunner.compile_spec(
+        [{'log': ['hi']}, {},
+         {'call': {'sample': 'x', 'args': [{'literal': 1}]}},
+         {'env': {'name': 'HOME', 'variable': 'home'}}],
+        'sample')
+    self.assertEqual(['log', 'call', 'env'],
+                     [operation.directive for operation in compiled])
+    self.assertIs(compiled, caserunner.compile_spec(compiled))
+    self.assertEqual((), caserunner.compile_spec(''))
+
+    for invalid in [[{'nonesuch': 1}],
+                    [{'fail': None}],
+                    [{'log': ['x'], 'shell': ['y']}],
+                    [{'call': {'target': 'x'}}],
+                    [{'call': {'sample': 'x', 'args': ['y']}}],
+                    [{'assert_contains': [{'literal': 'a', 'variable': 'b'}]}],
+                    [{'extract_match': {'pattern': '(', 'variable': 'v'}}],
+                    [{'env': {'name': 'HOME'}}],
+                    [{'code': 'x = ('}],
+                    ['log'],
+                    'log']:
+      with self.assertRaises(caserunner.ConfigError, msg=str(invalid)):
+        caserunner.compile_spec(invalid, 'sample')
+
+  def test_compile_plan(self):
+    manager = testplan.Manager(
+        environment_registry.new(
+            convention.DEFAULT,
+            inputs.create_indexed_docs(
+                *full_paths('testdata/caserunner_test.manifest.yaml'))),
+        testplan.suites_from(
+            inputs.create_indexed_docs(
+                *full_paths('testdata/caserunner_test.yaml'))))
+    visitor = runner.Visitor()
+    problems = visitor.compile_plan(manager)
+    self.assertEqual(2, len(problems))
+    self.assertTrue(all('erroring extract_match' in problem
+                        for problem in problems))
+    self.assertIn('cannot accept both variables and groups', problems[1])
+    self.assertIn('syntax error', problems[0])
+
+  def test_compile_plan_timeouts(self):
+    docs = parser.IndexedDocs()
+    docs.from_strings(('timeouts.yaml', dedent('''\
+        type: test/samples
+        schema_version: 1
+        test:
+          suites:
+          - name: suite
+            source: timeouts.yaml
+            call_timeout: 10s
+            cases:
+            - name: valid
+              call_timeout: 1.5
+              case_timeout: 30
+            - name: negative
+              case_timeout: -1
+        ''')))
+    manager = testplan.Manager(
+        environment_registry.new(convention.DEFAULT,
+                                 inputs.create_indexed_docs()),
+        testplan.suites_from(docs))
+    problems = runner.Visitor().compile_plan(manager)
+    self.assertEqual(2, len(problems))
+    self.assertIn('suite "suite": invalid "call_timeout"', problems[0])
+    self.assertIn("'10s'", problems[0])
+    self.assertIn('case "negative": invalid "case_timeout"', problems[1])
+
+
+class TestCompileCode(unittest.TestCase):
+  def test_compile_code(self):
+    with tempfile.TemporaryDirectory() as directory:
+      source = os.path.join(directory, 'plan.test.yaml')
+      with open(source, 'w') as stream:
+        stream.write(dedent("""\
+            cases:
+            - name: good
+              spec:
+              - code: |
+                  x = 1
+                  raise ValueError(x)
+            - name: bad
+              spec:
+              - code: |
+                  y = 2
+                  y +
+            """))
+
+      good = caserunner.compile_code('x = 1\nraise ValueError(x)\n', source)
+      self.assertIs(good, caserunner.compile_code('x = 1\nraise ValueError(x)\n',
+                                                  source))
+      self.assertEqual(source, good.co_filename)
+      try:
+        exec(good, {})
+        self.fail('expected ValueError')
+      except ValueError as e:
+        self.assertEqual(6, traceback.extract_tb(e.__traceback__)[-1].lineno)
+
+      with self.assertRaises(caserunner.ConfigError) as raised:
+        caserunner.compile_code('y = 2\ny +\n', source)
+      self.assertIn('{}, line 11'.format(source), raised.exception.msg)
+
+      # Not found in the source: line numbers are relative to the code.
+      elsewhere = caserunner.compile_code('z = 3\n', source)
+      self.assertEqual('<code in {}>'.format(source), elsewhere.co_filename)
+
+
+class TestOutputBuffer(unittest.TestCase):
+  def test_output_buffer(self):
+    output = caserunner.OutputBuffer()
+    self.assertEqual('', output.getvalue())
+    output.write('first\n')
+    output.write('second')
+    self.assertEqual('first\nsecond', output.getvalue())
+    self.assertEqual('  | first\n  | second', output.indented(2, '| '))
+    output.write(' line')
+    self.assertEqual('first\nsecond line', str(output))
+    self.assertEqual('  | first\n  | second line', output.indented(2, '| '))
+
+
+class TestChunksContain(unittest.TestCase):
+  def test_chunks_contain(self):
+    chunks = ['It was the be', 'St of ti', 'mes']
+    self.assertTrue(caserunner.chunks_contain(chunks, 'best', False))
+    self.assertFalse(caserunner.chunks_contain(chunks, 'best', True))
+    self.assertTrue(caserunner.chunks_contain(chunks, 'beSt of times', True))
+    self.assertTrue(caserunner.chunks_contain(chunks, 't', True))
+    self.assertFalse(caserunner.chunks_contain(chunks, 'worst', False))
+    self.assertFalse(caserunner.chunks_contain([], 'best', False))
+
+  def test_chunks_contain_each(self):
+    chunks = ['It was the be', 'St of ti', 'mes']
+    self.assertEqual([True, False, True],
+                     caserunner.chunks_contain_each(
+                         chunks, ['best', 'worst', 'of times'], False))
+    self.assertEqual([False, True],
+                     caserunner.chunks_contain_each(
+                         chunks, ['best', 'beSt'], True))
+    self.assertEqual([], caserunner.chunks_contain_each(chunks, [], False))
+
+
+class TestChunksSearch(unittest.TestCase):
+  def test_chunks_search(self):
+    chunks = ['It was the be', 'st of ti', 'mes, it was']
+    regex = re.compile('best of (t[a-z]*)')
+    self.assertEqual('times', caserunner.chunks_search(regex, chunks).group(1))
+    self.assertEqual('ti', caserunner.chunks_search(regex, chunks[:2]).group(1))
+    self.assertEqual('times', caserunner.chunks_search(regex, chunks,
+                                                       max_match=16).group(1))
+    self.assertIsNone(caserunner.chunks_search(regex, chunks, max_match=4))
+    self.assertIsNone(caserunner.chunks_search(regex, []))
+
+  def test_extract_match_streaming(self):
+    tcase = caserunner.TestCase(testenv.Base('env'), 0, 'case', None, [], None,
+                                engine=execution.SubprocessEngine(
+                                    max_output_bytes=4))
+    tcase.shell('echo "id: 1234"')
+    self.assertTrue(tcase.last_capture.spilled())
+    tcase.extract_match('id: ([0-9]+)', 'head_id')
+    tcase.extract_match('id: ([0-9]+)', 'full_id', streaming=True)
+    self.assertIsNone(tcase.local_symbols['head_id'])
+    self.assertEqual('1234', tcase.local_symbols['full_id'])
+    tcase.release_last_capture()
+
+
+class TestContainChecker(unittest.TestCase):
+  def test_reports_unmet_values(self):
+    tcase = caserunner.TestCase(testenv.Base('env'), 0, 'case', None, [], None)
+    tcase.last_call_output = 'Hello, World! 42'
+
+    tcase.contain_checker(tcase.expect, all, True)('hello', 'WORLD', 42)
+    self.assertEqual([], tcase.failures)
+    self.assertEqual('hello, world! 42', tcase.folded_call_output)
+
+    tcase.contain_checker(tcase.expect, all, True)('hello', 'moon', 'mars')
+    tcase.contain_checker(tcase.expect, all, False)('moon', 'world')
+    tcase.contain_checker(tcase.expect, any, True)('Hello', 'moon',
+                                                   case_sensitive=True,
+                                                   message='custom')
+    self.assertEqual(2, len(tcase.failures))
+    self.assertTrue(tcase.failures[0][1].endswith("(missing: ['moon', 'mars'])"))
+    self.assertTrue(tcase.failures[1][1].endswith("(found: ['world'])"))
+
 
 def full_paths(*leaf_path):
   return [os.path.join(_ABS_DIR, path) for path in leaf_path]
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import tempfile
 import unittest
 
 from sampletester import inputs
@@ -23,6 +24,28 @@ from sampletester import sample_manifest
 _ABS_FILE = os.path.abspath(__file__)
 _ABS_DIR = os.path.dirname(_ABS_FILE)
 
+class TestManifestSnapshot(unittest.TestCase):
+  def test_snapshot_skips_parsing_manifests(self):
+    with tempfile.TemporaryDirectory() as directory:
+      manifest_path = os.path.join(directory, 'samples.manifest.yaml')
+      testplan_path = os.path.join(directory, 'samples.yaml')
+      snapshot_path = os.path.join(directory, 'manifest.snapshot')
+      with open(manifest_path, 'w') as stream:
+        stream.write('type: manifest/samples\nschema_version: 3\n'
+                     'samples:\n- sample: alice\n  path: /{sample}.py\n')
+      with open(testplan_path, 'w') as stream:
+        stream.write('type: test/samples\nschema_version: 1\n'
+                     'test:\n  suites: []\n')
+      tag.compile_manifest(inputs.index_docs(manifest_path, testplan_path),
+                           ['sample'], snapshot_path)
+
+      indexed_docs = inputs.index_docs(manifest_path, testplan_path)
+      manifest = tag.build_manifest(indexed_docs, ['sample'], snapshot_path)
+      self.assertEqual('/alice.py', manifest.get_one('', 'alice')['path'])
+      self.assertNotIn(os.path.abspath(manifest_path),
+                       indexed_docs.parsed_paths)
+
+
 class TestSubstitution(unittest.TestCase):
   def test_substitution(self):
     self.assertEqual('hi there',        tag.insert_into('hi there',         ('@here', 'foo')))
@@ -37,6 +60,78 @@ class TestSubstitution(unittest.TestCase):
     self.assertRaises(tag.InternalInvalidPlaceholderDefinition,
                       tag.insert_into, 'hi @here', ('$here', 'foo'))
 
+  def test_template(self):
+    template = tag.Template('run @@@args @@x @args @there', ['@args', '@argsx'])
+    self.assertEqual(['run @', '', ' @x ', '', ' @there'], template.parts)
+    self.assertEqual(['@there'], template.unknown_placeholders)
+    self.assertEqual('run @1 @x 1 @there', template.render({'@args': '1'}))
+    self.assertIs(tag.compile_invocation('a @args'),
+                  tag.compile_invocation('a @args'))
+
+  def test_check_invocations(self):
+    self.assertRaises(sample_manifest.ManifestSyntaxError,
+                      tag.compile_invocation, ['not', 'a', 'string'])
+
+    manifest = sample_manifest.Manifest('sample')
+    manifest.read_sources([('typo', {'type': 'manifest/samples',
+                                     'schema_version': 3,
+                                     'samples': [{'sample': 'typo',
+                                                  'invocation': 'run @arg'}]},
+                            {})])
+    manifest.index()
+    with self.assertLogs(level='WARNING') as logs:
+      tag.check_invocations(manifest, 'invocation')
+    self.assertIn("['@arg']", logs.output[0])
+
+    manifest = sample_manifest.Manifest('sample')
+    sample = {'sample': 'other', 'execution': 'remote',
+              tag.EXECUTION_KEY: 'python-poll'}
+    manifest.read_sources([('other', {'type': 'manifest/samples',
+                                      'schema_version': 3,
+                                      'samples': [sample]},
+                            {})])
+    manifest.index()
+    with self.assertLogs(level='WARNING') as logs:
+      tag.check_invocations(manifest, 'invocation')
+    self.assertEqual(1, len(logs.output))
+    self.assertIn('python-poll', logs.output[0])
+
+    for sample in [{'sample': 'bad-timeout', 'timeout': '10s'},
+                   {'sample': 'zero-timeout', 'timeout': 0},
+                   {'sample': 'no-path', tag.EXECUTION_KEY: 'python-pool',
+                    'invocation': 'python3 x.py @args'},
+                   {'sample': 'no-python', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'invocation': 'cd /x && python3 x.py'},
+                   {'sample': 'fixed-args', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'invocation': 'python3 x.py -v @args'},
+                   {'sample': 'flags', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'invocation': 'python3 -u x.py @args'},
+                   {'sample': 'other-path', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'invocation': 'python3 y.py @args'},
+                   {'sample': 'bin-flags', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'bin': 'python3 -u'}]:
+      manifest = sample_manifest.Manifest('sample')
+      manifest.read_sources([('execution', {'type': 'manifest/samples',
+                                            'schema_version': 3,
+                                            'samples': [sample]},
+                              {})])
+      manifest.index()
+      with self.assertRaises(sample_manifest.ManifestSyntaxError,
+                             msg=sample['sample']):
+        tag.check_invocations(manifest, 'invocation')
+
+    for sample in [{'sample': 'invocation', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'invocation': "'python3' x.py @args"},
+                   {'sample': 'bin', tag.EXECUTION_KEY: 'python-pool',
+                    'path': 'x.py', 'bin': '/venv/bin/python'}]:
+      manifest = sample_manifest.Manifest('sample')
+      manifest.read_sources([('execution', {'type': 'manifest/samples',
+                                            'schema_version': 3,
+                                            'samples': [sample]},
+                              {})])
+      manifest.index()
+      tag.check_invocations(manifest, 'invocation')
+
 class TestArgSubstitution(unittest.TestCase):
   def setUp(self):
     filename = full_path('testdata/tag_test.manifest.yaml')
@@ -115,6 +210,53 @@ class TestArgSubstitution(unittest.TestCase):
                       self.get_call_only, 'no-object-with-this-value',
                       person='Bob')
 
+  def test_resolves_each_target_once(self):
+    lookups = []
+    get_one = self.env.manifest.get_one
+    def counting_get_one(*indices, **filters):
+      lookups.append(indices)
+      return get_one(*indices, **filters)
+    self.env.manifest.get_one = counting_get_one
+
+    self.assertEqual('Mexico is a country "--continent=NorthAmerica"',
+                     self.get_call_only('invocation-via-just-path',
+                                        '--continent=NorthAmerica'))
+    self.assertEqual('Mexico is a country --continent="Oceania"',
+                     self.get_call_only('invocation-via-just-path',
+                                        continent='Oceania'))
+    self.assertIsNone(self.env.get_call_timeout('invocation-via-just-path'))
+    self.assertEqual([('invocation-via-just-path',)], lookups)
+
+  def test_call_script(self):
+    self.assertEqual(('python3', 'sample.py',
+                      ['--color=blue', '--continent=South America']),
+                     self.env.get_call_script('python-pool',
+                                              '--continent=South America',
+                                              color='blue'))
+    self.assertEqual('python3 sample.py --color="blue"',
+                     self.get_call_only('python-pool', color='blue'))
+    self.assertIsNone(self.env.get_call_script('simple'))
+
+  def test_parse_timeout(self):
+    self.assertIsNone(tag.parse_timeout(None))
+    self.assertEqual(30.0, tag.parse_timeout('30'))
+    self.assertEqual(0.5, tag.parse_timeout(0.5))
+    for invalid in ['10s', '-1', 0, True, ['1']]:
+      self.assertRaises(ValueError, tag.parse_timeout, invalid)
+
+  def test_python_interpreter(self):
+    for expected, artifact in [
+        ('python3', {'invocation': 'python3 x.py @args'}),
+        ('/venv/bin/python', {'invocation': '/venv/bin/python -u x.py'}),
+        ('python3.7', {'bin': 'python3.7', 'path': 'x.py'}),
+        ('python', {'invocation': 'python x.py', 'bin': 'node'}),
+        (None, {'invocation': 'node x.js', 'bin': 'python'}),
+        (None, {'invocation': 'cd /x && python3 x.py'}),
+        (None, {'invocation': '"python3 x.py'}),
+        (None, {'path': 'x.py'})]:
+      self.assertEqual(expected, tag.python_interpreter(artifact, 'invocation'),
+                       msg=str(artifact))
+
 class TestChangingInvocationKey(unittest.TestCase):
   def setUp(self):
     filename = full_path('testdata/tag_test.manifest.yaml')
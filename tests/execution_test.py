@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import os
+import sys
+import tempfile
+import time
+import unittest
+from textwrap import dedent
+
+from sampletester import execution
+
+_ABS_FILE = os.path.abspath(__file__)
+_ABS_DIR = os.path.dirname(_ABS_FILE)
+
+
+class EngineTests:
+  """Tests common to all engines. Subclasses set `self.engine` in `setUp`."""
+
+  def tearDown(self):
+    self.engine.close()
+
+  def test_success(self):
+    return_code, capture = self.engine.run('echo "hello" && echo "oops" >&2')
+    self.assertEqual(0, return_code)
+    self.assertEqual(b'hello\noops\n', capture.getvalue())
+
+  def test_failure(self):
+    return_code, capture = self.engine.run('echo "goodbye"; exit 3')
+    self.assertEqual(3, return_code)
+    self.assertEqual(b'goodbye\n', capture.getvalue())
+
+  def test_cwd(self):
+    _, capture = self.engine.run('pwd', _ABS_DIR)
+    self.assertEqual(os.path.realpath(_ABS_DIR),
+                     os.path.realpath(capture.head_text().strip()))
+
+  def test_concurrent_calls(self):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+      futures = [executor.submit(self.engine.run, 'echo {}'.format(idx))
+                 for idx in range(16)]
+      results = [(return_code, capture.getvalue())
+                 for return_code, capture in
+                 [future.result() for future in futures]]
+    self.assertEqual([(0, '{}\n'.format(idx).encode('utf-8'))
+                      for idx in range(16)],
+                     results)
+
+  def test_bounded_capture(self):
+    self.engine.max_output_bytes = 1000
+    return_code, capture = self.engine.run(
+        'head -c 300000 /dev/zero | tr "\\0" "x"')
+    self.assertEqual(0, return_code)
+    self.assertTrue(capture.spilled())
+    self.assertEqual(1000, len(capture.head()))
+    self.assertEqual(300000, capture.size)
+    self.assertEqual(b'x' * 300000, capture.getvalue())
+    capture.close()
+
+  def test_timeout_with_background_child(self):
+    # The shell exits at once, but its child keeps the output pipe open.
+    start = time.monotonic()
+    with self.assertRaises(execution.TimeoutExpired):
+      self.engine.run('sleep 30 & echo hi', timeout=1)
+    self.assertLess(time.monotonic() - start, 10)
+
+
+class TestSubprocessEngine(EngineTests, unittest.TestCase):
+  def setUp(self):
+    self.engine = execution.new('subprocess')
+
+
+class TestAsyncioEngine(EngineTests, unittest.TestCase):
+  def setUp(self):
+    self.engine = execution.new('asyncio')
+
+
+class TestCapture(unittest.TestCase):
+  def test_unbounded(self):
+    capture = execution.Capture()
+    capture.write(b'abc')
+    capture.write(b'def')
+    self.assertFalse(capture.spilled())
+    self.assertEqual(b'abcdef', capture.head())
+    self.assertEqual('abcdef', capture.head_text())
+    self.assertEqual(6, capture.size)
+
+  def test_spill(self):
+    capture = execution.Capture(max_bytes=4)
+    capture.write(b'ab')
+    capture.write(b'cdef')
+    capture.write(b'gh')
+    self.assertTrue(capture.spilled())
+    self.assertEqual(b'abcd', capture.head())
+    self.assertEqual(b'abcdefgh', capture.getvalue())
+    self.assertEqual(['abcd', 'efgh'], list(capture.text_chunks()))
+    capture.close()
+
+  def test_spill_splits_character(self):
+    capture = execution.Capture(max_bytes=2)
+    capture.write('aé'.encode('utf-8'))
+    self.assertEqual('a', capture.head_text())
+    self.assertEqual('aé', ''.join(capture.text_chunks()))
+    capture.close()
+
+
+class TestPythonPool(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.script = os.path.join(self.directory.name, 'sample.py')
+    with open(self.script, 'w') as script:
+      script.write(dedent("""\
+          import os
+          import sys
+          import json
+
+          # Preloaded modules are imported, but not modified by other scripts.
+          print(json.__name__, getattr(json, 'touched', False))
+          json.touched = True
+          print(os.path.basename(os.getcwd()), sys.argv[1:])
+          print('oops', file=sys.stderr)
+          if len(sys.argv) > 1 and sys.argv[1] == 'sleep':
+            import time
+            time.sleep(60)
+          sys.exit(len(sys.argv) - 1)
+          """))
+    self.pool = execution.PythonPool(2, ['json'])
+
+  def tearDown(self):
+    self.pool.close()
+    self.directory.cleanup()
+
+  def test_run(self):
+    for _ in range(2):
+      return_code, capture = self.pool.run(sys.executable, self.script, ['a b', 'c'],
+                                           self.directory.name)
+      self.assertEqual(2, return_code)
+      self.assertEqual(
+          "json False\n{} ['a b', 'c']\noops\n"
+          .format(os.path.basename(self.directory.name)),
+          capture.head_text())
+    self.assertEqual(1, len(self.pool._workers))
+
+  def test_sys_path(self):
+    script = os.path.join(self.directory.name, 'path.py')
+    with open(script, 'w') as stream:
+      stream.write(dedent("""\
+          import importlib.util
+          import sys
+          print(sys.path[0])
+          print(importlib.util.find_spec('pyworker'))
+          """))
+    return_code, capture = self.pool.run(sys.executable, script, [])
+    self.assertEqual(0, return_code)
+    self.assertEqual('{}\nNone\n'.format(self.directory.name),
+                     capture.head_text())
+
+  def test_concurrent_runs(self):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+      futures = [executor.submit(self.pool.run, sys.executable, self.script, [str(idx)])
+                 for idx in range(8)]
+      results = [future.result() for future in futures]
+    for idx, (return_code, capture) in enumerate(results):
+      self.assertEqual(1, return_code)
+      self.assertIn("['{}']".format(idx), capture.head_text())
+    self.assertEqual(2, len(self.pool._workers))
+
+  def test_timeout(self):
+    with self.assertRaises(execution.TimeoutExpired) as raised:
+      self.pool.run(sys.executable, self.script, ['sleep'], timeout=0.5)
+    self.assertIn('oops', raised.exception.capture.head_text())
+    return_code, _ = self.pool.run(sys.executable, self.script, [])
+    self.assertEqual(0, return_code)
+
+  def test_engine(self):
+    engine = execution.new('subprocess', python_pool=self.pool)
+    return_code, capture = engine.run_python('false', sys.executable, self.script, [])
+    self.assertEqual(0, return_code)
+    self.assertIn('json False', capture.head_text())
+
+    engine = execution.new('subprocess')
+    return_code, _ = engine.run_python('false', sys.executable, self.script, [])
+    self.assertEqual(1, return_code)
+
+  def test_bad_preload(self):
+    pool = execution.PythonPool(1, ['no_such_module_here'])
+    self.assertRaises(execution.PythonPoolError, pool.run, sys.executable,
+                      self.script, [])
+    self.assertEqual([], pool._workers)
+
+    # Callers waiting for the failed worker's slot retry, rather than hang.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+      futures = [executor.submit(pool.run, sys.executable, self.script, [])
+                 for _ in range(3)]
+      for future in futures:
+        self.assertIsInstance(future.exception(timeout=60),
+                              execution.PythonPoolError)
+    self.assertEqual(0, pool._num_workers)
+
+  def test_interpreters(self):
+    link = os.path.join(self.directory.name, 'python3')
+    os.symlink(sys.executable, link)
+    pool = execution.PythonPool(1)
+    try:
+      for interpreter in [sys.executable, link, sys.executable]:
+        return_code, _ = pool.run(interpreter, self.script, [])
+        self.assertEqual(0, return_code)
+        self.assertEqual([interpreter],
+                         [worker.interpreter for worker in pool._workers])
+      self.assertRaises(execution.PythonPoolError, pool.run,
+                        os.path.join(self.directory.name, 'nonesuch'),
+                        self.script, [])
+      self.assertEqual(0, pool._num_workers)
+    finally:
+      pool.close()
+
+
+class TestNew(unittest.TestCase):
+  def test_unknown_engine(self):
+    self.assertRaises(ValueError, execution.new, 'carrier-pigeon')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import os
+import tempfile
 import unittest
 
 from contextlib import contextmanager
@@ -35,6 +36,25 @@ class TestInputs(unittest.TestCase):
                       inputs.untyped_yaml_resolver(
                           parser.Document('path/to/some.txt', None)))
 
+  def test_find_yaml_files(self):
+    with pushd(os.path.join(_ABS_DIR, 'testdata', 'inputs')):
+      self.assertEqual(inputs.get_globbed('**/*.yaml'),
+                       inputs.find_yaml_files(''))
+      self.assertEqual(inputs.get_globbed('configs/**/*.yaml'),
+                       inputs.find_yaml_files('configs'))
+      self.assertEqual(inputs.get_globbed('multidocs/*.yaml'),
+                       inputs.find_yaml_files('', prune={'configs',
+                                                         'alternate-configs'}))
+
+    with tempfile.TemporaryDirectory() as directory:
+      for subdirectory in ['.git', 'node_modules', 'plans']:
+        os.makedirs(os.path.join(directory, subdirectory))
+        with open(os.path.join(directory, subdirectory, 'a.yaml'), 'w'):
+          pass
+      os.symlink(directory, os.path.join(directory, 'plans', 'loop'))
+      self.assertEqual({os.path.join(directory, 'plans', 'a.yaml')},
+                       inputs.find_yaml_files(directory))
+
   def test_get_globbed(self):
     with pushd(os.path.join(_ABS_DIR, 'testdata', 'inputs')):
       self.assertEquals(set(), inputs.get_globbed())
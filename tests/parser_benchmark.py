@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times parser.IndexedDocs.from_files on a generated corpus of manifests.
+
+Usage: python3 -m tests.parser_benchmark [--files=N] [--samples=N] [--jobs=N]
+
+This is not run as part of the unit tests.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import yaml
+
+from sampletester import parser
+
+MANIFEST_TEMPLATE = """\
+type: manifest/samples
+schema_version: 3
+base: &common
+  env: '{language}'
+  bin: '{language} run'
+  chdir: '{{@path:/workspace}}'
+samples:
+{samples}
+"""
+
+SAMPLE_TEMPLATE = """\
+- <<: *common
+  path: '{{base_path}}/sample_{idx}.{language}'
+  sample: 'sample_{file}_{idx}'
+  region_tag: 'region_{file}_{idx}'
+  invocation: '{{bin}} {{path}} @args'
+  description: "Sample number {idx} in file {file}, with some padding text"
+"""
+
+
+def write_corpus(directory: str, num_files: int, samples_per_file: int):
+  paths = []
+  for file_idx in range(num_files):
+    language = ['python', 'java', 'node', 'ruby'][file_idx % 4]
+    samples = ''.join(SAMPLE_TEMPLATE.format(idx=idx, file=file_idx,
+                                             language=language)
+                      for idx in range(samples_per_file))
+    path = os.path.join(directory, 'corpus_{}.manifest.yaml'.format(file_idx))
+    with open(path, 'w') as stream:
+      stream.write(MANIFEST_TEMPLATE.format(language=language, samples=samples))
+    paths.append(path)
+  return paths
+
+
+def time_from_files(paths, loader, jobs: int) -> float:
+  parser.SafeLoader = loader
+  start = time.perf_counter()
+  parser.IndexedDocs().from_files(*paths, jobs=jobs)
+  return time.perf_counter() - start
+
+
+def main():
+  cli = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  cli.add_argument('--files', type=int, default=400)
+  cli.add_argument('--samples', type=int, default=50)
+  cli.add_argument('--jobs', type=int, default=os.cpu_count() or 1)
+  args = cli.parse_args()
+
+  default_loader = parser.SafeLoader
+  cases = [('pure-Python loader, serial', yaml.SafeLoader, 1)]
+  if hasattr(yaml, 'CSafeLoader'):
+    cases.append(('libyaml loader, serial', yaml.CSafeLoader, 1))
+  cases.append(('default loader, {} jobs'.format(args.jobs), default_loader,
+                args.jobs))
+
+  with tempfile.TemporaryDirectory() as directory:
+    paths = write_corpus(directory, args.files, args.samples)
+    print('{} files with {} samples each'.format(args.files, args.samples))
+    baseline = None
+    for description, loader, jobs in cases:
+      seconds = time_from_files(paths, loader, jobs)
+      baseline = baseline or seconds
+      print('  {:32s} {:7.3f}s  ({:.1f}x)'.format(description, seconds,
+                                                   baseline / seconds))
+  parser.SafeLoader = default_loader
+
+
+if __name__ == '__main__':
+  main()
@@ -13,6 +13,8 @@
 # limitations under the License.
 
 import os
+import tempfile
+import time
 import unittest
 
 from contextlib import contextmanager
@@ -31,6 +33,164 @@ class TestParser(unittest.TestCase):
       self.assertEquals({'configs/zebra_m.yaml'},
                         parser.only_files_in({'configs/zebra_m.yaml'}))
 
+  def test_from_files_in_parallel(self):
+    with tempfile.TemporaryDirectory() as directory:
+      paths = []
+      for idx in range(6):
+        path = os.path.join(directory, 'file{}.yaml'.format(idx))
+        with open(path, 'w') as stream:
+          stream.write('type: manifest/samples\nidx: {}\n'.format(idx))
+        paths.append(path)
+
+      serial = parser.IndexedDocs()
+      serial.from_files(*reversed(paths))
+      parallel = parser.IndexedDocs()
+      parallel.from_files(*paths, jobs=3)
+
+      self.assertEqual(list(range(6)),
+                       [doc.obj['idx'] for doc in parallel.of_type('manifest')])
+      self.assertEqual(serial.of_type('manifest'),
+                       parallel.of_type('manifest'))
+
+  def test_sniff_types(self):
+    self.assertEqual(['manifest/samples', None, None, None],
+                     parser.sniff_types('nested: {type: x}\n'
+                                        'type: manifest/samples\n'
+                                        '---\n'
+                                        '- type: test/samples\n'
+                                        '---\n'
+                                        'type: 3\n'
+                                        '---\n'
+                                        'type: [test]\n'))
+    self.assertEqual([parser.SNIFFED_TYPE_UNKNOWN, parser.SNIFFED_TYPE_UNKNOWN],
+                     parser.sniff_types('a: &t test\n'
+                                        'type: *t\n'
+                                        '---\n'
+                                        '<<: {type: test}\n'))
+
+  def test_lazy_parsing(self):
+    with tempfile.TemporaryDirectory() as directory:
+      contents = {'plan.yaml': 'type: test/samples\n',
+                  'samples.yaml': 'type: manifest/samples\n',
+                  'ci.yaml': 'steps: [build]\n',
+                  'both.yaml': 'type: manifest/samples\n---\ntype: test\n'}
+      for name, content in contents.items():
+        with open(os.path.join(directory, name), 'w') as stream:
+          stream.write(content)
+
+      parsed = []
+      original_parse = parser.parse
+      def counting_parse(content, file_name):
+        parsed.append(os.path.basename(file_name))
+        return original_parse(content, file_name)
+      parser.parse = counting_parse
+      self.addCleanup(setattr, parser, 'parse', original_parse)
+
+      indexed = parser.IndexedDocs(resolver=lambda doc: 'other', lazy=True)
+      indexed.from_files(*[os.path.join(directory, name) for name in contents])
+      self.assertEqual([], parsed)
+      self.assertTrue(indexed.contains('manifest', 'test', 'other'))
+
+      self.assertEqual(['both.yaml', 'samples.yaml'],
+                       [os.path.basename(doc.path)
+                        for doc in indexed.of_type('manifest')])
+      self.assertEqual(['both.yaml', 'samples.yaml'], parsed)
+
+      self.assertEqual(['both.yaml', 'plan.yaml'],
+                       [os.path.basename(doc.path)
+                        for doc in indexed.of_type('test')])
+      self.assertEqual(['both.yaml', 'samples.yaml', 'plan.yaml'], parsed)
+      self.assertEqual(['ci.yaml'], [os.path.basename(doc.path)
+                                     for doc in indexed.of_type('other')])
+
+  def test_lazy_parsing_in_parallel(self):
+    with tempfile.TemporaryDirectory() as directory:
+      paths = []
+      for idx in range(2):
+        path = os.path.join(directory, 'file{}.manifest.yaml'.format(idx))
+        with open(path, 'w') as stream:
+          stream.write('base: &base {{type: manifest/samples}}\n'
+                       '<<: *base\n'
+                       'idx: {}\n'.format(idx))
+        paths.append(path)
+
+      indexed = parser.IndexedDocs(lazy=True)
+      indexed.from_files(*paths, jobs=2)
+      self.assertEqual([0, 1],
+                       [doc.obj['idx'] for doc in indexed.of_type('manifest')])
+
+
+class TestParseCache(unittest.TestCase):
+  def setUp(self):
+    self.tempdir = tempfile.TemporaryDirectory()
+    self.cache = parser.ParseCache(os.path.join(self.tempdir.name, 'cache'))
+    self.path = os.path.join(self.tempdir.name, 'plan.yaml')
+    self.write('type: test/samples\n---\ntype: manifest/samples\n')
+
+    self.parsed = []
+    original_parse = parser.parse
+    def counting_parse(content, file_name):
+      self.parsed.append(file_name)
+      return original_parse(content, file_name)
+    parser.parse = counting_parse
+    self.addCleanup(setattr, parser, 'parse', original_parse)
+
+  def tearDown(self):
+    self.tempdir.cleanup()
+
+  def write(self, content, mtime_offset=0):
+    with open(self.path, 'w') as stream:
+      stream.write(content)
+    stat = os.stat(self.path)
+    os.utime(self.path, ns=(stat.st_atime_ns,
+                            stat.st_mtime_ns + mtime_offset * 1000000000))
+
+  def index(self):
+    indexed = parser.IndexedDocs(parse_cache=self.cache)
+    indexed.from_files(self.path)
+    return indexed
+
+  def test_unchanged_file_is_not_parsed_again(self):
+    first = self.index()
+    second = self.index()
+    self.assertEqual([self.path], self.parsed)
+    for type_name in ['test', 'manifest']:
+      self.assertEqual(first.of_type(type_name), second.of_type(type_name))
+
+  def test_touched_file_is_not_parsed_again(self):
+    self.index()
+    self.write('type: test/samples\n---\ntype: manifest/samples\n', 5)
+    self.assertEqual(1, len(self.index().of_type('manifest')))
+    self.assertEqual([self.path], self.parsed)
+
+  def test_changed_file_is_parsed_again(self):
+    self.index()
+    self.write('type: test/samples\n', 5)
+    indexed = self.index()
+    self.assertEqual(2, len(self.parsed))
+    self.assertEqual([], indexed.of_type('manifest'))
+    self.assertEqual(1, len(indexed.of_type('test')))
+
+  def test_evict(self):
+    self.index()
+    entry_path = self.cache._entry_path(self.path)
+    long_ago = time.time() - 3600
+    os.utime(entry_path, (long_ago, long_ago))
+
+    self.cache.max_age = 60
+    self.cache.evict()
+    self.assertFalse(os.path.exists(entry_path))
+
+    self.index()
+    os.utime(entry_path, (long_ago, long_ago))
+    self.index()  # marks the entry as recently used
+    self.cache.evict()
+    self.assertTrue(os.path.exists(entry_path))
+    self.assertEqual(2, len(self.parsed))
+
+    self.cache.max_bytes = 0
+    self.cache.evict()
+    self.assertFalse(os.path.exists(entry_path))
 
 
 @contextmanager
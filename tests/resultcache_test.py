@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import time
+import unittest
+import yaml
+
+from sampletester import environment_registry
+from sampletester import parser
+from sampletester import resultcache
+from sampletester import runner
+from sampletester import testenv
+from sampletester import testplan
+
+
+class SampleEnvironment(testenv.Base):
+  """Calls `sh` on the script named by the call target, in `directory`."""
+
+  def __init__(self, directory):
+    super().__init__('sample-env')
+    self.directory = directory
+
+  def get_call(self, target, *args, **kwargs):
+    return 'sh {}'.format(target), self.directory
+
+  def get_testcase_settings(self):
+    return {}
+
+
+class TestResultCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.TemporaryDirectory()
+    self.sample_dir = os.path.join(self.tempdir.name, 'samples')
+    os.makedirs(self.sample_dir)
+    self.counter = os.path.join(self.tempdir.name, 'runs')
+    self.write_sample('echo hello; echo run >> {}'.format(self.counter))
+    self.cache = resultcache.ResultCache(os.path.join(self.tempdir.name,
+                                                      'cache'))
+    self.environment = SampleEnvironment(self.sample_dir)
+
+  def tearDown(self):
+    self.tempdir.cleanup()
+
+  def write_sample(self, contents):
+    path = os.path.join(self.sample_dir, 'sample.sh')
+    with open(path, 'w') as stream:
+      stream.write(contents + '\n')
+    # Make sure the modification time changes even on coarse clocks.
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+  def run_plan(self, spec):
+    registry = environment_registry.Registry()
+    registry.add(self.environment)
+    config = parser.IndexedDocs()
+    config.from_strings(('plan', yaml.dump({
+        'type': 'test/samples',
+        'schema_version': 1,
+        'test': {'suites': [{'name': 'suite',
+                             'cases': [{'name': 'case', 'spec': spec}]}]}})))
+    suites = testplan.suites_from(config)
+    manager = testplan.Manager(registry, suites)
+    visitor = runner.Visitor(result_cache=self.cache)
+    success = manager.accept(visitor)
+    tcase = manager.environments[0].suites[0].cases[0]
+    return success, tcase
+
+  def count_runs(self):
+    if not os.path.exists(self.counter):
+      return 0
+    with open(self.counter) as stream:
+      return len(stream.readlines())
+
+  def test_replays_unchanged_passing_case(self):
+    spec = [{'call': {'target': 'sample.sh'}},
+            {'assert_contains': [{'literal': 'hello'}]}]
+    success, tcase = self.run_plan(spec)
+    self.assertTrue(success)
+    self.assertFalse(tcase.cached)
+    self.assertEqual(1, self.count_runs())
+
+    success, tcase = self.run_plan(spec)
+    self.assertTrue(success)
+    self.assertTrue(tcase.cached)
+    self.assertEqual(1, self.count_runs())
+    self.assertIn('hello', tcase.runner.get_output())
+
+  def test_reruns_when_sample_changes(self):
+    spec = [{'call': {'target': 'sample.sh'}}]
+    self.run_plan(spec)
+    self.write_sample('echo bye; echo run >> {}'.format(self.counter))
+    success, tcase = self.run_plan(spec)
+    self.assertTrue(success)
+    self.assertFalse(tcase.cached)
+    self.assertEqual(2, self.count_runs())
+
+  def test_reruns_when_spec_changes(self):
+    self.run_plan([{'call': {'target': 'sample.sh'}}])
+    _, tcase = self.run_plan([{'call': {'target': 'sample.sh'}},
+                              {'log': 'again'}])
+    self.assertFalse(tcase.cached)
+    self.assertEqual(2, self.count_runs())
+
+  def test_does_not_cache_failures(self):
+    spec = [{'call': {'target': 'sample.sh'}},
+            {'assert_contains': [{'literal': 'goodbye'}]}]
+    self.run_plan(spec)
+    success, tcase = self.run_plan(spec)
+    self.assertFalse(success)
+    self.assertFalse(tcase.cached)
+    self.assertEqual(2, self.count_runs())
+
+  def test_does_not_cache_code(self):
+    self.assertIsNone(self.cache.key(self.environment, None,
+                                     [{'code': 'pass'}], None))
+    self.assertIsNone(self.cache.key(self.environment, None,
+                                     [{'shell': 'true'}], None))
+
+  def test_evict(self):
+    old_key, new_key = 'a' * 64, 'b' * 64
+    self.cache.put(old_key, 'old', 1)
+    self.cache.put(new_key, 'new', 1)
+    old_path = self.cache._path(old_key)
+    long_ago = time.time() - 3600
+    os.utime(old_path, (long_ago, long_ago))
+
+    self.cache.max_age = 60
+    self.cache.evict()
+    self.assertIsNone(self.cache.get(old_key))
+    self.assertEqual('new', self.cache.get(new_key)['output'])
+
+    self.cache.max_bytes = 0
+    self.cache.evict()
+    self.assertIsNone(self.cache.get(new_key))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import os
+import tempfile
 import unittest
 
 from sampletester import inputs
@@ -118,6 +119,52 @@ who: dan
       math.remove(x)
     self.assertEqual(0, len(math))
 
+  def test_get_filter_indices(self):
+    manifest_source, (expect_alice, expect_bob, expect_carol,
+                      expect_dan) = self.get_manifest_source()
+    manifest = sample_manifest.Manifest('language', 'sample')
+    manifest.read_sources([manifest_source])
+    manifest.index()
+
+    self.assertEqual([expect_dan],
+                     manifest.get('', 'math', path='/tmp/newest/dan'))
+    self.assertIn((('', 'math'), 'path'), manifest.filter_indices)
+    self.assertEqual([], manifest.get('', 'math', path=['unhashable']))
+
+    manifest_source[1]['mysamples'][3]['path'] = '/tmp/moved/dan'
+    manifest.index()
+    self.assertEqual({}, manifest.filter_indices)
+    self.assertEqual([], manifest.get('', 'math', path='/tmp/newest/dan'))
+    self.assertEqual(1, len(manifest.get('', 'math', path='/tmp/moved/dan')))
+
+  def test_snapshot(self):
+    with tempfile.TemporaryDirectory() as directory:
+      manifest_path = os.path.join(directory, 'samples.manifest.yaml')
+      snapshot_path = os.path.join(directory, 'manifest.snapshot')
+      with open(manifest_path, 'w') as stream:
+        stream.write('type: manifest/samples\nschema_version: 3\n'
+                     'samples:\n- sample: alice\n  path: /{sample}.py\n')
+      indexed_docs = parser.IndexedDocs()
+      indexed_docs.from_files(manifest_path)
+
+      manifest = sample_manifest.Manifest('sample')
+      manifest.from_docs(indexed_docs)
+      manifest.index()
+      manifest.write_snapshot(snapshot_path, [manifest_path])
+
+      loaded = sample_manifest.Manifest('sample')
+      self.assertTrue(loaded.read_snapshot(snapshot_path, [manifest_path]))
+      self.assertEqual('/alice.py', loaded.get_one('alice')['path'])
+
+      self.assertFalse(sample_manifest.Manifest('path').read_snapshot(
+          snapshot_path, [manifest_path]))
+      self.assertFalse(sample_manifest.Manifest('sample').read_snapshot(
+          snapshot_path, [manifest_path, snapshot_path]))
+      with open(manifest_path, 'a') as stream:
+        stream.write('- sample: bob\n')
+      stale = sample_manifest.Manifest('sample')
+      self.assertFalse(stale.read_snapshot(snapshot_path, [manifest_path]))
+      self.assertEqual({}, stale.tags)
 
   def test_get_keys(self):
     manifest_source, (expect_alice, expect_bob, expect_carol,
@@ -460,6 +507,29 @@ who: dan
     manifest.read_sources([('erroring manifest', manifest_content, {})])
     self.assertRaises(sample_manifest.CycleError, manifest.index)
 
+  def test_inclusion_resolver_reuses_parsed_values(self):
+    common = {'base': '/{lang}/samples', 'path': '{base}/{name}.{lang}'}
+    elements = [dict(common, lang='py', name='one'),
+                dict(common, lang='py', name='two'),
+                dict(common, lang='java', name='one')]
+    resolver = sample_manifest.InclusionResolver()
+    sample_manifest.resolve_inclusions(elements, resolver)
+
+    self.assertEqual(['/py/samples/one.py', '/py/samples/two.py',
+                      '/java/samples/one.java'],
+                     [element['path'] for element in elements])
+    self.assertEqual('/py/samples', elements[1]['base'])
+
+    # each distinct tag value is parsed only once
+    self.assertEqual({'/{lang}/samples', '{base}/{name}.{lang}', 'py', 'java',
+                      'one', 'two'},
+                     set(resolver.inclusions))
+    # `base` is resolved once per distinct language
+    self.assertEqual([('/{lang}/samples', ('py',)),
+                      ('/{lang}/samples', ('java',))],
+                     [key for key in resolver.resolved
+                      if key[0] == '/{lang}/samples'])
+
   def test_extend_all_with(self):
     manifest = [
       {
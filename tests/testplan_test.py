@@ -16,7 +16,9 @@
 import unittest
 from textwrap import dedent
 
+from sampletester import environment_registry
 from sampletester import parser
+from sampletester import testenv
 from sampletester import testplan
 
 
@@ -86,3 +88,89 @@ class TestTestPlan(unittest.TestCase):
                       if suite.selected() and test_case.selected()}
     self.assertEqual({'hadrons'}, selected_suites)
     self.assertEqual({'neutron'}, selected_cases)
+
+  def test_suites_from_invalid_filter(self):
+    with self.assertRaisesRegex(ValueError, 'invalid filter "tron\('):
+      testplan.suites_from(self.config, case_filter='tron(')
+
+
+class TestSharding(unittest.TestCase):
+  def setUp(self):
+    config = parser.IndexedDocs()
+    config.from_strings(('particles', dedent('''\
+       type: test/samples
+       schema_version: 1
+       test:
+         suites:
+         - name: hadrons
+           cases:
+           - name: proton
+           - name: neutron
+         - name: leptons
+           cases:
+           - name: electron
+           - name: muon
+           - name: tauon
+       ''')))
+    self.registry = environment_registry.Registry()
+    self.registry.add(testenv.Base('python'), testenv.Base('java'))
+    self.suites = testplan.suites_from(config)
+
+  def selected_in_shard(self, index, count, shard_estimator=None, **kwargs):
+    manager = testplan.Manager(self.registry, self.suites, **kwargs)
+    manager.shard(index, count, shard_estimator)
+    return {(env.name(), suite.name(), case.name())
+            for env in manager.environments if env.selected()
+            for suite in env.suites if suite.selected()
+            for case in suite.cases if case.selected()}
+
+  def test_shards_partition_cases(self):
+    all_cases = self.selected_in_shard(0, 1)
+    self.assertEqual(10, len(all_cases))
+    shards = [self.selected_in_shard(index, 3) for index in range(3)]
+    self.assertEqual(all_cases, set.union(*shards))
+    self.assertEqual(10, sum(len(shard) for shard in shards))
+    self.assertEqual([4, 3, 3], [len(shard) for shard in shards])
+    self.assertEqual(shards[1], self.selected_in_shard(1, 3))
+
+  def test_shards_balanced_by_duration(self):
+    durations = {'proton': 10, 'neutron': 8, 'electron': 1, 'muon': 1,
+                 'tauon': None}
+    estimator = lambda env, suite, case: durations[case.name()]
+    shards = [self.selected_in_shard(index, 2, shard_estimator=estimator)
+              for index in range(2)]
+    self.assertEqual(10, len(shards[0] | shards[1]))
+    median = 4.5  # assumed for the case without a known duration
+    totals = [sum(durations[case] or median for _, _, case in shard)
+              for shard in shards]
+    self.assertEqual(totals[0], totals[1])
+
+    # The estimator for ordering concurrent cases doesn't affect the shards.
+    self.assertEqual(self.selected_in_shard(0, 2),
+                     self.selected_in_shard(0, 2, duration_estimator=estimator))
+
+  def test_empty_suites_deselected(self):
+    manager = testplan.Manager(self.registry, self.suites, env_filter='python')
+    manager.shard(1, 10)
+    selected = {env.name(): [suite.name() for suite in env.suites
+                             if suite.selected()]
+                for env in manager.environments if env.selected()}
+    self.assertEqual({'python': ['hadrons']}, selected)
+
+  def test_environments_share_configuration(self):
+    manager = testplan.Manager(self.registry, self.suites)
+    python, java = manager.environments
+    python_case = python.suites[1].cases[0]
+    java_case = java.suites[1].cases[0]
+    self.assertIsNot(python_case, java_case)
+    self.assertIs(python_case.config, java_case.config)
+    self.assertIs(python.suites[1].config, java.suites[1].config)
+
+    python_case.num_failures += 1
+    self.assertEqual(0, java_case.num_failures)
+    with self.assertRaises(TypeError):
+      python_case.config['name'] = 'positron'
+
+  def test_invalid_shard(self):
+    manager = testplan.Manager(self.registry, self.suites)
+    self.assertRaises(ValueError, manager.shard, 2, 2)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import threading
+import unittest
+from textwrap import dedent
+
+from sampletester import environment_registry
+from sampletester import parser
+from sampletester import testenv
+from sampletester import testplan
+from sampletester import timings
+
+
+class TestDatabase(unittest.TestCase):
+  def test_record_and_get(self):
+    database = timings.Database('unused')
+    self.assertIsNone(database.get('python', 'suite', 'case'))
+    database.record('python', 'suite', 'case', 10)
+    self.assertEqual(10, database.get('python', 'suite', 'case'))
+    database.record('python', 'suite', 'case', 20)
+    self.assertEqual(15, database.get('python', 'suite', 'case'))
+    self.assertIsNone(database.get('java', 'suite', 'case'))
+
+  def test_save_and_load(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'nested', 'timings.json')
+      database = timings.Database(path)
+      database.record('python', 'suite', 'case', 3.5)
+      database.save()
+
+      loaded = timings.Database(path).load()
+      self.assertEqual(3.5, loaded.get('python', 'suite', 'case'))
+
+  def test_load_missing_or_corrupt(self):
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'timings.json')
+      self.assertEqual({}, timings.Database(path).load().durations)
+      with open(path, 'w') as stream:
+        stream.write('{not json')
+      self.assertEqual({}, timings.Database(path).load().durations)
+
+
+class StartOrderVisitor(testplan.Visitor):
+  """Records the order in which test cases start being visited."""
+
+  def __init__(self):
+    self.started = []
+    self.lock = threading.Lock()
+
+  def parallelizable(self):
+    return True
+
+  def visit_testcase(self, idx, tcase, doit):
+    with self.lock:
+      self.started.append(tcase.name())
+
+
+class TestScheduling(unittest.TestCase):
+  def setUp(self):
+    config = parser.IndexedDocs()
+    config.from_strings(('plan', dedent('''\
+        type: test/samples
+        schema_version: 1
+        test:
+          suites:
+          - name: short
+            cases:
+            - name: a
+            - name: b
+          - name: long
+            cases:
+            - name: c
+            - name: d
+        ''')))
+    self.suites = testplan.suites_from(config)
+    self.registry = environment_registry.Registry()
+    self.registry.add(testenv.Base('python'))
+
+    self.database = timings.Database('unused')
+    for case, seconds in [('a', 1), ('b', 2), ('c', 30), ('d', 20)]:
+      suite = 'short' if case in 'ab' else 'long'
+      self.database.record('python', suite, case, seconds)
+
+  def test_longest_first(self):
+    manager = testplan.Manager(self.registry, self.suites,
+                               duration_estimator=self.database.estimate)
+    visitor = StartOrderVisitor()
+    manager.accept(visitor, jobs=2)
+    self.assertEqual({'c', 'd'}, set(visitor.started[:2]))
+    self.assertEqual({'a', 'b'}, set(visitor.started[2:]))
+
+  def test_recorder(self):
+    manager = testplan.Manager(self.registry, self.suites)
+    database = timings.Database('unused')
+    manager.accept(timings.Recorder(database))
+    self.assertEqual({}, database.durations)  # nothing was attempted
+
+
+if __name__ == '__main__':
+  unittest.main()
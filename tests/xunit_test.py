@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Copyright 2019 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+from sampletester import xunit
+
+
+class TestMerge(unittest.TestCase):
+  def test_merge(self):
+    shard_0 = '\n'.join([
+        '<testsuites failures="1" errors="0">',
+        '  <testsuite name="hadrons:python" failures="1" errors="0">',
+        '    <testcase name="proton:python" failures="1" errors="0">',
+        '      <failure type="failed assertion">oops &amp; more</failure>',
+        '    </testcase>',
+        '  </testsuite>',
+        '</testsuites>'])
+    shard_1 = '\n'.join([
+        '<testsuites failures="0" errors="2">',
+        '  <testsuite name="leptons:python" failures="0" errors="2">',
+        '    <testcase name="muon:python" failures="0" errors="2"/>',
+        '  </testsuite>',
+        '</testsuites>'])
+    merged = ElementTree.fromstring(xunit.merge(shard_0, shard_1))
+    self.assertEqual('testsuites', merged.tag)
+    self.assertEqual('1', merged.get('failures'))
+    self.assertEqual('2', merged.get('errors'))
+    self.assertEqual(['hadrons:python', 'leptons:python'],
+                     [suite.get('name') for suite in merged])
+    self.assertEqual('oops & more', merged.find('.//failure').text)
+
+  def test_merge_same_suite(self):
+    shard_0 = '\n'.join([
+        '<testsuites failures="1" errors="0">',
+        '  <testsuite name="s" failures="1" errors="0"'
+        ' timestamp="2019-06-01T10:00:05" time="1.5">',
+        '    <testcase name="a" failures="1" errors="0"/>',
+        '  </testsuite>',
+        '  <testsuite name="t" failures="0" errors="0"'
+        ' timestamp="2019-06-01T10:00:00" time="1.0">',
+        '    <testcase name="c" failures="0" errors="0"/>',
+        '  </testsuite>',
+        '</testsuites>'])
+    shard_1 = '\n'.join([
+        '<testsuites failures="0" errors="1">',
+        '  <testsuite name="s" failures="0" errors="1"'
+        ' timestamp="2019-06-01T10:00:01.500000" time="2.25">',
+        '    <testcase name="b" failures="0" errors="1"/>',
+        '  </testsuite>',
+        '</testsuites>'])
+    merged = ElementTree.fromstring(xunit.merge(shard_0, shard_1))
+    self.assertEqual('1', merged.get('failures'))
+    self.assertEqual('1', merged.get('errors'))
+    self.assertEqual(['s', 't'], [suite.get('name') for suite in merged])
+    suite = merged[0]
+    self.assertEqual(['a', 'b'], [case.get('name') for case in suite])
+    self.assertEqual('1', suite.get('failures'))
+    self.assertEqual('1', suite.get('errors'))
+    self.assertEqual(3.75, float(suite.get('time')))
+    self.assertEqual('2019-06-01T10:00:01.500000', suite.get('timestamp'))
+
+  def test_merge_rejects_other_documents(self):
+    self.assertRaises(ValueError, xunit.merge, '<testsuite/>')
+
+
+if __name__ == '__main__':
+  unittest.main()